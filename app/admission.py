@@ -0,0 +1,140 @@
+"""Допуск задач по свободному месту на диске загрузок.
+
+Перед скачиванием задача резервирует место: сумма ``filesize`` /
+``filesize_approx`` выбранных форматов из пробы, умноженная на
+``DISK_RESERVE_FACTOR`` (дорожки + результат склейки/ремукса лежат на диске
+одновременно). Если резерв не помещается в ``free - зарезервировано -
+DISK_MIN_FREE_MB``, задача ждёт, пока другие освободят место; резерв
+снимается по завершении задачи. Задача, которая не помещается даже на пустой
+очереди, сразу получает :class:`InsufficientSpace`.
+
+Учёт консервативный: уже записанные байты идущих задач вычитаются из
+``free`` и ещё раз учитываются в их резерве.
+"""
+
+import os
+import shutil
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from formats import FormatIndex
+
+log = logging.getLogger("bot.admission")
+
+MB = 1024 * 1024
+DISK_MIN_FREE = int(float(os.getenv("DISK_MIN_FREE_MB", "1024")) * MB)
+DISK_RESERVE_FACTOR = float(os.getenv("DISK_RESERVE_FACTOR", "2.0"))
+# оценка, если размеров в пробе нет (или info_dict уже выброшен)
+DISK_DEFAULT_ESTIMATE = int(float(os.getenv("DISK_DEFAULT_ESTIMATE_MB", "512")) * MB)
+DISK_WAIT_POLL = 5.0  # сек; место могло освободиться и без нас (janitor и т.п.)
+
+
+class InsufficientSpace(Exception):
+    """Задача не поместится на диск, даже если дождаться всех остальных."""
+
+
+def _fmt_size(f: Dict[str, Any]) -> int:
+    return int(f.get("filesize") or f.get("filesize_approx") or 0)
+
+
+def estimate_bytes(
+    info: Optional[Dict[str, Any]],
+    format_str: Optional[str],
+    factor: float = DISK_RESERVE_FACTOR,
+) -> int:
+    """Сколько места зарезервировать под скачивание ``format_str``.
+
+    Для конкретных id (``"137+140"``) — сумма их размеров; для селекторов
+    (``"bv*+ba/best"``) — верхняя оценка: самое большое видео + самое большое
+    аудио.
+    """
+    size = FormatIndex.of(info).estimate(format_str) if info else 0
+    if not size and info:
+        size = _fmt_size(info)
+    if not size:
+        return DISK_DEFAULT_ESTIMATE
+    return int(size * factor)
+
+
+class DiskAdmission:
+    def __init__(self, path: str, min_free: int = DISK_MIN_FREE):
+        self.path = path
+        self.min_free = min_free
+        self.reserved = 0
+        self.waiting = 0
+        self._cond = asyncio.Condition()
+
+    def free(self) -> int:
+        try:
+            return shutil.disk_usage(self.path).free
+        except OSError as e:
+            log.warning("Не удалось узнать свободное место %s: %s", self.path, e)
+            return 0
+
+    def available(self) -> int:
+        return self.free() - self.reserved - self.min_free
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "free": self.free(),
+            "reserved": self.reserved,
+            "waiting": self.waiting,
+            "min_free": self.min_free,
+        }
+
+    @asynccontextmanager
+    async def reserve(
+        self,
+        nbytes: int,
+        on_wait: Optional[Callable[[], Awaitable[Any]]] = None,
+        check: Optional[Callable[[], None]] = None,
+    ):
+        """Резервирует ``nbytes`` на время блока; ждёт, если не помещается.
+
+        ``on_wait`` вызывается один раз, если пришлось ждать (например, правка
+        статуса), ``check`` — проверка отмены (бросает исключение), пока ждём.
+        """
+        nbytes = max(0, int(nbytes))
+        waited = False
+        try:
+            while True:
+                if check is not None:
+                    check()
+                async with self._cond:
+                    if self.available() >= nbytes:
+                        self.reserved += nbytes
+                        break
+                    if self.reserved == 0:
+                        raise InsufficientSpace(self._shortage(nbytes))
+                    if waited:
+                        try:
+                            await asyncio.wait_for(self._cond.wait(), DISK_WAIT_POLL)
+                        except asyncio.TimeoutError:
+                            pass
+                        continue
+                waited = True
+                self.waiting += 1
+                log.info(
+                    "Нет места под %.0f MB (резерв %.0f MB), задача ждёт",
+                    nbytes / MB,
+                    self.reserved / MB,
+                )
+                if on_wait is not None:
+                    await on_wait()
+        finally:
+            if waited:
+                self.waiting -= 1
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self.reserved -= nbytes
+                self._cond.notify_all()
+
+    def _shortage(self, nbytes: int) -> str:
+        return (
+            f"нужно {nbytes / MB:.0f} MB, свободно "
+            f"{max(0, self.free() - self.min_free) / MB:.0f} MB"
+        )
@@ -0,0 +1,214 @@
+"""Подбор параметров aria2c под источник и размер файла по измеренной скорости.
+
+Раньше каждая задача шла с ``--split=16 --max-connection-per-server=16`` и
+``concurrent_fragments=4``: для коротких reels это лишние соединения, YouTube
+режет скорость на соединение, а N параллельных задач открывали 16×N
+соединений и забивали канал. Теперь :class:`AriaPolicy`:
+
+* берёт стартовые значения по экстрактору (``instagram`` — одно соединение,
+  ``youtube`` — умеренно) и ограничивает split размером файла;
+* для каждого экстрактора и вида протокола (обычный HTTP / фрагменты)
+  копит EWMA скорости по каждому числу соединений из ``progress_hooks``
+  (событие ``finished``: байты и ``elapsed``) и выбирает число, после которого
+  прирост меньше ``_GAIN``; время от времени пробует вдвое больше;
+* выдаёт соединения из общего бюджета ``ARIA_CONN_BUDGET`` на все задачи:
+  задача получает не больше свободного остатка (но хотя бы одно) и
+  возвращает их по завершении (:meth:`AriaLease.release`).
+
+aria2c включают опции yt-dlp ``external_downloader`` / ``external_downloader_args``
+(ключи ``downloader``/``downloader_args`` yt-dlp молча игнорирует). Наши
+``--split`` и ``--max-connection-per-server`` идут после умолчаний yt-dlp
+(``-s16 -x16``) и перекрывают их; без aria2c в PATH yt-dlp качает сам.
+
+Статистика живёт в памяти процесса; счётчики — в :meth:`AriaPolicy.stats`.
+"""
+
+import os
+import logging
+import threading
+from urllib.parse import urlparse
+from typing import Any, Dict, Optional, Tuple
+
+from admission import estimate_bytes
+from formats import FormatIndex
+
+log = logging.getLogger("bot.aria")
+
+MB = 1024 * 1024
+ARIA_CONN_BUDGET = max(1, int(os.getenv("ARIA_CONN_BUDGET", "32")))
+ARIA_MAX_SPLIT = max(1, int(os.getenv("ARIA_MAX_SPLIT", "16")))
+# сколько байт файла на одно соединение (меньше — split не окупается)
+ARIA_MIN_BYTES_PER_CONN = int(float(os.getenv("ARIA_MIN_MB_PER_CONN", "4")) * MB)
+
+_ALPHA = 0.3  # вес нового замера в EWMA
+_GAIN = 1.1  # больше соединений — только если быстрее хотя бы на 10%
+_EXPLORE_AFTER = 3  # замеров на лучшем значении, прежде чем пробовать вдвое больше
+_MIN_SAMPLE_BYTES = 2 * MB  # короткие загрузки скорость не показывают
+
+# (split, фрагментов параллельно) для начала, пока нет замеров
+_PROFILES: Dict[str, Tuple[int, int]] = {
+    "instagram": (1, 1),
+    "tiktok": (1, 2),
+    "twitter": (2, 2),
+    "youtube": (4, 4),
+    "vimeo": (8, 4),
+}
+_DEFAULT_PROFILE = (8, 4)
+
+# протоколы yt-dlp, где файл качается фрагментами (HLS/DASH)
+_FRAGMENTED = ("m3u8", "dash", "ism", "f4m")
+
+
+def extractor_of(url: str, info: Optional[Dict[str, Any]] = None) -> str:
+    """Ключ источника: ``extractor_key`` пробы или домен ссылки."""
+    key = ((info or {}).get("extractor_key") or "").lower()
+    if key:
+        return key
+    host = (urlparse(url).hostname or "").lower()
+    parts = host.split(".")
+    return parts[-2] if len(parts) >= 2 else host or "generic"
+
+
+def _protocol(info: Optional[Dict[str, Any]], format_str: Optional[str]) -> str:
+    """``frag`` для HLS/DASH, иначе ``http`` — по первому выбранному формату."""
+    by_id = FormatIndex.of(info).by_id
+    for alt in (format_str or "").split("/"):
+        for fid in alt.split("+"):
+            f = by_id.get(fid)
+            if f is not None:
+                return "frag" if any(p in f.protocol for p in _FRAGMENTED) else "http"
+    proto = str((info or {}).get("protocol") or "")
+    return "frag" if any(p in proto for p in _FRAGMENTED) else "http"
+
+
+class _Stats:
+    __slots__ = ("rates", "samples")
+
+    def __init__(self):
+        self.rates: Dict[int, float] = {}  # соединений -> EWMA байт/с
+        self.samples: Dict[int, int] = {}
+
+
+class AriaLease:
+    """Соединения одной задачи: опции yt-dlp, замер скорости, возврат в бюджет."""
+
+    def __init__(self, policy: "AriaPolicy", key: Tuple[str, str], conns: int):
+        self.policy = policy
+        self.key = key
+        self.conns = conns
+        self._released = False
+
+    def opts(self) -> Dict[str, Any]:
+        """Опции yt-dlp поверх YDL_OPTS_BASE."""
+        split = self.conns if self.key[1] == "http" else 1
+        return {
+            "concurrent_fragment_downloads": (
+                self.conns if self.key[1] == "frag" else 1
+            ),
+            "external_downloader": {"default": "aria2c"},
+            "external_downloader_args": {
+                "aria2c": [
+                    f"--split={split}",
+                    f"--max-connection-per-server={split}",
+                    "--min-split-size=1M",
+                ]
+            },
+        }
+
+    def hook(self, d: Dict[str, Any]) -> None:
+        """progress_hook yt-dlp: по ``finished`` записывает скорость."""
+        if d.get("status") != "finished":
+            return
+        size = d.get("total_bytes") or d.get("downloaded_bytes") or 0
+        elapsed = d.get("elapsed") or 0
+        if size >= _MIN_SAMPLE_BYTES and elapsed > 0:
+            self.policy.record(self.key, self.conns, size / elapsed)
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self.policy._release(self.conns)
+
+
+class AriaPolicy:
+    def __init__(
+        self,
+        budget: int = ARIA_CONN_BUDGET,
+        max_split: int = ARIA_MAX_SPLIT,
+        min_bytes_per_conn: int = ARIA_MIN_BYTES_PER_CONN,
+    ):
+        self.budget = budget
+        self.max_split = max_split
+        self.min_bytes_per_conn = min_bytes_per_conn
+        self.in_use = 0
+        self._stats: Dict[Tuple[str, str], _Stats] = {}
+        self._lock = threading.Lock()
+
+    def _choose(self, key: Tuple[str, str]) -> int:
+        split, frags = _PROFILES.get(key[0], _DEFAULT_PROFILE)
+        base = min(split if key[1] == "http" else frags, self.max_split)
+        st = self._stats.get(key)
+        if st is None or not st.rates:
+            return base
+        # наименьшее число соединений, с которым скорость не хуже лучшей на _GAIN
+        top = max(st.rates.values())
+        best = min(n for n, r in st.rates.items() if r * _GAIN >= top)
+        up = min(best * 2, self.max_split)
+        if up not in st.rates and st.samples.get(best, 0) >= _EXPLORE_AFTER:
+            return up
+        return best
+
+    def lease(
+        self,
+        url: str,
+        info: Optional[Dict[str, Any]] = None,
+        format_str: Optional[str] = None,
+    ) -> AriaLease:
+        key = (extractor_of(url, info), _protocol(info, format_str))
+        size = estimate_bytes(info, format_str, factor=1.0) if info else 0
+        with self._lock:
+            want = self._choose(key)
+            if size:
+                want = min(want, max(1, size // self.min_bytes_per_conn))
+            conns = max(1, min(want, self.budget - self.in_use))
+            self.in_use += conns
+        log.info(
+            "aria2c: %s/%s → %d соединений (хотели %d, занято %d из %d)",
+            key[0],
+            key[1],
+            conns,
+            want,
+            self.in_use,
+            self.budget,
+        )
+        return AriaLease(self, key, conns)
+
+    def _release(self, conns: int) -> None:
+        with self._lock:
+            self.in_use = max(0, self.in_use - conns)
+
+    def record(self, key: Tuple[str, str], conns: int, rate: float) -> None:
+        with self._lock:
+            st = self._stats.setdefault(key, _Stats())
+            old = st.rates.get(conns)
+            st.rates[conns] = rate if old is None else old + _ALPHA * (rate - old)
+            st.samples[conns] = st.samples.get(conns, 0) + 1
+        log.info(
+            "aria2c: %s/%s, %d соединений: %.1f MB/s (EWMA %.1f MB/s)",
+            key[0],
+            key[1],
+            conns,
+            rate / MB,
+            st.rates[conns] / MB,
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "budget": self.budget,
+                "in_use": self.in_use,
+                "rates": {
+                    f"{k[0]}/{k[1]}": {n: round(r) for n, r in sorted(st.rates.items())}
+                    for k, st in self._stats.items()
+                },
+            }
@@ -0,0 +1,192 @@
+"""Общий лимит полосы на скачивания и аплоады с честной долей на чат.
+
+Скачивания (aria2c / yt-dlp) и аплоады в Bot API делят один канал: без
+координации аплоады голодают, и задачи заканчиваются позже. :class:`Bandwidth`
+держит по ведру токенов на направление (``BW_DOWNLOAD_MB`` /
+``BW_UPLOAD_MB`` МБ/с, 0 — без лимита). Каждая передача открывает
+:class:`Flow` (:meth:`Direction.open`), и лимит делится поровну (с весами)
+между чатами, у которых сейчас есть передачи, а доля чата — между его
+передачами. При открытии и закрытии потоков доли пересчитываются:
+
+* скачивание — колбэк :meth:`Flow.on_rate` пишет долю в
+  ``ydl.params["ratelimit"]``: нативный загрузчик yt-dlp читает его на
+  каждом куске, а для aria2c yt-dlp превращает его в
+  ``--max-overall-download-limit`` при запуске на каждый файл (новая доля
+  действует со следующего файла, уже идущий aria2c её не видит);
+* аплоад — :meth:`Flow.consume` вызывается перед отдачей каждого куска
+  тела запроса и спит, пока у потока и у направления не хватит токенов;
+  в цикле событий — :meth:`Flow.reserve` и ``asyncio.sleep`` на тот же срок.
+"""
+
+import os
+import time
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+log = logging.getLogger("bot.bandwidth")
+
+MB = 1024 * 1024
+# байт/с, 0 — без лимита
+BW_DOWNLOAD = int(float(os.getenv("BW_DOWNLOAD_MB", "0")) * MB)
+BW_UPLOAD = int(float(os.getenv("BW_UPLOAD_MB", "0")) * MB)
+BW_BURST = float(os.getenv("BW_BURST_SEC", "1.0"))  # сек запаса токенов в ведре
+
+_MIN_RATE = 64 * 1024  # меньше доли не даём: иначе передача фактически стоит
+
+
+class TokenBucket:
+    """Ведро токенов (байт) с долгом: большой кусок уводит баланс в минус."""
+
+    def __init__(self, rate: float, burst: float = BW_BURST):
+        self.burst_sec = burst
+        self.rate = 0.0
+        self.tokens = 0.0
+        self.stamp = time.monotonic()
+        self._lock = threading.Lock()
+        self.set_rate(rate)
+
+    def set_rate(self, rate: float) -> None:
+        with self._lock:
+            self._refill()
+            self.rate = max(0.0, float(rate))
+            self.tokens = min(self.tokens, self._cap())
+
+    def _cap(self) -> float:
+        return max(self.rate * self.burst_sec, _MIN_RATE)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        if self.rate > 0:
+            self.tokens = min(self._cap(), self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def reserve(self, n: int) -> float:
+        """Списывает ``n`` байт; возвращает, сколько секунд подождать."""
+        with self._lock:
+            if self.rate <= 0:
+                return 0.0
+            self._refill()
+            self.tokens -= n
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class Flow:
+    """Одна передача (файл) чата в одном направлении."""
+
+    def __init__(self, direction: "Direction", chat_id: Optional[int], weight: float):
+        self.direction = direction
+        self.chat_id = chat_id
+        self.weight = weight
+        self.rate = 0.0  # текущая доля, байт/с (0 — без лимита)
+        self.bucket = TokenBucket(0)
+        self.bytes = 0
+        self._listeners: List[Callable[[Optional[int]], Any]] = []
+
+    @property
+    def ratelimit(self) -> Optional[int]:
+        """Доля в формате ``ratelimit`` yt-dlp (None — без лимита)."""
+        return int(self.rate) if self.rate > 0 else None
+
+    def on_rate(self, fn: Callable[[Optional[int]], Any]) -> None:
+        """Вызывает ``fn(ratelimit)`` сейчас и при каждом пересчёте доли."""
+        self._listeners.append(fn)
+        fn(self.ratelimit)
+
+    def _set_rate(self, rate: float) -> None:
+        self.rate = rate
+        self.bucket.set_rate(rate)
+        for fn in self._listeners:
+            try:
+                fn(self.ratelimit)
+            except Exception:
+                log.debug("Ошибка в колбэке лимита", exc_info=True)
+
+    def reserve(self, n: int) -> float:
+        """Списывает ``n`` байт; возвращает, сколько секунд подождать."""
+        self.bytes += n
+        return max(self.bucket.reserve(n), self.direction.bucket.reserve(n))
+
+    def consume(self, n: int) -> None:
+        """Блокирует поток, пока передачу ``n`` байт не разрешат лимиты."""
+        wait = self.reserve(n)
+        if wait > 0:
+            time.sleep(wait)
+
+    def close(self) -> None:
+        self.direction._close(self)
+
+    def __enter__(self) -> "Flow":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class Direction:
+    def __init__(self, name: str, rate: int):
+        self.name = name
+        self.rate = rate
+        self.bucket = TokenBucket(rate)
+        self._flows: List[Flow] = []
+        self._lock = threading.Lock()
+
+    def open(self, chat_id: Optional[int], weight: float = 1.0) -> Flow:
+        flow = Flow(self, chat_id, weight)
+        with self._lock:
+            self._flows.append(flow)
+        self._rebalance()
+        return flow
+
+    def _close(self, flow: Flow) -> None:
+        with self._lock:
+            if flow not in self._flows:
+                return
+            self._flows.remove(flow)
+        self._rebalance()
+
+    def _shares(self) -> Dict[Flow, float]:
+        if self.rate <= 0:
+            return {f: 0.0 for f in self._flows}
+        chats: Dict[Optional[int], List[Flow]] = {}
+        for f in self._flows:
+            chats.setdefault(f.chat_id, []).append(f)
+        # вес чата — наибольший вес его передач
+        weights = {c: max(f.weight for f in fs) for c, fs in chats.items()}
+        total = sum(weights.values()) or 1.0
+        shares = {}
+        for c, fs in chats.items():
+            per_flow = self.rate * weights[c] / total / len(fs)
+            for f in fs:
+                shares[f] = max(per_flow, _MIN_RATE)
+        return shares
+
+    def _rebalance(self) -> None:
+        # под замком: два пересчёта подряд не применятся в обратном порядке
+        with self._lock:
+            for f, rate in self._shares().items():
+                if rate != f.rate:
+                    f._set_rate(rate)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "rate": self.rate,
+                "flows": len(self._flows),
+                "chats": len({f.chat_id for f in self._flows}),
+            }
+
+
+class Bandwidth:
+    def __init__(self, download: int = BW_DOWNLOAD, upload: int = BW_UPLOAD):
+        self.download = Direction("download", download)
+        self.upload = Direction("upload", upload)
+        if download or upload:
+            log.info(
+                "Лимит полосы: скачивание %s, аплоад %s",
+                f"{download / MB:.1f} MB/s" if download else "без лимита",
+                f"{upload / MB:.1f} MB/s" if upload else "без лимита",
+            )
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {"download": self.download.stats(), "upload": self.upload.stats()}
@@ -1,9 +1,46 @@
-import os, re, time, json, subprocess, tempfile, requests, logging, traceback
+import os, re, time, json, copy, asyncio, logging, traceback
 from pathlib import Path
 from yt_dlp import YoutubeDL
+from yt_dlp.utils import DownloadError
 import uuid
 from typing import List, Dict, Any, Tuple, Optional
 
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from botapi import AsyncBotAPI, BotAPI, retry_after
+from admission import DiskAdmission, InsufficientSpace, estimate_bytes
+from aria_policy import AriaPolicy
+from bandwidth import Bandwidth
+from delivery_cache import DeliveryCache, file_id_from_result
+from formats import FormatIndex
+from janitor import Janitor, Root
+import metrics
+from metrics import BYTES, JOBS_TOTAL, timed
+from jobs import Job, JobCancelled, JobRegistry, cancellable, run_job
+from media_info import probe as probe_media
+from outputs import JobOutput
+from pending_store import PendingSession, PendingStore
+from pipeline import (
+    MERGER_PP_ARGS,
+    PIPELINED_UPLOAD,
+    MergeWatcher,
+    multipart_stream,
+    video_meta_from_info,
+)
+from postprocess import SmartMp4PP
+from probe_cache import ProbeCache, canonical_key, info_is_fresh, info_key
+from progress import (
+    PROGRESS_CHAT_INTERVAL,
+    UPLOAD_HEADER,
+    Progress,
+    ProgressReporter,
+)
+from scheduler import MAX_JOBS, JobScheduler
+from singleflight import AsyncSingleFlight
+from thumbnails import THUMB_DIR, make_thumbnail
+
 try:
     from dotenv import load_dotenv
     from pathlib import Path as _P
@@ -52,6 +89,8 @@ BOT_TOKEN = require_env("BOT_TOKEN")
 BASE_URL = require_env("BASE_URL")  # локальный Bot API
 OUT_DIR = require_env("OUT_DIR")
 COOKIES = os.getenv("COOKIES")
+# сек, общий таймаут скачивания; по истечении задача останавливается
+DOWNLOAD_TIMEOUT = int(os.getenv("DOWNLOAD_TIMEOUT", "7200"))
 os.makedirs(OUT_DIR, exist_ok=True)
 
 log.info("BASE_URL=%s", BASE_URL)
@@ -60,31 +99,18 @@ if COOKIES:
     log.info("COOKIES=%s", COOKIES)
 
 # yt-dlp опции — на основе твоего test.py
+# split aria2c и параллельность фрагментов подбирает ARIA (aria_policy.py)
 YDL_OPTS_BASE = {
-    "concurrent_fragments": 4,
-    "downloader": "aria2c",
-    "downloader_args": {
-        "aria2c": [
-            "--split=16",
-            "--max-connection-per-server=16",
-            "--min-split-size=1M",
-        ]
-    },
+    "external_downloader": {"default": "aria2c"},
     "socket_timeout": 30,
     "retries": 10,
     "fragment_retries": 10,
     "file_access_retries": 10,
     "geo_bypass": True,
-    # Сразу делаем MP4; если нельзя ремукснуть — сконвертируем
+    # Сразу делаем MP4; ремукс/перекодирование решает SmartMp4PP по кодекам
     "merge_output_format": "mp4",
-    "postprocessors": [
-        {"key": "FFmpegVideoRemuxer", "preferedformat": "mp4"},
-        {"key": "FFmpegVideoConvertor", "preferedformat": "mp4"},
-    ],
     # Предпочитаем H.264, потом разрешение/кадровую
     "format_sort": ["codec:avc1", "res", "fps", "br"],
-    # Выходной шаблон
-    "outtmpl": os.path.join(OUT_DIR, "%(title)s [%(id)s].%(ext)s"),
     # Не шумим лишним
     "quiet": True,
     "no_warnings": True,
@@ -93,81 +119,101 @@ YDL_OPTS_BASE = {
 if COOKIES and os.path.isfile(COOKIES):
     YDL_OPTS_BASE["cookiefile"] = COOKIES
 
+# Имя файла внутри каталога задачи (outputs.JobOutput)
+OUT_NAME = "%(title)s [%(id)s].%(ext)s"
+
 URL_RE = re.compile(r"https?://\S+")
 
-# token -> (url, choices). choices is a list of (label, format_str)
-PENDING: Dict[str, Tuple[str, List[Tuple[str, str]]]] = {}
+# token -> PendingSession(url, choices, info). choices is a list of
+# (label, format_str), info — info_dict пробы, переиспользуется при скачивании
+PENDING = PendingStore.from_env(OUT_DIR)
 
+# Клиенты Bot API с пулом keep-alive соединений и повторами по retry_after:
+# асинхронный — для коротких вызовов из цикла, синхронный — для потоковых
+# аплоадов, которые идут в потоках executor'а
+API = AsyncBotAPI(BASE_URL, BOT_TOKEN)
+UPLOAD_API = BotAPI(BASE_URL, BOT_TOKEN)
 
-def ffprobe_meta(path: str):
-    """Вернёт (width, height, duration) или (None, None, None)."""
-    try:
-        out = (
-            subprocess.check_output(
-                [
-                    "ffprobe",
-                    "-v",
-                    "error",
-                    "-select_streams",
-                    "v:0",
-                    "-show_entries",
-                    "stream=width,height:format=duration",
-                    "-of",
-                    "default=noprint_wrappers=1:nokey=1",
-                    path,
-                ],
-                stderr=subprocess.STDOUT,
-            )
-            .decode("utf-8", "ignore")
-            .strip()
-            .splitlines()
-        )
-        if len(out) >= 3:
-            w = int(float(out[0])) if out[0] else None
-            h = int(float(out[1])) if out[1] else None
-            try:
-                dur = int(float(out[2])) if out[2] else None
-            except ValueError:
-                dur = None
-            return w, h, dur
-    except Exception:
-        pass
-    return None, None, None
+# Кэш проб: один и тот же ролик не экстрактим повторно в течение PROBE_CACHE_TTL
+PROBE_CACHE = ProbeCache.from_env(OUT_DIR)
 
+# (ролик, формат) -> file_id уже отправленного файла
+DELIVERY_CACHE = DeliveryCache.from_env(OUT_DIR)
 
-def make_thumbnail(video_path: str) -> str | None:
-    """Делает jpeg-миниатюру на ~1.0с. Возвращает путь или None."""
-    try:
-        tmpdir = tempfile.gettempdir()
-        base = os.path.splitext(os.path.basename(video_path))[0]
-        out = os.path.join(tmpdir, f"{base}.jpg")
-        subprocess.check_call(
-            [
-                "ffmpeg",
-                "-y",
-                "-ss",
-                "1.0",
-                "-i",
-                video_path,
-                "-vframes",
-                "1",
-                "-q:v",
-                "2",
-                out,
-            ],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-        )
-        if os.path.isfile(out) and os.path.getsize(out) > 0:
-            return out
-    except Exception:
-        pass
+# Лимиты задач/этапов; цикл getUpdates только запускает корутины
+SCHEDULER = JobScheduler()
+
+# Потоки для блокирующей работы (yt-dlp, ffprobe/ffmpeg, аплоад). Каждая
+# задача держит не больше двух потоков сразу (конвейер: скачивание + аплоад)
+BLOCKING_WORKERS = int(os.getenv("BLOCKING_WORKERS", str(MAX_JOBS * 2 + 4)))
+
+# Соединения aria2c: по источнику, размеру и замерам скорости, общий бюджет
+ARIA = AriaPolicy()
+
+# Общий лимит полосы скачиваний/аплоадов с долей на чат, см. bandwidth.py
+BW = Bandwidth()
+
+# Резервирование места в OUT_DIR под скачивания, см. admission.py
+DISK = DiskAdmission(OUT_DIR)
+
+# Активные задачи скачивания: /cancel и кнопка «Отмена», см. jobs.py
+JOBS = JobRegistry()
+
+# Одинаковые (ролик, формат) качаем один раз, остальным — по file_id
+DOWNLOADS = AsyncSingleFlight("Скачивание")
+
+# Фоновая уборка хвостов упавших задач и старых файлов, см. janitor.py
+JANITOR = Janitor(
+    [Root(OUT_DIR), Root(THUMB_DIR, "thumb-*.jpg", recursive=False)],
+    protect=JOBS.owns,
+)
+
+
+async def _progress_edit(
+    chat_id: int, message_id: int, text: str, reply_markup: Optional[str]
+) -> Optional[float]:
+    # без повторов: к концу паузы 429 текст прогресса уже устарел
+    data: Dict[str, Any] = {
+        "chat_id": str(chat_id),
+        "message_id": message_id,
+        "text": text,
+    }
+    if reply_markup:
+        data["reply_markup"] = reply_markup
+    r = await API.call("editMessageText", data=data, retries=0)
+    if r.status_code == 429:
+        return retry_after(r) or PROGRESS_CHAT_INTERVAL
     return None
 
 
-def _probe_mp4_choices(url: str) -> List[Tuple[str, str]]:
-    """Return list of (label, format_str) for MP4-only video options.
-    Label is like "2160p", "1440p", "1080p" (no extra letters).
+# Прогресс скачивания/аплоада в служебном сообщении, см. progress.py
+PROGRESS = ProgressReporter(_progress_edit)
+
+# Состояние компонентов на /metrics (METRICS_PORT), см. metrics.py
+metrics.Gauge("dlbot_jobs_active", "Активные задачи", fn=lambda: {(): len(JOBS)})
+metrics.expose_stats(
+    "scheduler", "Планировщик: задачи, очередь, этапы", SCHEDULER.stats
+)
+metrics.expose_stats("disk", "Место на диске и резерв, байт", DISK.stats)
+metrics.expose_stats("janitor", "Уборка каталога загрузок", JANITOR.stats)
+metrics.expose_stats("bandwidth", "Лимит полосы и активные передачи", BW.stats)
+metrics.expose_stats("aria", "Соединения aria2c и скорость, байт/с", ARIA.stats)
+metrics.expose_stats(
+    "flights",
+    "Склейка одинаковых проб и скачиваний",
+    lambda: {"probe": PROBE_CACHE.flights.stats(), "download": DOWNLOADS.stats()},
+)
+metrics.expose_stats(
+    "probe_cache",
+    "Кэш проб",
+    lambda: {"hits": PROBE_CACHE.hits, "misses": PROBE_CACHE.misses},
+)
+metrics.expose_stats("progress", "Правки сообщений с прогрессом", PROGRESS.stats)
+
+
+def _probe_mp4_choices(url: str) -> Tuple[List[Tuple[str, str]], Dict[str, Any]]:
+    """Return (choices, info): list of (label, format_str) for MP4-only video
+    options and the probed info_dict. Label is like "2160p", "1440p", "1080p".
     """
     log.info("Пробую получить доступные mp4 форматы: %s", url)
     opts = dict(YDL_OPTS_BASE)
@@ -180,86 +226,49 @@ def _probe_mp4_choices(url: str) -> List[Tuple[str, str]]:
         }
     )
     # ensure we don't force aria2c for probing
-    opts.pop("downloader", None)
-    opts.pop("downloader_args", None)
-    with YoutubeDL(opts) as ydl:
-        info = ydl.extract_info(url, download=False)
+    opts.pop("external_downloader", None)
+    opts.pop("external_downloader_args", None)
+    info = PROBE_CACHE.extract(url, opts)
     log.debug("Заголовок: %s | id: %s", info.get("title"), info.get("id"))
-    formats: List[Dict[str, Any]] = info.get("formats", [])
-
-    # pick best audio (m4a/aac preferred) for pairing with video-only mp4
-    audio_candidates = [
-        f
-        for f in formats
-        if (f.get("vcodec") in (None, "none"))
-        and (f.get("acodec") not in (None, "none"))
-    ]
-
-    def _aud_score(f: Dict[str, Any]):
-        ext = (f.get("ext") or "").lower()
-        pref = 2 if ext in ("m4a", "mp4", "aac") else 1
-        return (pref, f.get("abr") or 0)
-
-    best_audio = max(audio_candidates, key=_aud_score) if audio_candidates else None
-
-    # collect mp4 video formats
-    candidates: List[Dict[str, Any]] = [
-        f
-        for f in formats
-        if (f.get("vcodec") not in (None, "none"))
-        and ((f.get("ext") or "").lower() == "mp4")
+    # лучший mp4 на каждую высоту (fps, затем tbr), видео без звука — с лучшим аудио
+    index = FormatIndex.of(info)
+    uniq: List[Tuple[str, str]] = [
+        (f"{v.height}p", index.pair(v)) for v in index.best_per_height("mp4")
     ]
 
-    # group by height and choose best by fps, then tbr
-    by_h: Dict[int, Dict[str, Any]] = {}
-    for f in candidates:
-        h = int(f.get("height") or 0)
-        cur = by_h.get(h)
-        if not cur:
-            by_h[h] = f
-            continue
-
-        # prefer higher fps, then higher total bitrate
-        def key(ff):
-            return (int(ff.get("fps") or 0), int(ff.get("tbr") or 0))
-
-        if key(f) > key(cur):
-            by_h[h] = f
-
-    choices: List[Tuple[str, str]] = []
-    for h, f in by_h.items():
-        if h <= 0:
-            continue
-        v_id = str(f.get("format_id"))
-        # if video has no audio, pair with best audio
-        if (f.get("acodec") in (None, "none")) and best_audio:
-            a_id = str(best_audio.get("format_id"))
-            fmt = f"{v_id}+{a_id}"
-        else:
-            fmt = v_id
-        label = f"{h}p"
-        choices.append((label, fmt))
-
-    # sort by height desc and ensure unique labels
-    choices.sort(key=lambda x: int(x[0].rstrip("p") or 0), reverse=True)
-    seen = set()
-    uniq: List[Tuple[str, str]] = []
-    for lbl, fmt in choices:
-        if lbl in seen:
-            continue
-        seen.add(lbl)
-        uniq.append((lbl, fmt))
-
     # fallback
     if not uniq:
         uniq.append(("best", "bv*+ba/best"))
     log.info("Найдено вариантов mp4: %d", len(uniq))
-    return uniq
-
-
-def ydl_download(url: str, format_override: Optional[str] = None) -> Path:
-    """Скачивает видео лучшего доступного MP4 (со звуком), возвращает путь к файлу."""
+    return uniq, info
+
+
+def ydl_download(
+    url: str,
+    format_override: Optional[str] = None,
+    info: Optional[Dict[str, Any]] = None,
+    merge_watcher: Optional[MergeWatcher] = None,
+    job: Optional[Job] = None,
+    progress: Optional[Progress] = None,
+) -> Path:
+    """Скачивает видео лучшего доступного MP4 (со звуком), возвращает путь к файлу.
+
+    Если передан ``info`` из пробы и ссылки в нём ещё живы, повторный
+    extract_info не делаем (как ``--load-info-json``). С ``merge_watcher``
+    склейка пишет фрагментированный MP4, который можно отправлять на лету.
+    ``job`` — отмена: его hooks прерывают скачивание и постобработку.
+    ``progress`` — прогресс в служебном сообщении чата.
+    """
     opts = dict(YDL_OPTS_BASE)
+    # каталог задачи + итоговый путь из post_hooks (после MoveFiles)
+    output = JobOutput(OUT_DIR, job.id if job is not None else None)
+    if job is not None:
+        job.use_dir(output.dir)
+    opts["outtmpl"] = output.template(OUT_NAME)
+    opts["post_hooks"] = [output.hook]
+    if merge_watcher is not None:
+        opts["postprocessor_args"] = MERGER_PP_ARGS
+        opts["postprocessor_hooks"] = [merge_watcher.hook]
 
     if format_override:
         opts["format"] = format_override
@@ -290,38 +299,78 @@ def ydl_download(url: str, format_override: Optional[str] = None) -> Path:
         except Exception:
             pass
 
-    opts.setdefault("progress_hooks", []).append(_phook)
-    with YoutubeDL(opts) as ydl:
-        info = ydl.extract_info(url, download=True)
-        # yt_dlp возвращает итоговый путь тут:
-        out_path = ydl.prepare_filename(info)
-        # если был merge/convert — расширение может стать mp4
-        out = Path(os.path.splitext(out_path)[0] + ".mp4")
-        if not out.exists():
-            # fallback: что реально было записано
-            guessed = Path(out_path)
-            if guessed.exists():
-                out = guessed
+    opts.setdefault("progress_hooks", []).extend([_phook, metrics.download_hook])
+    opts["postprocessor_hooks"] = list(opts.get("postprocessor_hooks") or []) + [
+        metrics.pp_hook()
+    ]
+    if job is not None:
+        opts["progress_hooks"].append(job.hook)
+        opts["postprocessor_hooks"].append(job.pp_hook)
+    if progress is not None:
+        opts["progress_hooks"].append(progress.hook)
+        opts["postprocessor_hooks"].append(progress.pp_hook)
+    # split/фрагменты — из бюджета соединений; скорость уходит в статистику
+    lease = ARIA.lease(url, info, opts["format"])
+    opts.update(lease.opts())
+    opts["progress_hooks"].append(lease.hook)
+    flow = BW.download.open(job.chat_id if job is not None else None)
+    try:
+        with YoutubeDL(opts) as ydl:
+            # доля полосы чата; yt-dlp перечитывает ratelimit по ходу скачивания
+            flow.on_rate(lambda rate: ydl.params.__setitem__("ratelimit", rate))
+            if merge_watcher is None:
+                # в конвейере файл уже уходит в Telegram во время склейки
+                ydl.add_post_processor(SmartMp4PP(ydl), when="post_process")
+            if info is not None and info_is_fresh(info, format_override):
+                log.info("Скачиваю по info_dict пробы, без повторной экстракции")
+                try:
+                    info = ydl.process_ie_result(copy.deepcopy(info), download=True)
+                except DownloadError as e:
+                    log.warning(
+                        "Скачивание по info_dict не удалось (%s), повторяю extract_info",
+                        e,
+                    )
+                    info = ydl.extract_info(url, download=True)
             else:
-                # попробуем из info
-                if "requested_downloads" in info and info["requested_downloads"]:
-                    out = Path(info["requested_downloads"][0].get("filepath", out_path))
-        sz = out.stat().st_size if out.exists() else 0
-        log.info(
-            "Готов файл: %s (%.2f MB) за %.1f c",
-            out.name,
-            sz / 1024 / 1024,
-            time.time() - t0,
-        )
-        return out
-
-
-def send_video(chat_id: int, path: Path):
-    """Отправка видео через локальный Bot API (как в upload.py, но без прогресса)."""
+                info = ydl.extract_info(url, download=True)
+            out = Path(output.resolve(info))
+            sz = out.stat().st_size
+            log.info(
+                "Готов файл: %s (%.2f MB) за %.1f c",
+                out.name,
+                sz / 1024 / 1024,
+                time.time() - t0,
+            )
+            return out
+    finally:
+        flow.close()
+        lease.release()
+
+
+def send_video(
+    chat_id: int,
+    path: Path,
+    info: Optional[Dict[str, Any]] = None,
+    job: Optional[Job] = None,
+    progress: Optional[Progress] = None,
+):
+    """Отправка видео через локальный Bot API потоковым multipart-аплоадом."""
     log.info("Отправка видео в Telegram: %s", path)
-    w, h, dur = ffprobe_meta(str(path))
-    thumb_path = make_thumbnail(str(path))
+    with timed("ffprobe"):
+        mi = probe_media(str(path))
+    w, h = mi.width, mi.height
+    dur = int(mi.duration) if mi.duration else None
+    with timed("thumbnail"):
+        thumb_path = make_thumbnail(str(path), mi, info)
     thumb_file = None
+    flow = BW.upload.open(chat_id)
+
+    def _on_progress(sent: int, total: int) -> None:
+        if job is not None:
+            job.upload_hook(sent, total)
+        if progress is not None:
+            progress.upload(sent, total)
+
     try:
         with open(path, "rb") as video_file:
             files = {
@@ -353,15 +402,20 @@ def send_video(chat_id: int, path: Path):
                 dur,
                 bool(thumb_path),
             )
-            r = requests.post(
-                f"{BASE_URL}/bot{BOT_TOKEN}/sendVideo",
-                data=data,
-                files=files,
-                timeout=1800,
-            )
+            with timed("upload"):
+                r = UPLOAD_API.upload(
+                    "sendVideo",
+                    data=data,
+                    files=files,
+                    timeout=1800,
+                    label=path.name,
+                    on_progress=_on_progress,
+                    throttle=flow.consume,
+                )
             log.info("Ответ Bot API: %s", r.status_code)
             return r.status_code, r.text
     finally:
+        flow.close()
         if thumb_file is not None:
             try:
                 thumb_file.close()
@@ -377,35 +431,127 @@ def send_video(chat_id: int, path: Path):
                 )
 
 
-def send_message(chat_id: int, text: str):
+def download_and_send_pipelined(
+    chat_id: int,
+    url: str,
+    fmt: str,
+    info: Optional[Dict[str, Any]],
+    job: Optional[Job] = None,
+    progress: Optional[Progress] = None,
+) -> Tuple[Optional[Path], Optional[int], str]:
+    """Скачивание с аплоадом, который стартует вместе со склейкой дорожек.
+
+    Возвращает (путь, код ответа Bot API, тело). Если склейки не было или
+    конвейерный аплоад не удался, код будет не 200 — тогда вызывающий
+    отправляет готовый файл обычным send_video.
+    """
+    watcher = MergeWatcher()
+    result: Dict[str, Any] = {}
+
+    def _download():
+        try:
+            result["path"] = ydl_download(
+                url, fmt, info, merge_watcher=watcher, job=job, progress=progress
+            )
+            watcher.close()
+        except Exception as e:
+            result["error"] = e
+            watcher.close(failed=True)
+
+    t = threading.Thread(target=_download, name="pipe-download", daemon=True)
+    t.start()
+    code, body = None, ""
     try:
-        log.debug("sendMessage → %s", text[:120])
-        requests.post(
-            f"{BASE_URL}/bot{BOT_TOKEN}/sendMessage",
-            data={"chat_id": str(chat_id), "text": text},
-            timeout=30,
-        )
-    except Exception:
-        pass
+        if watcher.wait_started():
+            name = os.path.basename(watcher.final_path)
+            data: Dict[str, Any] = {
+                "chat_id": str(chat_id),
+                "caption": name,
+                "supports_streaming": "true",
+            }
+            data.update(video_meta_from_info(info, fmt))
+
+            flow = BW.upload.open(chat_id)
+
+            def _chunks():
+                sent = 0
+                for chunk in watcher.chunks():
+                    if job is not None:
+                        job.check()
+                    flow.consume(len(chunk))
+                    BYTES.inc(len(chunk), direction="upload")
+                    sent += len(chunk)
+                    if progress is not None:
+                        # размер станет известен только после склейки
+                        progress.upload(sent, 0)
+                    yield chunk
+
+            content_type, stream = multipart_stream(
+                data, "video", name, "video/mp4", _chunks(), label=name
+            )
+            log.info("HTTP POST sendVideo (конвейер) … %s", data)
+            try:
+                with timed("upload"), metrics.api_call("sendVideo") as m:
+                    r = UPLOAD_API.session.post(
+                        UPLOAD_API.url("sendVideo"),
+                        data=stream,
+                        headers={"Content-Type": content_type},
+                        timeout=1800,
+                    )
+                    m["code"] = r.status_code
+                code, body = r.status_code, r.text
+                log.info("Ответ Bot API (конвейер): %s", code)
+            except JobCancelled:
+                raise
+            except Exception as e:
+                log.warning("Конвейерный аплоад не удался: %s", e)
+                # отмена из _chunks могла прийти обёрнутой в ошибку requests
+                if job is not None:
+                    job.check()
+            finally:
+                flow.close()
+    finally:
+        # по отмене скачивание останавливают hook'и задачи
+        t.join()
+    if "error" in result:
+        raise result["error"]
+    return result.get("path"), code, body
 
 
-def get_updates(offset=None, timeout=30):
-    params = {"timeout": timeout}
-    if offset is not None:
-        params["offset"] = offset
-    log.debug("getUpdates(offset=%s, timeout=%s)", offset, timeout)
-    r = requests.get(
-        f"{BASE_URL}/bot{BOT_TOKEN}/getUpdates", params=params, timeout=timeout + 5
+async def send_cached(chat_id: int, file_id: str, kind: str, caption: str = ""):
+    """Повторная отправка уже загруженного в Telegram файла по file_id."""
+    method = {"video": "sendVideo", "animation": "sendAnimation"}.get(
+        kind, "sendDocument"
     )
-    log.debug(
-        "getUpdates ok=%s, items=%s",
-        r.ok,
-        (len(r.json().get("result", [])) if r.ok else "?"),
-    )
-    return r.json()
+    field = {"sendVideo": "video", "sendAnimation": "animation"}.get(method, "document")
+    data = {"chat_id": str(chat_id), field: file_id, "caption": caption}
+    if method == "sendVideo":
+        data["supports_streaming"] = "true"
+    log.info("Отправка по file_id (%s): %s", method, file_id[:24])
+    try:
+        r = await API.call(method, data=data)
+    except Exception as e:
+        log.warning("Ошибка отправки по file_id: %s", e)
+        return None, str(e)
+    return r.status_code, r.text
+
 
+def _remember_delivery(
+    video_key: str, fmt: str, body: str, path: Path
+) -> Optional[Tuple[str, str, str]]:
+    """Запоминает file_id из ответа Bot API; возвращает (file_id, kind, caption)."""
+    try:
+        found = file_id_from_result(json.loads(body).get("result") or {})
+    except Exception:
+        found = None
+    if not found:
+        return None
+    file_id, kind = found
+    DELIVERY_CACHE.put(video_key, fmt, file_id, kind, path.name)
+    return file_id, kind, path.name
 
-def handle_update(upd: dict):
+
+async def handle_update(upd: dict):
     log.debug("handle_update: keys=%s", list(upd.keys()))
     msg = upd.get("message") or upd.get("edited_message")
     if not msg:
@@ -414,24 +560,35 @@ def handle_update(upd: dict):
     text = (msg.get("text") or "").strip()
 
     log.info("Сообщение от %s: %s", chat_id, (text[:200] if text else "<no text>"))
+    if text.split("@", 1)[0] == "/cancel":
+        jobs = JOBS.cancel_chat(chat_id)
+        await API.send_message(
+            chat_id,
+            f"✖️ Отменено задач: {len(jobs)}" if jobs else "Нет активных задач.",
+        )
+        return
     m = URL_RE.search(text)
     if not m:
         log.info("URL не найден в сообщении")
-        send_message(chat_id, "Пришли ссылку на видео (YouTube и др.).")
+        await API.send_message(chat_id, "Пришли ссылку на видео (YouTube и др.).")
         return
 
     url = m.group(0)
     log.info("URL: %s", url)
     # Probe choices and show inline buttons
     try:
-        choices = _probe_mp4_choices(url)
+        async with SCHEDULER.job(chat_id), SCHEDULER.stage("probe"):
+            with timed("probe"):
+                choices, info = await asyncio.to_thread(_probe_mp4_choices, url)
     except Exception as e:
         log.exception("Ошибка при получении качеств")
-        send_message(chat_id, f"Не удалось получить качества: {type(e).__name__}: {e}")
+        await API.send_message(
+            chat_id, f"Не удалось получить качества: {type(e).__name__}: {e}"
+        )
         return
 
     token = uuid.uuid4().hex[:12]
-    PENDING[token] = (url, choices)
+    PENDING.put(token, PendingSession(url, choices, info))
     # Build inline keyboard (max 12 buttons, rows of 3)
     kb_rows: List[List[Dict[str, str]]] = []
     for i, (lbl, _fmt) in enumerate(choices[:12]):
@@ -439,22 +596,11 @@ def handle_update(upd: dict):
             kb_rows.append([])
         kb_rows[-1].append({"text": lbl, "callback_data": f"pick|{token}|{i}"})
     reply_markup = json.dumps({"inline_keyboard": kb_rows}, ensure_ascii=False)
-    try:
-        requests.post(
-            f"{BASE_URL}/bot{BOT_TOKEN}/sendMessage",
-            data={
-                "chat_id": str(chat_id),
-                "text": "Выбери качество:",
-                "reply_markup": reply_markup,
-            },
-            timeout=30,
-        )
+    if await API.send_message(chat_id, "Выбери качество:", reply_markup) is not None:
         log.info("Показаны варианты качества (%d)", len(choices))
-    except Exception:
-        pass
 
 
-def handle_callback(upd: dict):
+async def handle_callback(upd: dict):
     log.debug("handle_callback: data=%s", upd.get("callback_query", {}).get("data"))
     q = upd.get("callback_query")
     if not q:
@@ -462,13 +608,25 @@ def handle_callback(upd: dict):
     data = q.get("data") or ""
     chat_id = q["message"]["chat"]["id"]
     msg_id = q["message"]["message_id"]
+    if data.startswith("cancel|"):
+        job = JOBS.get(data.split("|", 1)[1])
+        if job is None or job.chat_id != chat_id:
+            await API.answer_callback_query(q["id"], "Задача уже завершена")
+            return
+        job.cancel()
+        await API.answer_callback_query(q["id"], "Отменяю…")
+        return
     try:
         action, token, idx_str = data.split("|", 2)
     except ValueError:
         return
-    if action != "pick" or token not in PENDING:
+    if action != "pick":
+        return
+    session = PENDING.pop(token)
+    if session is None:
+        log.info("Сессия %s не найдена или истекла", token)
         return
-    url, choices = PENDING.pop(token)
+    url, choices, info = session.url, session.choices, session.info
     try:
         idx = int(idx_str)
     except Exception:
@@ -478,127 +636,239 @@ def handle_callback(upd: dict):
     label, fmt = choices[idx]
     log.info("Выбрано качество: %s (fmt=%s)", label, fmt)
 
-    # acknowledge button
+    # acknowledge button — сразу, не дожидаясь слота задачи
+    await API.answer_callback_query(q["id"], f"Качество: {label}")
+
+    # уже отправляли этот ролик в этом качестве — шлём по file_id
+    video_key = info_key(info) or canonical_key(url)
+    cached = DELIVERY_CACHE.get(video_key, fmt)
+    if cached:
+        code, body = await send_cached(chat_id, *cached)
+        if code == 200:
+            await API.delete_message(chat_id, msg_id)
+            JOBS_TOTAL.inc(outcome="cached")
+            return
+        log.warning("file_id не сработал (%s): %s", code, (body or "")[:200])
+        if code == 400:
+            DELIVERY_CACHE.invalidate(video_key, fmt)
+
+    job = JOBS.new(chat_id, url)
+    job.message_id = msg_id
+    flight_key = (video_key, fmt)
+    leader, delivered, outcome = False, None, None
     try:
-        requests.post(
-            f"{BASE_URL}/bot{BOT_TOKEN}/answerCallbackQuery",
-            data={"callback_query_id": q["id"], "text": f"Качество: {label}"},
-            timeout=15,
+        # тот же ролик в том же качестве уже качается — ждём и шлём по file_id
+        while True:
+            leader, flight = DOWNLOADS.join(flight_key)
+            if leader:
+                break
+            await API.edit_message_text(
+                chat_id,
+                msg_id,
+                "⏳ Этот ролик уже скачивается по другому запросу, жду…",
+                _cancel_markup(job),
+            )
+            shared = await cancellable(job, asyncio.shield(flight))
+            if shared:
+                code, body = await send_cached(chat_id, *shared)
+                if code == 200:
+                    await API.delete_message(chat_id, msg_id)
+                    outcome = "shared"
+                    return
+                log.warning("file_id лидера не сработал (%s): %s", code, body[:200])
+        await API.edit_message_text(
+            chat_id, msg_id, f"⬇️ Скачиваю {label}…", _cancel_markup(job)
         )
-    except Exception:
-        pass
-    # edit message to show selection
-    try:
-        requests.post(
-            f"{BASE_URL}/bot{BOT_TOKEN}/editMessageText",
-            data={
-                "chat_id": str(chat_id),
-                "message_id": msg_id,
-                "text": f"⬇️ Скачиваю {label}…",
-            },
-            timeout=30,
+        # слот задачи, затем место под дорожки + результат склейки
+        async with SCHEDULER.job(chat_id), DISK.reserve(
+            estimate_bytes(info, fmt),
+            on_wait=lambda: API.edit_message_text(
+                chat_id,
+                msg_id,
+                "💾 Жду свободного места на диске…",
+                _cancel_markup(job),
+            ),
+            check=job.check,
+        ):
+            delivered = await _download_and_deliver(
+                chat_id, msg_id, url, fmt, info, video_key, job, label
+            )
+    except InsufficientSpace as e:
+        log.warning("Нет места на диске для %s: %s", url, e)
+        outcome = "no_space"
+        await API.edit_message_text(
+            chat_id, msg_id, f"💾 Недостаточно места на диске: {e}"
         )
-    except Exception:
-        pass
+    except JobCancelled:
+        await API.edit_message_text(chat_id, msg_id, "✖️ Отменено")
+    finally:
+        if leader:
+            DOWNLOADS.finish(flight_key, delivered)
+        JOBS.finish(job)
+        JOBS_TOTAL.inc(
+            outcome=outcome or ("ok" if delivered else job.reason or "error")
+        )
+        # файл уже отправлен или не нужен: убираем каталог задачи с хвостами
+        await asyncio.to_thread(job.cleanup)
+
+
+def _cancel_markup(job: Job) -> str:
+    return json.dumps(
+        {
+            "inline_keyboard": [
+                [{"text": "✖️ Отмена", "callback_data": f"cancel|{job.id}"}]
+            ]
+        },
+        ensure_ascii=False,
+    )
+
 
-    # download with selected format, then upload
+async def _download_and_deliver(
+    chat_id: int,
+    msg_id: int,
+    url: str,
+    fmt: str,
+    info: Optional[Dict[str, Any]],
+    video_key: str,
+    job: Job,
+    label: str = "",
+) -> Optional[Tuple[str, str, str]]:
+    # download with selected format, then upload;
+    # returns (file_id, kind, caption) of the sent file, if any
+    progress = PROGRESS.track(
+        chat_id, msg_id, f"⬇️ Скачиваю {label}…", _cancel_markup(job)
+    )
     try:
-        log.info("Старт скачивания выбранного качества…")
-        p = ydl_download(url, format_override=fmt)
-        if p and p.exists():
-            try:
-                requests.post(
-                    f"{BASE_URL}/bot{BOT_TOKEN}/editMessageText",
-                    data={
-                        "chat_id": str(chat_id),
-                        "message_id": msg_id,
-                        "text": "📤 Загрузка в Telegram…",
-                    },
-                    timeout=30,
-                )
-            except Exception:
-                pass
-            code = None
-            body = ""
-            try:
-                code, body = send_video(chat_id, p)
-            finally:
+        code = None
+        body = ""
+        try:
+            job.check()  # отменили, пока задача ждала слота
+            log.info("Старт скачивания выбранного качества…")
+            if PIPELINED_UPLOAD and "+" in fmt:
+                # аплоад идёт параллельно со склейкой — держим оба слота
+                async with SCHEDULER.stage("download"), SCHEDULER.stage("upload"):
+                    with timed("pipeline"):
+                        p, code, body = await run_job(
+                            job,
+                            asyncio.to_thread(
+                                download_and_send_pipelined,
+                                chat_id,
+                                url,
+                                fmt,
+                                info,
+                                job,
+                                progress,
+                            ),
+                            DOWNLOAD_TIMEOUT,
+                        )
+            else:
+                async with SCHEDULER.stage("download"):
+                    with timed("download"):
+                        p = await run_job(
+                            job,
+                            asyncio.to_thread(
+                                ydl_download, url, fmt, info, job=job, progress=progress
+                            ),
+                            DOWNLOAD_TIMEOUT,
+                        )
+            downloaded = p is not None and p.exists()
+            if downloaded:
                 try:
-                    if p.exists():
-                        p.unlink()
-                        log.info("Удалил файл после отправки: %s", p)
-                except Exception as cleanup_err:
-                    log.warning("Не удалось удалить файл %s: %s", p, cleanup_err)
+                    if code != 200:
+                        progress.stage(UPLOAD_HEADER)
+                        async with SCHEDULER.stage("upload"):
+                            code, body = await run_job(
+                                job,
+                                asyncio.to_thread(
+                                    send_video, chat_id, p, info, job, progress
+                                ),
+                                None,
+                            )
+                finally:
+                    try:
+                        if p.exists():
+                            p.unlink()
+                            log.info("Удалил файл после отправки: %s", p)
+                    except Exception as cleanup_err:
+                        log.warning("Не удалось удалить файл %s: %s", p, cleanup_err)
+        finally:
+            # дальше сообщение правим сами — прогресс не должен его перезаписать
+            await progress.close()
+        if downloaded:
             if code == 200:
+                delivered = _remember_delivery(video_key, fmt, body, p)
                 # Успех: удаляем служебное сообщение, не пишем «Готово»
-                try:
-                    requests.post(
-                        f"{BASE_URL}/bot{BOT_TOKEN}/deleteMessage",
-                        data={"chat_id": str(chat_id), "message_id": msg_id},
-                        timeout=30,
-                    )
+                if await API.delete_message(chat_id, msg_id) is not None:
                     log.info("Отправка завершена, служебное сообщение удалено")
-                except Exception:
+                else:
                     log.error("Ошибка при удалении служебного сообщения")
+                return delivered
             else:
                 # Ошибка: показываем её в том же сообщении
                 log.error("Ошибка отправки видео: %s %s", code, body[:500])
-                try:
-                    requests.post(
-                        f"{BASE_URL}/bot{BOT_TOKEN}/editMessageText",
-                        data={
-                            "chat_id": str(chat_id),
-                            "message_id": msg_id,
-                            "text": f"❌ Ошибка отправки: {code}\n{body[:500]}",
-                        },
-                        timeout=30,
-                    )
-                except Exception:
-                    log.error("Ошибка при отправке сообщения об ошибке отправки видео")
+                await API.edit_message_text(
+                    chat_id, msg_id, f"❌ Ошибка отправки: {code}\n{body[:500]}"
+                )
         else:
             log.error("Не удалось скачать файл для отправки")
-            requests.post(
-                f"{BASE_URL}/bot{BOT_TOKEN}/sendMessage",
-                data={"chat_id": str(chat_id), "text": "Не удалось скачать файл 😕"},
-                timeout=30,
-            )
+            await API.send_message(chat_id, "Не удалось скачать файл 😕")
+    except JobCancelled as e:
+        log.info("Задача %s остановлена: %s", job.id, e.reason)
+        text = (
+            f"⏱️ Скачивание превысило лимит времени ({DOWNLOAD_TIMEOUT} c)"
+            if e.reason == "timeout"
+            else "✖️ Отменено"
+        )
+        await API.edit_message_text(chat_id, msg_id, text)
     except Exception as e:
         log.exception("Ошибка при скачивании или отправке видео")
-        requests.post(
-            f"{BASE_URL}/bot{BOT_TOKEN}/editMessageText",
-            data={
-                "chat_id": str(chat_id),
-                "message_id": msg_id,
-                "text": f"❌ Ошибка: {type(e).__name__}: {e}",
-            },
-            timeout=30,
+        await API.edit_message_text(
+            chat_id, msg_id, f"❌ Ошибка: {type(e).__name__}: {e}"
         )
 
 
-def main():
+async def _poll():
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix="blocking")
+    )
     log.info("Бот запущен. Жду сообщения…")
+    SCHEDULER.spawn(JANITOR.run_forever(), "janitor")
+    SCHEDULER.spawn(PROGRESS.run_forever(), "progress")
     last_update_id = None
-    while True:
-        try:
-            data = get_updates(
-                offset=(last_update_id + 1) if last_update_id else None, timeout=25
-            )
-            if not data.get("ok"):
-                log.error("getUpdates error: %s", data)
-                time.sleep(2)
-                continue
-            for upd in data.get("result", []):
-                last_update_id = upd["update_id"]
-                if "callback_query" in upd:
-                    handle_callback(upd)
-                else:
-                    handle_update(upd)
-        except KeyboardInterrupt:
-            print("Остановлено пользователем.")
-            break
-        except Exception as e:
-            log.exception("Loop error")
-            time.sleep(2)
+    try:
+        while True:
+            try:
+                data = await API.get_updates(
+                    offset=(last_update_id + 1) if last_update_id else None,
+                    timeout=25,
+                )
+                if not data.get("ok"):
+                    log.error("getUpdates error: %s", data)
+                    await asyncio.sleep(2)
+                    continue
+                for upd in data.get("result", []):
+                    last_update_id = upd["update_id"]
+                    if "callback_query" in upd:
+                        SCHEDULER.spawn(handle_callback(upd), f"cb-{last_update_id}")
+                    else:
+                        SCHEDULER.spawn(handle_update(upd), f"msg-{last_update_id}")
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("Loop error")
+                await asyncio.sleep(2)
+    finally:
+        await SCHEDULER.shutdown()
+        await API.aclose()
+        DELIVERY_CACHE.flush()
+
+
+def main():
+    metrics.start_server()
+    try:
+        asyncio.run(_poll())
+    except KeyboardInterrupt:
+        print("Остановлено пользователем.")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,241 @@
+"""Клиенты локального Bot API с пулом keep-alive соединений.
+
+:class:`AsyncBotAPI` (``httpx.AsyncClient``) — для всех коротких вызовов
+asyncio-цикла bot.py, :class:`BotAPI` (``requests.Session``) — для потоковых
+аплоадов, которые выполняются в потоках executor'а. В обоих TCP/TLS
+рукопожатие (Traefik/HTTPS) делается один раз на соединение пула, а не на
+каждый sendMessage. Ответы 429 повторяются через ``parameters.retry_after``,
+5xx и сетевые ошибки — с экспоненциальной паузой. Длительность каждого
+вызова (со всеми повторами) пишется в ``dlbot_botapi_seconds`` (metrics.py).
+"""
+
+import os
+import time
+import asyncio
+import logging
+from typing import Any, Callable, Dict, Optional, Union
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import api_call
+from streaming_upload import post_multipart
+
+log = logging.getLogger("bot.api")
+
+BOT_API_POOL_SIZE = int(os.getenv("BOT_API_POOL_SIZE", "16"))
+BOT_API_RETRIES = int(os.getenv("BOT_API_RETRIES", "3"))
+_MAX_BACKOFF = 30.0
+
+
+def retry_after(r: Union[requests.Response, httpx.Response]) -> Optional[float]:
+    """Секунды из ``parameters.retry_after`` (или заголовка Retry-After)."""
+    try:
+        params = r.json().get("parameters") or {}
+        if params.get("retry_after") is not None:
+            return float(params["retry_after"])
+    except Exception:
+        pass
+    try:
+        return float(r.headers["Retry-After"])
+    except (KeyError, ValueError):
+        return None
+
+
+class BotAPI:
+    """Потоковые аплоады из потоков executor'а; короткие вызовы — :class:`AsyncBotAPI`."""
+
+    def __init__(
+        self,
+        base_url: str,
+        token: str,
+        pool_size: int = BOT_API_POOL_SIZE,
+        retries: int = BOT_API_RETRIES,
+    ):
+        self.base = f"{base_url}/bot{token}"
+        self.retries = max(0, retries)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def url(self, method: str) -> str:
+        return f"{self.base}/{method}"
+
+    def upload(
+        self,
+        method: str,
+        data: Dict[str, Any],
+        files: Dict[str, tuple],
+        timeout: float = 1800,
+        label: str = "upload",
+        on_progress: Optional[Callable[[int, int], None]] = None,
+        throttle: Optional[Callable[[int], None]] = None,
+    ) -> requests.Response:
+        """Потоковый multipart-аплоад; повторяется только при 429 и обрыве соединения."""
+        with api_call(method) as m:
+            for attempt in range(self.retries + 1):
+                last = attempt == self.retries
+                for f in files.values():
+                    f[1].seek(0)
+                try:
+                    r = post_multipart(
+                        self.url(method),
+                        data=data,
+                        files=files,
+                        timeout=timeout,
+                        label=label,
+                        session=self.session,
+                        on_progress=on_progress,
+                        throttle=throttle,
+                    )
+                except requests.ConnectionError as e:
+                    if last:
+                        raise
+                    log.warning("Аплоад %s оборвался: %s, повторяю", method, e)
+                    time.sleep(2)
+                    continue
+                if r.status_code == 429 and not last:
+                    wait = retry_after(r) or 5
+                    log.warning("Аплоад %s: 429, повтор через %.1f c", method, wait)
+                    time.sleep(wait)
+                    continue
+                m["code"] = r.status_code
+                return r
+            raise RuntimeError("unreachable")
+
+
+class AsyncBotAPI:
+    """Короткие методы Bot API для asyncio-цикла bot.py."""
+
+    def __init__(
+        self,
+        base_url: str,
+        token: str,
+        pool_size: int = BOT_API_POOL_SIZE,
+        retries: int = BOT_API_RETRIES,
+    ):
+        self.base = f"{base_url}/bot{token}"
+        self.retries = max(0, retries)
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=pool_size, max_keepalive_connections=pool_size
+            ),
+            timeout=30,
+        )
+
+    def url(self, method: str) -> str:
+        return f"{self.base}/{method}"
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
+    async def call(
+        self,
+        method: str,
+        data: Optional[Dict[str, Any]] = None,
+        params: Optional[Dict[str, Any]] = None,
+        timeout: float = 30,
+        http_method: str = "POST",
+        retries: Optional[int] = None,
+    ) -> httpx.Response:
+        """Вызов метода с повторами. Сетевая ошибка после всех попыток — исключение.
+
+        ``retries`` переопределяет BOT_API_RETRIES (0 — без повторов, например
+        для правок прогресса, которые устаревают раньше паузы 429).
+        """
+        retries = self.retries if retries is None else max(0, retries)
+        delay = 1.0
+        with api_call(method) as m:
+            for attempt in range(retries + 1):
+                last = attempt == retries
+                try:
+                    r = await self.client.request(
+                        http_method,
+                        self.url(method),
+                        data=data,
+                        params=params,
+                        timeout=timeout,
+                    )
+                except httpx.TransportError as e:
+                    if last:
+                        raise
+                    log.warning("Bot API %s: %r, повтор через %.1f c", method, e, delay)
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, _MAX_BACKOFF)
+                    continue
+                if (r.status_code == 429 or r.status_code >= 500) and not last:
+                    wait = retry_after(r) or delay
+                    log.warning(
+                        "Bot API %s: HTTP %s, повтор через %.1f c",
+                        method,
+                        r.status_code,
+                        wait,
+                    )
+                    await asyncio.sleep(wait)
+                    delay = min(delay * 2, _MAX_BACKOFF)
+                    continue
+                m["code"] = r.status_code
+                return r
+            raise RuntimeError("unreachable")
+
+    async def _safe(self, method: str, data: Dict[str, Any], timeout: float = 30):
+        """Response при успехе, иначе None (ошибка уже в логе)."""
+        try:
+            r = await self.call(method, data=data, timeout=timeout)
+        except Exception as e:
+            log.warning("Bot API %s не удался: %r", method, e)
+            return None
+        if not r.is_success:
+            log.warning("Bot API %s: HTTP %s %s", method, r.status_code, r.text[:300])
+            return None
+        return r
+
+    async def send_message(
+        self, chat_id: int, text: str, reply_markup: Optional[str] = None
+    ):
+        log.debug("sendMessage → %s", text[:120])
+        data: Dict[str, Any] = {"chat_id": str(chat_id), "text": text}
+        if reply_markup:
+            data["reply_markup"] = reply_markup
+        return await self._safe("sendMessage", data)
+
+    async def edit_message_text(
+        self,
+        chat_id: int,
+        message_id: int,
+        text: str,
+        reply_markup: Optional[str] = None,
+    ):
+        data: Dict[str, Any] = {
+            "chat_id": str(chat_id),
+            "message_id": message_id,
+            "text": text,
+        }
+        if reply_markup:
+            data["reply_markup"] = reply_markup
+        return await self._safe("editMessageText", data)
+
+    async def delete_message(self, chat_id: int, message_id: int):
+        return await self._safe(
+            "deleteMessage", {"chat_id": str(chat_id), "message_id": message_id}
+        )
+
+    async def answer_callback_query(self, callback_query_id: str, text: str = ""):
+        data = {"callback_query_id": callback_query_id}
+        if text:
+            data["text"] = text
+        return await self._safe("answerCallbackQuery", data, timeout=15)
+
+    async def get_updates(
+        self, offset: Optional[int] = None, timeout: int = 30
+    ) -> dict:
+        params: Dict[str, Any] = {"timeout": timeout}
+        if offset is not None:
+            params["offset"] = offset
+        log.debug("getUpdates(offset=%s, timeout=%s)", offset, timeout)
+        r = await self.call(
+            "getUpdates", params=params, timeout=timeout + 5, http_method="GET"
+        )
+        return r.json()
@@ -0,0 +1,172 @@
+"""Индекс уже отправленных файлов: (ролик, формат) -> Telegram file_id.
+
+Повторный запрос того же ролика в том же качестве отвечается отправкой по
+file_id (миллисекунды) вместо скачивания и аплоада. Индекс лежит в SQLite,
+записи старше ``DELIVERY_CACHE_TTL`` и сверх ``DELIVERY_CACHE_SIZE`` (LRU по
+последнему использованию) удаляются. Если Telegram не принял file_id, запись
+нужно инвалидировать через :meth:`DeliveryCache.invalidate`.
+
+Попадания (``used``/``hits``) копятся в памяти и пишутся одной транзакцией
+при следующей записи или раз в ``_TOUCH_FLUSH_INTERVAL`` — :meth:`get`
+зовут прямо из event loop, fsync на каждое нажатие кнопки ему ни к чему.
+"""
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+log = logging.getLogger("bot.delivery_cache")
+
+DELIVERY_CACHE = os.getenv("DELIVERY_CACHE", "true").lower() in {"1", "true", "yes"}
+DELIVERY_CACHE_TTL = float(os.getenv("DELIVERY_CACHE_TTL", str(30 * 24 * 3600)))
+DELIVERY_CACHE_SIZE = int(os.getenv("DELIVERY_CACHE_SIZE", "5000"))
+
+# Поля сообщения Bot API, в которых может оказаться отправленный файл
+_MEDIA_KINDS = ("video", "document", "animation", "audio")
+_TOUCH_FLUSH_INTERVAL = 60.0
+
+
+def file_id_from_result(result: Dict[str, Any]) -> Optional[Tuple[str, str]]:
+    """(file_id, kind) из объекта Message ответа sendVideo/sendDocument."""
+    for kind in _MEDIA_KINDS:
+        media = result.get(kind)
+        if isinstance(media, dict) and media.get("file_id"):
+            return media["file_id"], kind
+    return None
+
+
+class DeliveryCache:
+    def __init__(
+        self,
+        db_path: Optional[str],
+        ttl: float = DELIVERY_CACHE_TTL,
+        max_entries: int = DELIVERY_CACHE_SIZE,
+    ):
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        # (video_key, fmt) -> (последнее использование, новых попаданий)
+        self._touched: Dict[Tuple[str, str], Tuple[float, int]] = {}
+        self._flushed = time.monotonic()
+        if not db_path:
+            return
+        try:
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS delivered ("
+                "video_key TEXT, fmt TEXT, file_id TEXT, kind TEXT, caption TEXT, "
+                "size INTEGER, created REAL, used REAL, hits INTEGER DEFAULT 0, "
+                "PRIMARY KEY (video_key, fmt))"
+            )
+            self._db.commit()
+            log.info("Индекс отправленных файлов: %s", db_path)
+        except Exception as e:
+            log.warning("Не удалось открыть индекс file_id %s: %s", db_path, e)
+            self._db = None
+
+    @classmethod
+    def from_env(cls, base_dir: str) -> "DeliveryCache":
+        db_path = (
+            os.path.join(base_dir, ".cache", "delivery.sqlite3")
+            if DELIVERY_CACHE
+            else None
+        )
+        return cls(db_path)
+
+    def get(self, video_key: str, fmt: str) -> Optional[Tuple[str, str, str]]:
+        """(file_id, kind, caption) или None."""
+        if self._db is None:
+            return None
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT file_id, kind, caption, created FROM delivered "
+                "WHERE video_key = ? AND fmt = ?",
+                (video_key, fmt),
+            ).fetchone()
+            if not row:
+                return None
+            file_id, kind, caption, created = row
+            if now - created >= self.ttl:
+                self._delete(video_key, fmt)
+                return None
+            _, hits = self._touched.get((video_key, fmt), (now, 0))
+            self._touched[(video_key, fmt)] = (now, hits + 1)
+            if time.monotonic() - self._flushed >= _TOUCH_FLUSH_INTERVAL:
+                self._flush_touched()
+                self._db.commit()
+            return file_id, kind, caption or ""
+
+    def put(
+        self,
+        video_key: str,
+        fmt: str,
+        file_id: str,
+        kind: str,
+        caption: str = "",
+        size: int = 0,
+    ) -> None:
+        if self._db is None:
+            return
+        now = time.time()
+        with self._lock:
+            try:
+                # used нужен свежим до вытеснения по LRU ниже
+                self._flush_touched()
+                self._db.execute(
+                    "INSERT OR REPLACE INTO delivered "
+                    "(video_key, fmt, file_id, kind, caption, size, created, used) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (video_key, fmt, file_id, kind, caption, size, now, now),
+                )
+                self._db.execute(
+                    "DELETE FROM delivered WHERE created < ? OR rowid NOT IN "
+                    "(SELECT rowid FROM delivered ORDER BY used DESC LIMIT ?)",
+                    (now - self.ttl, self.max_entries),
+                )
+                self._db.commit()
+                log.info("Запомнил file_id для %s [%s]", video_key, fmt)
+            except Exception as e:
+                log.warning("Не удалось сохранить file_id %s: %s", video_key, e)
+
+    def invalidate(self, video_key: str, fmt: str) -> None:
+        if self._db is None:
+            return
+        with self._lock:
+            self._delete(video_key, fmt)
+        log.info("Инвалидирован file_id для %s [%s]", video_key, fmt)
+
+    def flush(self) -> None:
+        """Записывает накопленные попадания (например, при остановке)."""
+        if self._db is None:
+            return
+        with self._lock:
+            try:
+                self._flush_touched()
+                self._db.commit()
+            except Exception as e:
+                log.warning("Не удалось записать попадания file_id: %s", e)
+
+    def _flush_touched(self) -> None:
+        self._flushed = time.monotonic()
+        if not self._touched:
+            return
+        rows = [(used, hits, k, f) for (k, f), (used, hits) in self._touched.items()]
+        self._touched.clear()
+        self._db.executemany(
+            "UPDATE delivered SET used = ?, hits = hits + ? "
+            "WHERE video_key = ? AND fmt = ?",
+            rows,
+        )
+
+    def _delete(self, video_key: str, fmt: str) -> None:
+        self._touched.pop((video_key, fmt), None)
+        self._db.execute(
+            "DELETE FROM delivered WHERE video_key = ? AND fmt = ?", (video_key, fmt)
+        )
+        self._db.commit()
@@ -0,0 +1,175 @@
+"""Индекс форматов info_dict: одна типизированная таблица вместо проходов по
+``info["formats"]`` в каждом месте.
+
+:class:`FormatIndex` один раз разбирает форматы в :class:`Fmt` (высота, fps,
+битрейт, кодеки, размер, ext, протокол) с готовыми ключами сортировки и
+отвечает на вопросы выбора качества:
+
+* :meth:`FormatIndex.videos` — видео (по ext), от лучшего к худшему по
+  (высота, fps, tbr);
+* :meth:`FormatIndex.best_per_height` — лучший формат на каждую высоту;
+* :attr:`FormatIndex.best_audio` и :meth:`FormatIndex.pair` — пара к
+  видео без звука (m4a/aac в приоритете, затем abr): ``"137+140"``;
+* :meth:`FormatIndex.estimate` — размер скачивания для id или селектора.
+
+Сортировка и подписи кнопок больше не разбирают высоту и fps обратно из
+строк. :meth:`FormatIndex.of` кэширует индекс для последних info_dict (по
+объекту), так что проба, резерв места и aria2c используют один и тот же;
+info_dict пробы после этого не меняют (скачивание работает с копией).
+"""
+
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from operator import attrgetter
+from typing import Any, Dict, List, Optional, Tuple
+
+# такой звук склеивается в mp4 без перекодирования
+_AUDIO_EXT_PREF = ("m4a", "mp4", "aac")
+_CACHE_SIZE = 16
+
+
+def _none(codec: Optional[str]) -> bool:
+    return codec in (None, "none")
+
+
+@dataclass(frozen=True)
+class Fmt:
+    id: str
+    ext: str
+    height: int
+    width: int
+    fps: float
+    tbr: float
+    abr: float
+    vcodec: Optional[str]
+    acodec: Optional[str]
+    size: int  # filesize или filesize_approx, 0 — неизвестен
+    protocol: str
+    # ключи сортировки, посчитанные при построении индекса
+    video_key: Tuple[int, float, float]
+    audio_key: Tuple[int, float]
+
+    @classmethod
+    def from_dict(cls, f: Dict[str, Any]) -> "Fmt":
+        ext = (f.get("ext") or "").lower()
+        height = int(f.get("height") or 0)
+        fps = float(f.get("fps") or 0)
+        tbr = float(f.get("tbr") or 0)
+        abr = float(f.get("abr") or 0)
+        return cls(
+            id=str(f.get("format_id")),
+            ext=ext,
+            height=height,
+            width=int(f.get("width") or 0),
+            fps=fps,
+            tbr=tbr,
+            abr=abr,
+            vcodec=f.get("vcodec"),
+            acodec=f.get("acodec"),
+            size=int(f.get("filesize") or f.get("filesize_approx") or 0),
+            protocol=str(f.get("protocol") or ""),
+            video_key=(height, fps, tbr),
+            audio_key=(2 if ext in _AUDIO_EXT_PREF else 1, abr),
+        )
+
+    @property
+    def has_video(self) -> bool:
+        return not _none(self.vcodec)
+
+    @property
+    def has_audio(self) -> bool:
+        return not _none(self.acodec)
+
+    @property
+    def audio_only(self) -> bool:
+        return self.has_audio and not self.has_video
+
+
+class FormatIndex:
+    def __init__(self, info: Optional[Dict[str, Any]]):
+        self.formats: List[Fmt] = [
+            Fmt.from_dict(f) for f in (info or {}).get("formats") or []
+        ]
+        self.by_id: Dict[str, Fmt] = {f.id: f for f in self.formats}
+        # sorted(reverse=True) устойчив: при равных ключах — порядок yt-dlp
+        self.video: List[Fmt] = sorted(
+            (f for f in self.formats if f.has_video),
+            key=attrgetter("video_key"),
+            reverse=True,
+        )
+        self.audio: List[Fmt] = sorted(
+            (f for f in self.formats if f.audio_only),
+            key=attrgetter("audio_key"),
+            reverse=True,
+        )
+        self.best_audio: Optional[Fmt] = self.audio[0] if self.audio else None
+        self.max_video_size = max((f.size for f in self.video), default=0)
+        self.max_audio_size = max((f.size for f in self.audio), default=0)
+
+    @classmethod
+    def of(cls, info: Optional[Dict[str, Any]]) -> "FormatIndex":
+        """Индекс ``info``; для недавно виденного info_dict — из кэша."""
+        if not info:
+            return cls(info)
+        key = id(info)
+        with _lock:
+            hit = _cache.get(key)
+            if hit is not None and hit[0] is info:
+                _cache.move_to_end(key)
+                return hit[1]
+        index = cls(info)
+        with _lock:
+            # держим ссылку на info, чтобы id не достался другому объекту
+            _cache[key] = (info, index)
+            _cache.move_to_end(key)
+            while len(_cache) > _CACHE_SIZE:
+                _cache.popitem(last=False)
+        return index
+
+    def videos(self, ext: Optional[str] = None) -> List[Fmt]:
+        """Видео (со звуком и без), лучшие первыми."""
+        if ext is None:
+            return list(self.video)
+        return [f for f in self.video if f.ext == ext]
+
+    def best_per_height(self, ext: Optional[str] = None) -> List[Fmt]:
+        """По одному формату на высоту (больше fps, затем tbr), высота по убыванию."""
+        out: List[Fmt] = []
+        seen = set()
+        for f in self.videos(ext):
+            if f.height > 0 and f.height not in seen:
+                seen.add(f.height)
+                out.append(f)
+        return out
+
+    def paired(self, v: Fmt) -> bool:
+        """Будет ли к видео добавлен отдельный звук."""
+        return not v.has_audio and self.best_audio is not None
+
+    def pair(self, v: Fmt) -> str:
+        """Строка формата yt-dlp: видео без звука — вместе с лучшим аудио."""
+        if self.paired(v):
+            return f"{v.id}+{self.best_audio.id}"
+        return v.id
+
+    def pair_size(self, v: Fmt) -> int:
+        return v.size + (self.best_audio.size if self.paired(v) else 0)
+
+    def resolve(self, format_str: Optional[str]) -> List[Fmt]:
+        """Форматы первой альтернативы ``format_str``, все id которой известны."""
+        for alt in (format_str or "").split("/"):
+            ids = [i for i in alt.split("+") if i]
+            if ids and all(i in self.by_id for i in ids):
+                return [self.by_id[i] for i in ids]
+        return []
+
+    def estimate(self, format_str: Optional[str]) -> int:
+        """Байт на скачивание: сумма размеров id, для селекторов
+        (``"bv*+ba/best"``) — самое большое видео + самое большое аудио."""
+        size = sum(f.size for f in self.resolve(format_str))
+        return size or self.max_video_size + self.max_audio_size
+
+
+_cache: "OrderedDict[int, Tuple[Dict[str, Any], FormatIndex]]" = OrderedDict()
+_lock = threading.Lock()
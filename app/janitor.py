@@ -0,0 +1,223 @@
+"""Фоновая уборка каталога загрузок и временных миниатюр.
+
+Раз в ``JANITOR_INTERVAL`` секунд :class:`Janitor` обходит свои каталоги и:
+
+* удаляет «осиротевшие» хвосты упавших задач (``.part``, ``.ytdl``,
+  ``.aria2``, ``.temp.*``, фрагменты), которых не трогали дольше
+  ``JANITOR_GRACE`` секунд;
+* удаляет файлы, к которым не обращались дольше ``JANITOR_MAX_AGE``;
+* если каталог всё ещё больше ``JANITOR_MAX_MB``, удаляет самые давно
+  использованные файлы (LRU по ``max(atime, mtime)``), пока не уложится.
+
+Опустевшие каталоги задач (``<root>/<job_id>/``, см. outputs.py) старше
+``JANITOR_GRACE`` тоже удаляются.
+
+Файлы активных задач (``protect(path)`` → True) и недавно изменённые файлы
+не трогаем никогда. Служебные каталоги вроде ``.cache`` (SQLite-кэши) не
+обходим. Счётчики — в :meth:`Janitor.stats`.
+"""
+
+import os
+import re
+import time
+import fnmatch
+import asyncio
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+log = logging.getLogger("bot.janitor")
+
+MB = 1024 * 1024
+JANITOR_INTERVAL = float(os.getenv("JANITOR_INTERVAL", "600"))  # сек, 0 — выключен
+JANITOR_MAX_AGE = float(os.getenv("JANITOR_MAX_AGE", str(6 * 3600)))  # сек
+JANITOR_MAX_BYTES = int(float(os.getenv("JANITOR_MAX_MB", "20480")) * MB)
+JANITOR_GRACE = float(os.getenv("JANITOR_GRACE", "600"))  # сек
+
+# Частичные файлы yt-dlp / aria2c / ffmpeg
+_PARTIAL_RE = re.compile(
+    r"(\.part(-Frag\d+)?|\.ytdl|\.aria2|\.temp\.[^.]+|-Frag\d+(\.part)?)$"
+)
+
+
+@dataclass
+class Root:
+    path: str
+    pattern: str = "*"  # только файлы с таким именем (fnmatch)
+    recursive: bool = True
+
+
+class Janitor:
+    def __init__(
+        self,
+        roots: List[Root],
+        protect: Optional[Callable[[str], bool]] = None,
+        max_age: float = JANITOR_MAX_AGE,
+        max_bytes: int = JANITOR_MAX_BYTES,
+        grace: float = JANITOR_GRACE,
+        interval: float = JANITOR_INTERVAL,
+    ):
+        self.roots = roots
+        self.protect = protect
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.grace = grace
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._stats: Dict[str, float] = {
+            "runs": 0,
+            "last_run": 0.0,
+            "last_duration": 0.0,
+            "files": 0,
+            "bytes": 0,
+            "protected": 0,
+            "removed_files": 0,
+            "removed_bytes": 0,
+            "removed_partial": 0,
+            "removed_age": 0,
+            "removed_lru": 0,
+            "removed_dirs": 0,
+            "errors": 0,
+        }
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._stats)
+
+    def _scan(self, root: Root) -> List[Tuple[str, float, float, int]]:
+        """[(path, last_used, mtime, size)] файлов корня."""
+        out = []
+        if not os.path.isdir(root.path):
+            return out
+        for dirpath, dirnames, filenames in os.walk(root.path):
+            # служебные каталоги (.cache с SQLite и т.п.) не трогаем
+            dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+            for name in filenames:
+                if name.startswith(".") or not fnmatch.fnmatch(name, root.pattern):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path, follow_symlinks=False)
+                except OSError:
+                    continue
+                out.append(
+                    (path, max(st.st_atime, st.st_mtime), st.st_mtime, st.st_size)
+                )
+            if not root.recursive:
+                break
+        return out
+
+    def _remove(self, path: str, size: int, reason: str) -> bool:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            log.warning("Не удалось удалить %s: %s", path, e)
+            with self._lock:
+                self._stats["errors"] += 1
+            return False
+        log.info("Уборка (%s): удалил %s (%.1f MB)", reason, path, size / MB)
+        with self._lock:
+            self._stats["removed_files"] += 1
+            self._stats["removed_bytes"] += size
+            self._stats["removed_" + reason] += 1
+        return True
+
+    def _prune_dirs(self, root: Root, now: float) -> None:
+        """Удаляет пустые подкаталоги задач (снизу вверх, сам корень не трогаем)."""
+        if not root.recursive or not os.path.isdir(root.path):
+            return
+        for dirpath, dirnames, filenames in os.walk(root.path, topdown=False):
+            if dirpath == root.path or filenames or dirnames:
+                continue
+            rel = os.path.relpath(dirpath, root.path)
+            if any(part.startswith(".") for part in rel.split(os.sep)):
+                continue
+            try:
+                if now - os.stat(dirpath).st_mtime < self.grace:
+                    continue
+                if self.protect and self.protect(dirpath):
+                    continue
+                os.rmdir(dirpath)
+            except OSError:
+                continue
+            with self._lock:
+                self._stats["removed_dirs"] += 1
+
+    def sweep(self) -> int:
+        """Один проход уборки (блокирующий). Возвращает число удалённых файлов."""
+        now = time.time()
+        removed = files = total = protected = 0
+        for root in self.roots:
+            keep: List[Tuple[str, float, float, int]] = []
+            locked = n_locked = 0  # файлы, которые удалять нельзя, и их байты
+            for path, used, mtime, size in self._scan(root):
+                if now - mtime < self.grace or (self.protect and self.protect(path)):
+                    protected += 1
+                    n_locked += 1
+                    locked += size
+                    continue
+                if _PARTIAL_RE.search(path):
+                    reason = "partial"
+                elif self.max_age > 0 and now - used > self.max_age:
+                    reason = "age"
+                else:
+                    keep.append((path, used, mtime, size))
+                    continue
+                if self._remove(path, size, reason):
+                    removed += 1
+                else:
+                    n_locked += 1
+                    locked += size
+            # LRU: самые давно использованные — первыми
+            excess = locked + sum(e[3] for e in keep) - self.max_bytes
+            left = []
+            for entry in sorted(keep, key=lambda e: e[1]):
+                path, _used, _mtime, size = entry
+                if (
+                    self.max_bytes > 0
+                    and excess > 0
+                    and self._remove(path, size, "lru")
+                ):
+                    removed += 1
+                    excess -= size
+                else:
+                    left.append(entry)
+            files += n_locked + len(left)
+            total += locked + sum(e[3] for e in left)
+            self._prune_dirs(root, now)
+        with self._lock:
+            self._stats["runs"] += 1
+            self._stats["last_run"] = now
+            self._stats["last_duration"] = time.time() - now
+            self._stats["files"] = files
+            self._stats["bytes"] = total
+            self._stats["protected"] = protected
+        return removed
+
+    async def run_forever(self) -> None:
+        if self.interval <= 0:
+            log.info("Уборка выключена (JANITOR_INTERVAL=0)")
+            return
+        log.info(
+            "Уборка: каждые %.0f c, возраст > %.0f c, лимит %.0f MB: %s",
+            self.interval,
+            self.max_age,
+            self.max_bytes / MB,
+            ", ".join(r.path for r in self.roots),
+        )
+        while True:
+            try:
+                if await asyncio.to_thread(self.sweep):
+                    st = self.stats()
+                    log.info(
+                        "Уборка: осталось %d файлов, %.0f MB (удалено всего %d)",
+                        st["files"],
+                        st["bytes"] / MB,
+                        st["removed_files"],
+                    )
+            except Exception:
+                log.exception("Ошибка уборки")
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,318 @@
+"""Отменяемые задачи скачивания: /cancel, кнопка «Отмена» и жёсткий таймаут.
+
+:class:`Job` — флаг отмены плюс всё, что нужно, чтобы реально остановить
+работу:
+
+* ``job.hook`` / ``job.pp_hook`` — progress/postprocessor hooks yt-dlp;
+  запоминают файлы задачи и бросают :class:`JobCancelled`, как только задача
+  отменена (скачивание в потоке или процессе пула прерывается);
+* :meth:`Job.cancel` убивает дочерние процессы задачи (aria2c, ffmpeg):
+  ищем в ``/proc`` потомков нашего процесса, в командной строке которых есть
+  файлы задачи, — иначе yt-dlp ждёт их завершения;
+* :meth:`Job.cleanup` удаляет каталог задачи (см. outputs.py) или, если его
+  нет, ``.part``, фрагменты, ``.ytdl``/``.aria2`` и прочие файлы задачи.
+
+:func:`run_job` ждёт блокирующую работу с таймаутом и после отмены даёт ей
+``JOB_STOP_GRACE`` секунд на остановку, затем чистит хвосты.
+"""
+
+import os
+import glob
+import time
+import shutil
+import uuid
+import signal
+import asyncio
+import logging
+import threading
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+log = logging.getLogger("bot.jobs")
+
+JOB_STOP_GRACE = float(os.getenv("JOB_STOP_GRACE", "30"))  # сек
+_CHECK_INTERVAL = 0.25  # сек между проверками флага отмены в hooks
+
+
+class JobCancelled(Exception):
+    """Задача отменена пользователем (``cancel``) или по таймауту (``timeout``)."""
+
+    def __init__(self, reason: str = "cancel"):
+        super().__init__(reason)
+        self.reason = reason
+
+
+def _stem(path: str) -> str:
+    """Общий префикс файлов задачи: "Title [id]" из "Title [id].f137.mp4.part"."""
+    name = os.path.basename(path)
+    if "]" in name:
+        return name[: name.rindex("]") + 1]
+    return name.split(".", 1)[0] or name
+
+
+def _proc_children() -> Dict[int, List[int]]:
+    children: Dict[int, List[int]] = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "rb") as f:
+                stat = f.read().decode("utf-8", "replace")
+        except OSError:
+            continue
+        # поле comm в скобках может содержать пробелы — режем по последней ')'
+        fields = stat.rsplit(")", 1)[-1].split()
+        if len(fields) > 1:
+            children.setdefault(int(fields[1]), []).append(int(entry))
+    return children
+
+
+def _cmdline(pid: int) -> str:
+    try:
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            return f.read().replace(b"\0", b" ").decode("utf-8", "replace")
+    except OSError:
+        return ""
+
+
+def kill_matching_children(markers: Set[str], root: Optional[int] = None) -> int:
+    """SIGKILL потомкам ``root`` (по умолчанию — нас), чей argv содержит маркер."""
+    if not markers or not os.path.isdir("/proc"):
+        return 0
+    tree = _proc_children()
+    stack = list(tree.get(root or os.getpid(), []))
+    killed = 0
+    while stack:
+        pid = stack.pop()
+        stack.extend(tree.get(pid, []))
+        cmd = _cmdline(pid)
+        if cmd and any(m in cmd for m in markers):
+            try:
+                os.kill(pid, signal.SIGKILL)
+                killed += 1
+                log.info("Убил процесс %d: %s", pid, cmd[:200])
+            except OSError:
+                pass
+    return killed
+
+
+class Job:
+    def __init__(
+        self,
+        job_id: str,
+        chat_id: Optional[int],
+        label: str = "",
+        cancel_event=None,
+    ):
+        self.id = job_id
+        self.chat_id = chat_id
+        self.label = label
+        self.created = time.time()
+        # threading.Event или Event Manager'а (для пула процессов)
+        self.event = cancel_event or threading.Event()
+        self.reason: Optional[str] = None
+        self.message_id: Optional[int] = None
+        self._dirs: Set[str] = set()
+        self._stems: Set[str] = set()
+        # собственные каталоги задачи (outputs.JobOutput) — всё внутри её
+        self._workdirs: Set[str] = set()
+        self._callbacks: List[Callable[[], Any]] = []
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.reason is not None or self.event.is_set()
+
+    def remember(self, path: Optional[str]) -> None:
+        if not path:
+            return
+        with self._lock:
+            self._dirs.add(os.path.dirname(os.path.abspath(path)))
+            self._stems.add(_stem(path))
+
+    def use_dir(self, path: str) -> None:
+        """Каталог, целиком принадлежащий задаче: он же маркер её процессов."""
+        with self._lock:
+            self._workdirs.add(os.path.abspath(path))
+
+    def owns(self, path: str) -> bool:
+        """Принадлежит ли файл задаче (её каталог или тот же префикс имени)."""
+        path = os.path.abspath(path)
+        d = os.path.dirname(path)
+        name = os.path.basename(path)
+        with self._lock:
+            if any(path == w or path.startswith(w + os.sep) for w in self._workdirs):
+                return True
+            return d in self._dirs and any(name.startswith(s) for s in self._stems)
+
+    def on_cancel(self, fn: Callable[[], Any]) -> None:
+        """Колбэк при отмене (например, ``task.cancel`` аплоада)."""
+        self._callbacks.append(fn)
+
+    def cancel(self, reason: str = "cancel") -> bool:
+        """Помечает задачу отменённой и убивает её дочерние процессы."""
+        if self.reason is not None:
+            return False
+        self.reason = reason
+        self.event.set()
+        log.info("Задача %s (%s) отменена: %s", self.id, self.label, reason)
+        with self._lock:
+            # свой каталог однозначен; имя "Title [id]" совпадёт с чужой задачей
+            # на то же видео, поэтому по нему — только если каталога нет
+            markers = {w + os.sep for w in self._workdirs} or set(self._stems)
+        kill_matching_children(markers)
+        for fn in self._callbacks:
+            try:
+                fn()
+            except Exception:
+                log.debug("Ошибка в колбэке отмены", exc_info=True)
+        return True
+
+    def check(self) -> None:
+        if self.cancelled:
+            raise JobCancelled(self.reason or "cancel")
+
+    def hook(self, d: Dict[str, Any]) -> None:
+        """progress_hook yt-dlp."""
+        self.remember(d.get("filename"))
+        self.remember(d.get("tmpfilename"))
+        now = time.monotonic()
+        if now - self._last_check >= _CHECK_INTERVAL:
+            self._last_check = now
+            self.check()
+
+    def pp_hook(self, d: Dict[str, Any]) -> None:
+        """postprocessor_hook yt-dlp: не даём запустить ffmpeg после отмены."""
+        self.remember((d.get("info_dict") or {}).get("filepath"))
+        self.check()
+
+    def upload_hook(self, sent: int, total: int) -> None:
+        """on_progress потокового аплоада: обрывает отправку после отмены."""
+        now = time.monotonic()
+        if now - self._last_check >= _CHECK_INTERVAL:
+            self._last_check = now
+            self.check()
+
+    def cleanup(self) -> int:
+        """Удаляет все файлы задачи (частичные и итоговые). Возвращает их число."""
+        with self._lock:
+            workdirs = list(self._workdirs)
+            pairs = [
+                (d, s)
+                for d in self._dirs
+                if not any(d == w or d.startswith(w + os.sep) for w in workdirs)
+                for s in self._stems
+            ]
+        removed = 0
+        for w in workdirs:
+            if os.path.isdir(w):
+                removed += sum(len(files) for _, _, files in os.walk(w))
+                shutil.rmtree(w, ignore_errors=True)
+        for d, s in pairs:
+            for path in glob.glob(os.path.join(glob.escape(d), glob.escape(s) + "*")):
+                try:
+                    if os.path.isfile(path):
+                        os.remove(path)
+                        removed += 1
+                except OSError as e:
+                    log.warning("Не удалось удалить %s: %s", path, e)
+        if removed:
+            log.info("Задача %s: удалено хвостов: %d", self.id, removed)
+        return removed
+
+
+class JobRegistry:
+    """Активные задачи по id и по чату."""
+
+    def __init__(self):
+        self._jobs: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+
+    def new(self, chat_id: Optional[int], label: str = "", cancel_event=None) -> Job:
+        # id попадает в callback_data кнопки «Отмена»
+        job = Job(uuid.uuid4().hex[:10], chat_id, label, cancel_event)
+        with self._lock:
+            self._jobs[job.id] = job
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def for_chat(self, chat_id: int) -> List[Job]:
+        with self._lock:
+            return [j for j in self._jobs.values() if j.chat_id == chat_id]
+
+    def active(self) -> List[Job]:
+        with self._lock:
+            return list(self._jobs.values())
+
+    def owns(self, path: str) -> bool:
+        """Файл занят какой-то активной задачей (его нельзя удалять)."""
+        return any(j.owns(path) for j in self.active())
+
+    def finish(self, job: Job) -> None:
+        with self._lock:
+            self._jobs.pop(job.id, None)
+
+    def cancel(self, job_id: str, reason: str = "cancel") -> Optional[Job]:
+        job = self.get(job_id)
+        if job is not None:
+            job.cancel(reason)
+        return job
+
+    def cancel_chat(self, chat_id: int, reason: str = "cancel") -> List[Job]:
+        return [j for j in self.for_chat(chat_id) if j.cancel(reason)]
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+
+async def _drain(job: Job, task: "asyncio.Future[Any]") -> None:
+    try:
+        await asyncio.wait_for(asyncio.shield(task), JOB_STOP_GRACE)
+    except asyncio.TimeoutError:
+        log.warning(
+            "Задача %s не остановилась за %.0f c, бросаю её", job.id, JOB_STOP_GRACE
+        )
+    except BaseException:
+        pass
+
+
+async def cancellable(job: Job, aw: Awaitable[Any]) -> Any:
+    """Ждёт ``aw``; отмена задачи отменяет ожидание (JobCancelled вместо CancelledError)."""
+    task = asyncio.ensure_future(aw)
+    job.on_cancel(task.cancel)
+    try:
+        return await task
+    except asyncio.CancelledError:
+        if job.cancelled:
+            raise JobCancelled(job.reason or "cancel")
+        raise
+
+
+async def run_job(job: Job, work: Awaitable[Any], timeout: Optional[float]) -> Any:
+    """Ждёт ``work`` (обычно to_thread/пул); таймаут и отмена останавливают её.
+
+    При отмене бросает :class:`JobCancelled` — уже после того, как работа
+    остановилась (или истёк ``JOB_STOP_GRACE``) и хвосты удалены.
+    """
+    task = asyncio.ensure_future(work)
+    try:
+        result = await asyncio.wait_for(asyncio.shield(task), timeout)
+    except asyncio.TimeoutError:
+        job.cancel("timeout")
+        await _drain(job, task)
+    except asyncio.CancelledError:
+        job.cancel("cancel")
+        await _drain(job, task)
+        await asyncio.to_thread(job.cleanup)
+        raise
+    except Exception:
+        if not job.cancelled:
+            raise
+    else:
+        if not job.cancelled:
+            return result
+    await asyncio.to_thread(job.cleanup)
+    raise JobCancelled(job.reason or "cancel")
@@ -1,12 +1,14 @@
 import os
 import asyncio
-import pathlib
 import uuid
 import time
 import io
-from typing import Optional, List, Dict, Any
+import functools
+import contextlib
+import contextvars
+from typing import Callable, Iterator, Optional, List, Dict, Any, Tuple
 
-from yt_dlp import YoutubeDL
+import httpx
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile
 from telegram.ext import (
     Application,
@@ -15,11 +17,27 @@ from telegram.ext import (
     ContextTypes,
     filters,
 )
-from telegram.error import NetworkError, TimedOut, RetryAfter
+from telegram.error import BadRequest, NetworkError, TimedOut, RetryAfter
 from telegram.request import HTTPXRequest
 import telegram.ext
 import logging
 
+from admission import DiskAdmission, InsufficientSpace, estimate_bytes
+from bandwidth import Bandwidth, Flow
+from delivery_cache import DeliveryCache
+from formats import FormatIndex
+from janitor import Janitor, Root
+import metrics
+from metrics import BYTES, JOBS_TOTAL, timed
+from jobs import JobCancelled, JobRegistry, cancellable, run_job
+from outputs import JobOutput
+from pending_store import PendingSession, PendingStore
+from probe_cache import ProbeCache, canonical_key, info_is_fresh, info_key
+from progress import UPLOAD_HEADER, ProgressReporter
+from singleflight import AsyncSingleFlight
+from thumbnails import THUMB_DIR
+from workers import YdlPool, download as ydl_download, extract_info as ydl_extract
+
 try:
     from dotenv import load_dotenv
 
@@ -34,9 +52,12 @@ logger = logging.getLogger("bot")
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 COOKIEFILE = os.getenv("COOKIEFILE")  # путь до cookies.txt (формат Netscape)
+PROXY = os.getenv("PROXY")  # один и тот же для пробы и скачивания
 DOWNLOAD_TIMEOUT = int(
     os.getenv("DOWNLOAD_TIMEOUT", "7200")
 )  # сек, общий таймаут скачивания (по умолчанию 2ч)
+PROBE_TIMEOUT = float(os.getenv("PROBE_TIMEOUT", "90"))  # сек на пробу форматов
+MAX_PROBES = max(1, int(os.getenv("MAX_PROBES", "4")))  # одновременных проб
 
 FORCE_DOCUMENT = os.getenv("FORCE_DOCUMENT", "false").lower() in {"1", "true", "yes"}
 TG_READ_TIMEOUT = int(
@@ -56,21 +77,178 @@ os.makedirs(DOWNLOAD_DIR, exist_ok=True)
 
 HELP_TEXT = (
     "Пришли мне ссылку на видео/риелс/тикток/ютуб — я предложу выбрать качество и пришлю файл.\n"
-    "Если файл большой, отправлю как документ."
+    "Если файл большой, отправлю как документ.\n"
+    "/cancel — отменить текущие загрузки."
+)
+
+# token -> PendingSession(url, варианты [(label, format_str)], info_dict пробы);
+# TTL, ограничение памяти и копия на диске — см. pending_store.py
+PENDING = PendingStore.from_env(DOWNLOAD_DIR)
+
+# (ролик, формат) -> file_id уже отправленного файла, см. delivery_cache.py
+DELIVERY_CACHE = DeliveryCache.from_env(DOWNLOAD_DIR)
+
+# Кэш проб (ключ — экстрактор + id ролика), см. probe_cache.py
+PROBE_CACHE = ProbeCache.from_env(DOWNLOAD_DIR)
+
+# Где выполняются проба и скачивание: потоки или тёплые процессы
+# (YDL_EXECUTOR=process, YDL_PROCESSES), см. workers.py
+YDL_POOL = YdlPool()
+
+
+# Резервирование места в DOWNLOAD_DIR под скачивания, см. admission.py
+DISK = DiskAdmission(DOWNLOAD_DIR)
+
+# Лимит полосы с долей на чат, см. bandwidth.py. Доля скачивания доходит до
+# пула через YDL_POOL.shared_value, аплоад ограничивает _track_upload
+BW = Bandwidth()
+
+# Текущий аплоад (поток BW.upload, колбэк прогресса): request-hook httpx
+# ведёт по нему тело запроса (ставится в _deliver, виден в задачах, созданных после)
+_UPLOAD: contextvars.ContextVar[Optional[Tuple[Flow, Callable[[int, int], None]]]] = (
+    contextvars.ContextVar("upload", default=None)
+)
+
+# кусок тела аплоада: шаг лимита полосы и прогресса
+_UPLOAD_SLICE = 256 * 1024
+
+# Активные задачи скачивания: /cancel и кнопка «Отмена», см. jobs.py
+JOBS = JobRegistry()
+
+# Одинаковые (ролик, формат) качаем один раз, остальным — по file_id
+DOWNLOADS = AsyncSingleFlight("Скачивание")
+
+# Фоновая уборка DOWNLOAD_DIR (main.py сам файлы не удаляет), см. janitor.py
+JANITOR = Janitor(
+    [Root(DOWNLOAD_DIR), Root(THUMB_DIR, "thumb-*.jpg", recursive=False)],
+    protect=JOBS.owns,
+)
+
+# Прогресс скачивания в сообщении «Скачиваю…»; правки — через app.bot,
+# который появляется в _post_init, см. progress.py
+PROGRESS = ProgressReporter()
+
+# Состояние компонентов на /metrics (METRICS_PORT), см. metrics.py
+metrics.Gauge("dlbot_jobs_active", "Активные задачи", fn=lambda: {(): len(JOBS)})
+metrics.expose_stats("disk", "Место на диске и резерв, байт", DISK.stats)
+metrics.expose_stats("janitor", "Уборка каталога загрузок", JANITOR.stats)
+metrics.expose_stats("bandwidth", "Лимит полосы и активные передачи", BW.stats)
+metrics.expose_stats(
+    "flights",
+    "Склейка одинаковых проб и скачиваний",
+    lambda: {"probe": PROBE_CACHE.flights.stats(), "download": DOWNLOADS.stats()},
+)
+metrics.expose_stats(
+    "probe_cache",
+    "Кэш проб",
+    lambda: {"hits": PROBE_CACHE.hits, "misses": PROBE_CACHE.misses},
 )
+metrics.expose_stats("progress", "Правки сообщений с прогрессом", PROGRESS.stats)
+
+
+class _UploadStream(httpx.AsyncByteStream):
+    """Тело аплоада кусками по ``_UPLOAD_SLICE``: не быстрее доли ``flow`` и
+    с прогрессом по реально отданным байтам.
+
+    httpx отдаёт файл из InputFile одним куском ``bytes``, поэтому режем его
+    сами; следующий кусок берётся, когда сокет принял предыдущий.
+    """
 
-# Хранилище невысоких рисков: токен -> URL (живёт пока процесс бота жив)
-PENDING_URLS: dict[str, str] = {}
+    def __init__(
+        self,
+        stream,
+        flow: Flow,
+        on_progress: Callable[[int, int], None],
+        total: int,
+    ):
+        self._stream = stream
+        self._flow = flow
+        self._on_progress = on_progress
+        self._total = total
+
+    async def __aiter__(self):
+        sent = 0
+        async for chunk in self._stream:
+            view = memoryview(chunk)
+            for i in range(0, len(view), _UPLOAD_SLICE):
+                piece = view[i : i + _UPLOAD_SLICE]
+                wait = self._flow.reserve(len(piece))
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                yield piece
+                sent += len(piece)
+                self._on_progress(sent, self._total)
+
+    async def aclose(self) -> None:
+        close = getattr(self._stream, "aclose", None)
+        if close is not None:
+            await close()
+
+
+async def _track_upload(request: httpx.Request) -> None:
+    upload = _UPLOAD.get()
+    content_type = request.headers.get("Content-Type", "")
+    if upload is not None and content_type.startswith("multipart/"):
+        flow, on_progress = upload
+        total = int(request.headers.get("Content-Length") or 0)
+        request.stream = _UploadStream(request.stream, flow, on_progress, total)
+
+
+class _TimedRequest(HTTPXRequest):
+    """HTTPXRequest, который пишет длительность вызовов Bot API в метрики,
+    а аплоадам считает прогресс и ограничивает полосу (_track_upload)."""
+
+    def _build_client(self) -> httpx.AsyncClient:
+        client = super()._build_client()
+        client.event_hooks["request"].append(_track_upload)
+        return client
+
+    async def do_request(self, url: str, *args, **kwargs):
+        with metrics.api_call(url.rsplit("/", 1)[-1]) as m:
+            code, payload = await super().do_request(url, *args, **kwargs)
+            m["code"] = code
+            return code, payload
+
+
+# Пробы идут в потоках executor'а, не больше MAX_PROBES одновременно
+PROBE_SEM = asyncio.Semaphore(MAX_PROBES)
+
+
+def _extract(url: str, opts: Dict[str, Any]) -> Dict[str, Any]:
+    return YDL_POOL.call(ydl_extract, url, opts)
+
+
+async def _probe(url: str, job) -> tuple[List[tuple[str, str]], Dict[str, Any]]:
+    """``_probe_quality_options`` вне цикла событий: с таймаутом и отменой.
+
+    Отменённую или зависшую пробу не ждём (результат выбрасывается), но слот
+    PROBE_SEM держится, пока поток реально не закончит.
+    """
+    await cancellable(job, PROBE_SEM.acquire())
+    loop = asyncio.get_running_loop()
+    fut = loop.run_in_executor(None, _probe_quality_options, url, COOKIEFILE)
 
-# token -> list of (label, format_str)
-PENDING_CHOICES: dict[str, List[tuple[str, str]]] = {}
+    def _done(f: asyncio.Future) -> None:
+        PROBE_SEM.release()
+        if not f.cancelled():
+            f.exception()  # у брошенной пробы ошибку уже никто не заберёт
+
+    fut.add_done_callback(_done)
+    try:
+        return await cancellable(
+            job, asyncio.wait_for(asyncio.shield(fut), PROBE_TIMEOUT)
+        )
+    except asyncio.TimeoutError:
+        logger.warning(f"Проба не уложилась в {PROBE_TIMEOUT:.0f} c: {url}")
+        job.cancel("timeout")
+        raise JobCancelled("timeout")
 
 
 def _probe_quality_options(
     url: str, cookiefile: Optional[str] = None
-) -> List[tuple[str, str]]:
-    """Возвращает список вариантов [(label, format_str)], отфильтрованных по mp4, отсортированных по качеству.
-    label — то, что покажем на кнопке, format_str — что передадим в yt-dlp (например, "137+140" или "22").
+) -> tuple[List[tuple[str, str]], Dict[str, Any]]:
+    """Возвращает (варианты, info): список [(label, format_str)], отфильтрованных по mp4, отсортированных по качеству,
+    и info_dict пробы. label — то, что покажем на кнопке, format_str — что передадим в yt-dlp (например, "137+140" или "22").
     """
     probe_opts: Dict[str, Any] = {
         "skip_download": True,
@@ -87,104 +265,85 @@ def _probe_quality_options(
     }
     if cookiefile:
         probe_opts["cookiefile"] = cookiefile
-    with YoutubeDL(probe_opts) as y:
-        info = y.extract_info(url, download=False)
-
-    formats: List[Dict[str, Any]] = info.get("formats", [])
-
-    # best audio (m4a/aac приоритет)
-    audio_candidates = [
-        f
-        for f in formats
-        if (f.get("acodec") not in (None, "none"))
-        and (f.get("vcodec") in (None, "none"))
-    ]
-
-    def audio_score(f: Dict[str, Any]):
-        ext = (f.get("ext") or "").lower()
-        pref = 2 if ext in ("m4a", "mp4", "aac") else 1
-        return (pref, f.get("abr") or 0)
-
-    best_audio = max(audio_candidates, key=audio_score) if audio_candidates else None
-
+    # подписанные ссылки в info_dict привязаны к IP: проба должна идти через
+    # тот же прокси, что и скачивание, иначе info пробы не переиспользовать
+    if PROXY:
+        probe_opts["proxy"] = PROXY
+    info = PROBE_CACHE.extract(url, probe_opts, extractor=_extract)
+
+    # mp4-видео от лучшего: высота, fps, битрейт (ключи — из индекса, не из подписей)
+    index = FormatIndex.of(info)
     options: List[tuple[str, str]] = []
     seen_fmt: set[str] = set()
-
-    for f in formats:
-        # Только mp4-видео
-        if (f.get("ext") or "").lower() != "mp4":
-            continue
-        if f.get("vcodec") in (None, "none"):
-            continue
-        height = f.get("height") or 0
-        fps = f.get("fps")
-        v_id = str(f.get("format_id"))
-        vext = f.get("ext")
-        acodec = f.get("acodec")
-        size = f.get("filesize") or f.get("filesize_approx")
-
-        if acodec and acodec != "none":
-            # прогрессивный поток (видео+аудио в одном)
-            label = f"{height}p{'' if not fps else f'{int(fps)}fps '}mp4"
-            fmt = v_id
-        else:
-            # видео-only mp4 — попробуем объединить с лучшим аудио
-            if best_audio:
-                a_id = str(best_audio.get("format_id"))
-                label = f"{height}p{'' if not fps else f'{int(fps)}fps '}mp4 + m4a"
-                fmt = f"{v_id}+{a_id}"
-            else:
-                label = (
-                    f"{height}p{'' if not fps else f'{int(fps)}fps '}mp4 (video-only)"
-                )
-                fmt = v_id
-
+    for v in index.videos("mp4"):
+        fmt = index.pair(v)
         if fmt in seen_fmt:
             continue
         seen_fmt.add(fmt)
+        label = f"{v.height}p{'' if not v.fps else f'{int(v.fps)}fps '}mp4"
+        if index.paired(v):
+            # видео-only mp4 — вместе с лучшим аудио
+            label += " + m4a"
+        elif not v.has_audio:
+            label += " (video-only)"
         options.append((label, fmt))
 
-    # Сортировка: по высоте (desc), затем по fps (desc)
-    def parse_h(lbl: str) -> int:
-        try:
-            return int(lbl.split("p", 1)[0])
-        except Exception:
-            return 0
-
-    def parse_fps(lbl: str) -> int:
-        try:
-            if "fps" in lbl:
-                return int(lbl.split("p", 1)[1].split("fps", 1)[0].strip())
-        except Exception:
-            pass
-        return 0
-
-    options.sort(key=lambda x: (parse_h(x[0]), parse_fps(x[0])), reverse=True)
-
     # Если ничего не нашли (редко), добавим дефолт
     if not options:
         options.append(("🎥 Best", "bv*+ba/best"))
-    return options
+    return options, info
 
 
 def _progress_hook(d):
+    # вызывается на каждый кусок: только DEBUG и без форматирования впустую,
+    # пользователю прогресс показывает PROGRESS
     if d.get("status") == "downloading":
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
         p = d.get("downloaded_bytes") or 0
         t = d.get("total_bytes") or d.get("total_bytes_estimate") or 0
         spd = d.get("speed") or 0
         eta = d.get("eta")
         pct = (p / t * 100) if t else 0
-        logger.info(
-            f"DL: {pct:5.1f}% of {t/1024/1024/1024:.2f}GiB at {spd/1024/1024:.2f}MiB/s ETA {eta if eta is not None else '-'}"
+        logger.debug(
+            "DL: %5.1f%% of %.2fGiB at %.2fMiB/s ETA %s",
+            pct,
+            t / 1024 / 1024 / 1024,
+            spd / 1024 / 1024,
+            eta if eta is not None else "-",
         )
     elif d.get("status") == "finished":
         logger.info(f"DL finished, postprocessing: {d.get('filename')}")
 
 
+async def _progress_edit(
+    bot, chat_id: int, message_id: int, text: str, reply_markup
+) -> Optional[float]:
+    try:
+        await bot.edit_message_text(
+            text, chat_id=chat_id, message_id=message_id, reply_markup=reply_markup
+        )
+    except RetryAfter as e:
+        return float(e.retry_after)
+    except BadRequest as e:
+        # «message is not modified» или сообщение уже удалено
+        logger.debug(f"Прогресс не обновлён: {e!r}")
+    return None
+
+
 def _download_video(
-    url: str, quality: str = "best", format_override: Optional[str] = None
+    url: str,
+    quality: str = "best",
+    format_override: Optional[str] = None,
+    info: Optional[Dict[str, Any]] = None,
+    job=None,
+    progress=None,
 ) -> str:
-    """Скачивает видео по URL и возвращает путь к локальному файлу (mp4)."""
+    """Скачивает видео по URL и возвращает путь к локальному файлу (mp4).
+    Если есть свежий info_dict пробы — качает по нему без повторной экстракции.
+    ``job`` (jobs.Job) — отмена: hooks прерывают скачивание по его флагу.
+    ``progress`` (progress.Progress) — прогресс в сообщении чата.
+    """
     logger.info(f"Начало скачивания: url={url}, quality={quality}")
     quality_map = {
         "best": "bv*+ba/best",
@@ -200,7 +359,11 @@ def _download_video(
     )
     audio_only = (quality == "audio") and (format_override is None)
 
-    outtmpl = os.path.join(DOWNLOAD_DIR, "%(title).80s [%(id)s].%(ext)s")
+    # у каждой задачи свой подкаталог: одинаковые названия не пересекаются
+    output = JobOutput(DOWNLOAD_DIR, job.id if job is not None else None)
+    if job is not None:
+        job.use_dir(output.dir)
+    outtmpl = output.template()
 
     ydl_opts = {
         # Сначала пробуем лучшее видео+аудио, иначе просто best
@@ -236,53 +399,55 @@ def _download_video(
             if audio_only
             else [{"key": "FFmpegVideoRemuxer", "preferedformat": "mp4"}]
         ),
-        "progress_hooks": [_progress_hook],
     }
 
     # Если задан путь к cookies.txt (формат Netscape), используем его
     if COOKIEFILE:
         ydl_opts["cookiefile"] = COOKIEFILE
 
-    proxy = os.getenv("PROXY")
-    if proxy:
-        ydl_opts["proxy"] = proxy
-
-    with YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=True)
-        logger.info(f"Завершено скачивание: {info.get('title')}")
-        # Определяем итоговый путь файла
-        final_path = None
-        # Новый способ (yt-dlp >= 2023): requested_downloads[0]['filepath']
-        rds = info.get("requested_downloads")
-        if rds and isinstance(rds, list) and rds and isinstance(rds[0], dict):
-            final_path = rds[0].get("filepath") or rds[0].get("_filename")
-        # Старые поля на случай другой версии
-        if not final_path:
-            final_path = info.get("filepath") or info.get("_filename")
-        # Если всё ещё не нашли — попробуем по шаблону из prepare_filename
-        if not final_path:
-            try:
-                final_path = ydl.prepare_filename(info)
-            except Exception:
-                pass
-        if not final_path:
-            raise RuntimeError("Не удалось определить путь скачанного файла")
-        # Если ремукс в mp4 — возможно расширение изменилось. Попробуем заменить на .mp4 при наличии такого файла.
-        if final_path and final_path.endswith((".mkv", ".webm", ".m4a", ".mp3")):
-            alt = os.path.splitext(final_path)[0] + ".mp4"
-            if os.path.exists(alt):
-                final_path = alt
-        if not os.path.exists(final_path):
-            # как запасной вариант посмотреть в каталоге скачивания файл с таким же base без учёта регистра
-            base = os.path.splitext(os.path.basename(final_path))[0].lower()
-            for p in pathlib.Path(DOWNLOAD_DIR).iterdir():
-                if p.is_file() and os.path.splitext(p.name)[0].lower() == base:
-                    final_path = str(p)
-                    break
-        if not os.path.exists(final_path):
-            raise RuntimeError("Скачивание завершилось, но файл не найден в download/")
-        logger.info(f"Файл сохранён: {final_path}")
-        return final_path
+    if PROXY:
+        ydl_opts["proxy"] = PROXY
+
+    if info is not None and info_is_fresh(info, selected_format):
+        logger.info("Скачивание по info_dict пробы, без повторной экстракции")
+    else:
+        info = None
+
+    def _on_progress(d):
+        if job is not None:
+            job.hook(d)
+        metrics.download_hook(d)
+        if d.get("status") == "postprocessed":
+            metrics.observe_pp(d.get("postprocessor"), d.get("elapsed") or 0)
+        if progress is not None:
+            if d.get("postprocessor"):
+                progress.pp_hook(d)
+            else:
+                progress.hook(d)
+        _progress_hook(d)
+
+    # сама загрузка и постобработка — в потоке или процессе пула (workers.py)
+    chat_id = job.chat_id if job is not None else None
+    ratelimit = YDL_POOL.shared_value()
+    with BW.download.open(chat_id) as flow, timed("download"):
+        # доля пересчитывается, когда другие передачи открываются и закрываются
+        flow.on_rate(lambda rate: setattr(ratelimit, "value", rate or 0))
+        ydl_opts["ratelimit"] = flow.ratelimit
+        res = YDL_POOL.call(
+            ydl_download,
+            url,
+            ydl_opts,
+            info,
+            ratelimit,
+            on_progress=_on_progress,
+            cancel=job.event if job is not None else None,
+        )
+    logger.info(f"Завершено скачивание: {res.get('title')}")
+    # итоговый путь приходит из post_hooks (после MoveFiles) — без угадывания
+    output.final_path = res.get("final_path")
+    final_path = output.resolve(res)
+    logger.info(f"Файл сохранён: {final_path}")
+    return final_path
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -301,11 +466,29 @@ async def handle_link(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 
     # Покажем кнопки выбора качества
     token = uuid.uuid4().hex[:12]
-    PENDING_URLS[token] = url
     logger.info(f"Получена ссылка: {url}, token={token}")
-    # Построим список доступных mp4-качейств для выбора
-    choices = _probe_quality_options(url, COOKIEFILE)
-    PENDING_CHOICES[token] = choices
+    # Сразу отвечаем, а список mp4-качеств строим в фоне
+    job = JOBS.new(update.effective_chat.id, label=f"probe {url}")
+    status = await update.message.reply_text(
+        "🔎 Получаю список форматов…", reply_markup=_cancel_markup(job)
+    )
+    try:
+        with timed("probe"):
+            choices, info = await _probe(url, job)
+    except JobCancelled as e:
+        await status.edit_text(
+            "⏱️ Источник слишком долго не отвечает, попробуй ещё раз."
+            if e.reason == "timeout"
+            else "✖️ Отменено"
+        )
+        return
+    except Exception as e:
+        logger.error(f"Ошибка пробы {url}: {e!r}")
+        await status.edit_text(f"❌ Не удалось получить форматы: {e}")
+        return
+    finally:
+        JOBS.finish(job)
+    PENDING.put(token, PendingSession(url, choices, info))
     # Ограничим количество кнопок (например, до 12) и разложим по рядам по 3
     max_buttons = min(12, len(choices))
     rows: List[List[InlineKeyboardButton]] = []
@@ -321,14 +504,19 @@ async def handle_link(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     rows.append(
         [InlineKeyboardButton("🎧 Audio (mp3)", callback_data=f"pick|{token}|audio")]
     )
-    await update.message.reply_text(
+    await status.edit_text(
         "Выбери качество загрузки:", reply_markup=InlineKeyboardMarkup(rows)
     )
     return
 
 
 class ProgressFile(io.BufferedReader):
-    def __init__(self, raw: io.BufferedReader, total_bytes: int, label: str = "upload"):
+    def __init__(
+        self,
+        raw: io.BufferedReader,
+        total_bytes: int,
+        label: str = "upload",
+    ):
         super().__init__(raw)
         self._raw = raw
         self.total = total_bytes
@@ -348,7 +536,7 @@ class ProgressFile(io.BufferedReader):
             ) >= PROGRESS_INTERVAL or self.read_so_far >= self.total:
                 pct = (self.read_so_far / self.total * 100) if self.total else 0
                 speed = self.read_so_far / max(1e-6, now - self.start)
-                logger.info(
+                logger.debug(
                     f"UP: {pct:5.1f}% of {self.total/1024/1024:.2f}MiB at {speed/1024/1024:.2f}MiB/s ({self.label})"
                 )
                 self.last_log = now
@@ -369,6 +557,25 @@ class ProgressFile(io.BufferedReader):
         return True
 
 
+@contextlib.contextmanager
+def _upload_flow(
+    chat_id: Optional[int], on_progress: Callable[[int, int], None]
+) -> Iterator[Flow]:
+    """Поток BW.upload и прогресс на время аплоада (см. _track_upload)."""
+    with BW.upload.open(chat_id) as flow:
+        token = _UPLOAD.set((flow, on_progress))
+        try:
+            yield flow
+        finally:
+            _UPLOAD.reset(token)
+
+
+def _input_file(filepath: str, size: int, filename: str) -> InputFile:
+    """InputFile читает файл целиком — зовём в потоке, не в цикле событий."""
+    with open(filepath, "rb") as base_f:
+        return InputFile(ProgressFile(base_f, size, label=filename), filename=filename)
+
+
 async def _send_with_retries(send_coro_factory, attempts: int = 3):
     delay = 3
     for i in range(attempts):
@@ -383,6 +590,53 @@ async def _send_with_retries(send_coro_factory, attempts: int = 3):
             delay *= 2
 
 
+def _cancel_markup(job) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        [[InlineKeyboardButton("✖️ Отмена", callback_data=f"cancel|{job.id}")]]
+    )
+
+
+async def cancel_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    jobs = JOBS.cancel_chat(update.effective_chat.id)
+    if jobs:
+        await update.message.reply_text(f"✖️ Отменено задач: {len(jobs)}")
+    else:
+        await update.message.reply_text("Нет активных задач.")
+
+
+async def on_cancel_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    q = update.callback_query
+    _, job_id = q.data.split("|", 1)
+    job = JOBS.get(job_id)
+    if job is None or job.chat_id != q.message.chat.id:
+        await q.answer("Задача уже завершена")
+        return
+    job.cancel()
+    await q.answer("Отменяю…")
+
+
+async def _send_cached(message, file_id: str, kind: str, caption: str):
+    if kind == "video":
+        return await message.reply_video(video=file_id, caption=caption)
+    if kind == "audio":
+        return await message.reply_audio(audio=file_id, caption=caption)
+    return await message.reply_document(document=file_id, caption=caption)
+
+
+def _remember_delivery(
+    video_key: str, fmt_key: str, msg, caption: str, size: int
+) -> Optional[Tuple[str, str, str]]:
+    """Запоминает file_id отправленного файла; возвращает (file_id, kind, caption)."""
+    if msg is None:
+        return None
+    for kind in ("video", "document", "audio"):
+        media = getattr(msg, kind, None)
+        if media is not None:
+            DELIVERY_CACHE.put(video_key, fmt_key, media.file_id, kind, caption, size)
+            return media.file_id, kind, caption
+    return None
+
+
 async def on_quality_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not update.callback_query or not update.callback_query.data:
         return
@@ -392,10 +646,11 @@ async def on_quality_choice(update: Update, context: ContextTypes.DEFAULT_TYPE)
     except ValueError:
         await q.answer("Некорректные данные", show_alert=True)
         return
-    if action != "pick" or (token not in PENDING_URLS):
+    session = PENDING.pop(token) if action == "pick" else None
+    if session is None:
         await q.answer("Сессия не найдена", show_alert=True)
         return
-    url = PENDING_URLS.pop(token)
+    url, info = session.url, session.info
     fmt_override: Optional[str] = None
     quality = "best"
     if third == "best":
@@ -403,13 +658,13 @@ async def on_quality_choice(update: Update, context: ContextTypes.DEFAULT_TYPE)
     elif third == "audio":
         quality = "audio"
     else:
-        # индекс варианта из PENDING_CHOICES
+        # индекс варианта из session.choices
         try:
             idx = int(third)
         except Exception:
             await q.answer("Некорректный выбор", show_alert=True)
             return
-        choices = PENDING_CHOICES.pop(token, [])
+        choices = session.choices
         if not choices or idx < 0 or idx >= len(choices):
             await q.answer("Вариант устарел", show_alert=True)
             return
@@ -417,66 +672,175 @@ async def on_quality_choice(update: Update, context: ContextTypes.DEFAULT_TYPE)
         quality = "custom"
     logger.info(f"Выбор качества: {quality} для url={url}")
     await q.answer()
-    status = await q.message.reply_text("⬇️ Скачиваю…")
+    job = JOBS.new(q.message.chat.id, url, cancel_event=YDL_POOL.cancel_event())
+    status = await q.message.reply_text(
+        "⬇️ Скачиваю…", reply_markup=_cancel_markup(job)
+    )
+    # Уже отправляли этот ролик в этом качестве — переотправим по file_id
+    video_key = info_key(info) if info else canonical_key(url)
+    fmt_key = fmt_override or quality
+    flight_key = (video_key, fmt_key)
+    leader, delivered, outcome = False, None, None
     try:
-        try:
-            filepath = await asyncio.wait_for(
-                asyncio.to_thread(_download_video, url, quality, fmt_override),
-                timeout=DOWNLOAD_TIMEOUT,
+        # тот же ролик в том же качестве уже качается — ждём и шлём по file_id
+        while True:
+            leader, flight = DOWNLOADS.join(flight_key)
+            if leader:
+                break
+            await status.edit_text(
+                "⏳ Этот ролик уже скачивается по другому запросу, жду…",
+                reply_markup=_cancel_markup(job),
             )
-        except asyncio.TimeoutError:
-            raise RuntimeError(
-                "Скачивание превысило лимит времени. Увеличь DOWNLOAD_TIMEOUT или выбери другое качество."
-            )
-        filename = os.path.basename(filepath)
-        size = os.path.getsize(filepath)
-        logger.info(
-            f"Начало отправки файла: {filename}, size={size} байт, quality={quality}"
+            shared = await cancellable(job, asyncio.shield(flight))
+            if shared:
+                try:
+                    await _send_cached(q.message, *shared)
+                    await status.delete()
+                    logger.info(f"Отправлено по file_id лидера: {flight_key}")
+                    outcome = "shared"
+                    return
+                except (BadRequest, TimedOut, NetworkError) as e:
+                    logger.warning(f"Не удалось отправить по file_id лидера: {e!r}")
+            await status.edit_text("⬇️ Скачиваю…", reply_markup=_cancel_markup(job))
+        delivered = await _deliver(
+            q, status, job, url, quality, fmt_override, info, video_key, fmt_key
+        )
+    except JobCancelled:
+        await status.edit_text("✖️ Отменено")
+    finally:
+        if leader:
+            DOWNLOADS.finish(flight_key, delivered)
+        JOBS.finish(job)
+        JOBS_TOTAL.inc(
+            outcome=outcome or ("ok" if delivered else job.reason or "error")
         )
 
-        async def _send():
-            if quality == "audio" or FORCE_DOCUMENT or size > 48 * 1024 * 1024:
-                with open(filepath, "rb") as base_f:
-                    pf = ProgressFile(base_f, size, label=filename)
-                    msg = await q.message.reply_document(
-                        document=InputFile(pf, filename=filename),
-                        caption=filename,
-                        read_timeout=TG_READ_TIMEOUT,
-                        write_timeout=TG_WRITE_TIMEOUT,
-                    )
-                    logger.info(f"Отправлено (document): message_id={msg.message_id}")
-                    return msg
-            else:
-                with open(filepath, "rb") as base_f:
-                    pf = ProgressFile(base_f, size, label=filename)
-                    msg = await q.message.reply_video(
-                        video=InputFile(pf, filename=filename),
-                        caption=filename,
-                        read_timeout=TG_READ_TIMEOUT,
-                        write_timeout=TG_WRITE_TIMEOUT,
-                    )
-                    logger.info(f"Отправлено (video): message_id={msg.message_id}")
-                    return msg
 
+async def _deliver(
+    q,
+    status,
+    job,
+    url: str,
+    quality: str,
+    fmt_override: Optional[str],
+    info: Optional[Dict[str, Any]],
+    video_key: str,
+    fmt_key: str,
+) -> Optional[Tuple[str, str, str]]:
+    """Отправка по file_id или скачивание + аплоад; отменяется через ``job``.
+
+    Возвращает (file_id, kind, caption) отправленного файла или None.
+    """
+    cached = DELIVERY_CACHE.get(video_key, fmt_key)
+    if cached:
         try:
-            await _send_with_retries(_send)
-            logger.info("Первичная отправка прошла успешно (получен ответ Telegram)")
-        except (TimedOut, NetworkError, Exception) as e:
-            logger.warning(f"Повторная отправка после ошибки: {e!r}")
-            # Последняя попытка принудительно документом
-            with open(filepath, "rb") as base_f:
-                pf = ProgressFile(base_f, size, label=filename)
-                msg = await q.message.reply_document(
-                    document=InputFile(pf, filename=filename),
-                    caption=filename,
-                    read_timeout=TG_READ_TIMEOUT,
-                    write_timeout=TG_WRITE_TIMEOUT,
+            await _send_cached(q.message, *cached)
+            await status.delete()
+            logger.info(f"Отправлено по file_id: {video_key} [{fmt_key}]")
+            return cached
+        except BadRequest as e:
+            logger.warning(f"file_id отклонён Telegram: {e!r}")
+            DELIVERY_CACHE.invalidate(video_key, fmt_key)
+        except (TimedOut, NetworkError) as e:
+            logger.warning(f"Не удалось отправить по file_id: {e!r}")
+    try:
+        # место под дорожки + результат склейки/ремукса, см. admission.py
+        async with DISK.reserve(
+            estimate_bytes(info, fmt_override),
+            on_wait=lambda: status.edit_text(
+                "💾 Жду свободного места на диске…", reply_markup=_cancel_markup(job)
+            ),
+            check=job.check,
+        ), PROGRESS.track(
+            status.chat_id, status.message_id, "⬇️ Скачиваю…", _cancel_markup(job)
+        ) as progress:
+            try:
+                # по таймауту задача останавливается (дети убиты, хвосты удалены)
+                filepath = await run_job(
+                    job,
+                    asyncio.to_thread(
+                        _download_video, url, quality, fmt_override, info, job, progress
+                    ),
+                    DOWNLOAD_TIMEOUT,
                 )
-                logger.info(
-                    f"Отправлено после фоллбека (document): message_id={msg.message_id}"
+            except JobCancelled as e:
+                if e.reason != "timeout":
+                    raise
+                raise RuntimeError(
+                    "Скачивание превысило лимит времени. Увеличь DOWNLOAD_TIMEOUT или выбери другое качество."
                 )
-        await status.delete()
-        logger.info("Сообщение отправлено успешно.")
+            filename = os.path.basename(filepath)
+            size = os.path.getsize(filepath)
+            logger.info(
+                f"Начало отправки файла: {filename}, size={size} байт, quality={quality}"
+            )
+            with _upload_flow(job.chat_id, progress.upload):
+                progress.stage(UPLOAD_HEADER)
+
+                async def _send():
+                    media = await asyncio.to_thread(
+                        _input_file, filepath, size, filename
+                    )
+                    if quality == "audio" or FORCE_DOCUMENT or size > 48 * 1024 * 1024:
+                        msg = await q.message.reply_document(
+                            document=media,
+                            caption=filename,
+                            read_timeout=TG_READ_TIMEOUT,
+                            write_timeout=TG_WRITE_TIMEOUT,
+                        )
+                        logger.info(
+                            f"Отправлено (document): message_id={msg.message_id}"
+                        )
+                        return msg
+                    else:
+                        msg = await q.message.reply_video(
+                            video=media,
+                            caption=filename,
+                            read_timeout=TG_READ_TIMEOUT,
+                            write_timeout=TG_WRITE_TIMEOUT,
+                        )
+                        logger.info(f"Отправлено (video): message_id={msg.message_id}")
+                        return msg
+
+                try:
+                    with timed("upload"):
+                        msg = await cancellable(job, _send_with_retries(_send))
+                    logger.info(
+                        "Первичная отправка прошла успешно (получен ответ Telegram)"
+                    )
+                except JobCancelled:
+                    raise
+                except (TimedOut, NetworkError, Exception) as e:
+                    logger.warning(f"Повторная отправка после ошибки: {e!r}")
+                    # Последняя попытка принудительно документом
+                    media = await asyncio.to_thread(
+                        _input_file, filepath, size, filename
+                    )
+                    with timed("upload"):
+                        msg = await cancellable(
+                            job,
+                            q.message.reply_document(
+                                document=media,
+                                caption=filename,
+                                read_timeout=TG_READ_TIMEOUT,
+                                write_timeout=TG_WRITE_TIMEOUT,
+                            ),
+                        )
+                    logger.info(
+                        f"Отправлено после фоллбека (document): message_id={msg.message_id}"
+                    )
+            BYTES.inc(size, direction="upload")
+            delivered = _remember_delivery(video_key, fmt_key, msg, filename, size)
+            await status.delete()
+            logger.info("Сообщение отправлено успешно.")
+            return delivered
+    except InsufficientSpace as e:
+        logger.warning(f"Нет места на диске для {url}: {e}")
+        await status.edit_text(f"💾 Недостаточно места на диске: {e}")
+    except JobCancelled:
+        logger.info(f"Задача {job.id} отменена: {url}")
+        await asyncio.to_thread(job.cleanup)
+        await status.edit_text("✖️ Отменено")
     except Exception as e:
         msg = str(e)
         logger.error(f"Ошибка при обработке: {msg}", exc_info=True)
@@ -500,28 +864,54 @@ async def on_quality_choice(update: Update, context: ContextTypes.DEFAULT_TYPE)
         pass
 
 
+async def _post_init(app: Application) -> None:
+    app.create_task(JANITOR.run_forever())
+    app.create_task(PROGRESS.run_forever(functools.partial(_progress_edit, app.bot)))
+
+
 def main() -> None:
     if not BOT_TOKEN:
         raise RuntimeError("Установи BOT_TOKEN в переменных окружения или .env")
 
-    request = HTTPXRequest(
+    request = _TimedRequest(
         connect_timeout=60,
         read_timeout=TG_READ_TIMEOUT,
         write_timeout=TG_WRITE_TIMEOUT,
     )
     logger.info("Используется HTTPXRequest backend")
-    app = Application.builder().token(BOT_TOKEN).request(request).build()
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .request(request)
+        .post_init(_post_init)
+        .build()
+    )
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", help_cmd))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_link))
+    app.add_handler(CommandHandler("cancel", cancel_cmd))
+    # долгие обработчики не блокируют очередь апдейтов (/cancel, новые ссылки)
     app.add_handler(
-        telegram.ext.CallbackQueryHandler(on_quality_choice, pattern=r"^pick\|")
+        MessageHandler(filters.TEXT & ~filters.COMMAND, handle_link, block=False)
+    )
+    app.add_handler(
+        telegram.ext.CallbackQueryHandler(
+            on_quality_choice, pattern=r"^pick\|", block=False
+        )
+    )
+    app.add_handler(
+        telegram.ext.CallbackQueryHandler(on_cancel_button, pattern=r"^cancel\|")
     )
 
     logger.info("Бот запущен. Ожидание сообщений...")
     print("Bot is running… Press Ctrl+C to stop.")
-    app.run_polling()
+    YDL_POOL.start()
+    metrics.start_server()
+    try:
+        app.run_polling()
+    finally:
+        YDL_POOL.shutdown()
+        DELIVERY_CACHE.flush()
 
 
 if __name__ == "__main__":
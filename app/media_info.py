@@ -0,0 +1,118 @@
+"""Один ffprobe на файл: размеры, длительность, кодеки и ключевые кадры.
+
+``probe(path)`` запускает ffprobe с ``-of json`` один раз и кэширует результат
+по (путь, mtime, размер), так что постобработка, аплоад и миниатюра читают
+одни и те же данные без лишних процессов. Ключевые кадры берём из пакетов
+первых ``KEYFRAME_SCAN_SECONDS`` секунд (без декодирования).
+"""
+
+import os
+import json
+import logging
+import threading
+import subprocess
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+log = logging.getLogger("bot.media_info")
+
+KEYFRAME_SCAN_SECONDS = 30
+_CACHE_SIZE = 64
+
+
+@dataclass
+class MediaInfo:
+    width: Optional[int] = None
+    height: Optional[int] = None
+    duration: Optional[float] = None
+    format_name: str = ""
+    vcodec: Optional[str] = None
+    acodec: Optional[str] = None
+    # pts (сек) ключевых кадров первой видеодорожки в начале файла
+    keyframes: List[float] = field(default_factory=list)
+
+    def keyframe_near(self, t: float) -> float:
+        """Ближайший к ``t`` ключевой кадр (или ``t``, если их не знаем)."""
+        if not self.keyframes:
+            return t
+        return min(self.keyframes, key=lambda k: abs(k - t))
+
+
+_cache: "OrderedDict[Tuple[str, int, int], MediaInfo]" = OrderedDict()
+_lock = threading.Lock()
+
+
+def _num(v: Any, cast=float):
+    try:
+        return cast(float(v))
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse(data: Dict[str, Any]) -> MediaInfo:
+    mi = MediaInfo(format_name=(data.get("format") or {}).get("format_name", ""))
+    v_index = None
+    for st in data.get("streams") or []:
+        kind = st.get("codec_type")
+        if kind == "video" and mi.vcodec is None:
+            # обложки (attached_pic) — не видео
+            if (st.get("disposition") or {}).get("attached_pic"):
+                continue
+            mi.vcodec = st.get("codec_name")
+            mi.width = _num(st.get("width"), int)
+            mi.height = _num(st.get("height"), int)
+            v_index = st.get("index")
+            mi.duration = _num(st.get("duration"))
+        elif kind == "audio" and mi.acodec is None:
+            mi.acodec = st.get("codec_name")
+    fmt_duration = _num((data.get("format") or {}).get("duration"))
+    if fmt_duration:
+        mi.duration = fmt_duration
+    for pkt in data.get("packets") or []:
+        if pkt.get("stream_index") == v_index and "K" in (pkt.get("flags") or ""):
+            pts = _num(pkt.get("pts_time"))
+            if pts is not None:
+                mi.keyframes.append(pts)
+    return mi
+
+
+def probe(path: str) -> MediaInfo:
+    """MediaInfo файла; при ошибке ffprobe — пустой MediaInfo (все поля None)."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return MediaInfo()
+    key = (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+    with _lock:
+        mi = _cache.get(key)
+        if mi is not None:
+            _cache.move_to_end(key)
+            return mi
+    try:
+        out = subprocess.check_output(
+            [
+                "ffprobe",
+                "-v",
+                "error",
+                "-show_format",
+                "-show_streams",
+                "-show_entries",
+                "packet=stream_index,pts_time,flags",
+                "-read_intervals",
+                f"%+{KEYFRAME_SCAN_SECONDS}",
+                "-of",
+                "json",
+                path,
+            ],
+            stderr=subprocess.DEVNULL,
+        )
+        mi = _parse(json.loads(out or b"{}"))
+    except Exception as e:
+        log.warning("ffprobe не смог прочитать %s: %s", path, e)
+        return MediaInfo()
+    with _lock:
+        _cache[key] = mi
+        while len(_cache) > _CACHE_SIZE:
+            _cache.popitem(last=False)
+    return mi
@@ -0,0 +1,355 @@
+"""Метрики горячего пути в текстовом формате Prometheus на ``/metrics``.
+
+Без внешних зависимостей: :class:`Counter`, :class:`Gauge` и
+:class:`Histogram` с метками, общий :data:`REGISTRY` и маленький HTTP-сервер
+в фоновом потоке (:func:`start_server`, порт ``METRICS_PORT``, 0 — выключен;
+по умолчанию слушает только ``127.0.0.1``).
+
+Что собираем:
+
+* ``dlbot_stage_seconds{stage}`` — длительность этапов: probe, extract,
+  download, merge, remux, postprocess, ffprobe, thumbnail, upload
+  (:func:`timed`, :func:`pp_hook`);
+* ``dlbot_botapi_seconds{method,code}`` — вызовы Bot API;
+* ``dlbot_bytes_total{direction}`` — скачанные и отправленные байты;
+* ``dlbot_jobs_total{outcome}`` — завершённые задачи;
+* ``dlbot_<имя>{key}`` — числовые поля ``stats()`` компонентов (очереди
+  планировщика, резерв диска, уборка, полоса, aria2c, склейка запросов),
+  читаются в момент запроса (:func:`expose_stats`).
+"""
+
+import os
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+log = logging.getLogger("bot.metrics")
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 — без эндпоинта
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+# секунды: от вызова Bot API до многочасового скачивания
+DEFAULT_BUCKETS = (
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    120,
+    300,
+    600,
+    1800,
+    3600,
+)
+
+Labels = Tuple[str, ...]
+
+
+def _fmt(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    if float(v).is_integer():
+        return str(int(v))
+    return repr(float(v))
+
+
+def _escape(v: str) -> str:
+    return v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List["_Metric"] = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: "_Metric") -> None:
+        with self._lock:
+            self._metrics.append(metric)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics)
+        lines: List[str] = []
+        for m in metrics:
+            try:
+                body = m.render()
+            except Exception:
+                log.debug("Не удалось собрать метрику %s", m.name, exc_info=True)
+                continue
+            lines.append(f"# HELP {m.name} {m.help}")
+            lines.append(f"# TYPE {m.name} {m.type}")
+            lines.extend(body)
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        registry: Optional[Registry] = REGISTRY,
+    ):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def _key(self, labels: Dict[str, Any]) -> Labels:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_labels(self.labelnames, k)} {_fmt(v)}" for k, v in items]
+
+
+class Gauge(_Metric):
+    """Значение по меткам; ``fn`` — вычислять при каждом запросе."""
+
+    type = "gauge"
+
+    def __init__(
+        self,
+        *args,
+        fn: Optional[Callable[[], Dict[Labels, float]]] = None,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Labels, float] = {}
+        self.fn = fn
+
+    def set(self, value: float, **labels: Any) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: Any) -> None:
+        self.inc(-amount, **labels)
+
+    def render(self) -> List[str]:
+        if self.fn is not None:
+            items = sorted(self.fn().items())
+        else:
+            with self._lock:
+                items = sorted(self._values.items())
+        return [f"{self.name}{_labels(self.labelnames, k)} {_fmt(v)}" for k, v in items]
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, *args, buckets: Sequence[float] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # метки -> ([счётчики по корзинам], сумма, число)
+        self._values: Dict[Labels, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = ([0] * len(self.buckets), [0.0, 0])
+            entry[0][i] += 1
+            entry[1][0] += value
+            entry[1][1] += 1
+
+    @contextmanager
+    def time(self, **labels: Any) -> Iterator[None]:
+        t0 = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - t0, **labels)
+
+    def totals(self) -> Dict[Labels, Tuple[float, int]]:
+        """(сумма, число наблюдений) по меткам — для разницы до/после (bench/)."""
+        with self._lock:
+            return {k: (s[0], int(s[1])) for k, (_, s) in self._values.items()}
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(
+                (k, (list(c), list(s))) for k, (c, s) in self._values.items()
+            )
+        out = []
+        for key, (counts, (total, n)) in items:
+            acc = 0
+            for le, c in zip(self.buckets, counts):
+                acc += c
+                le_label = f'le="{_fmt(le)}"'
+                out.append(
+                    f"{self.name}_bucket{_labels(self.labelnames, key, le_label)} {acc}"
+                )
+            out.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_fmt(total)}")
+            out.append(f"{self.name}_count{_labels(self.labelnames, key)} {int(n)}")
+        return out
+
+
+# --- метрики бота ---
+
+STAGE_SECONDS = Histogram(
+    "dlbot_stage_seconds", "Длительность этапов обработки, сек", ["stage", "status"]
+)
+BOTAPI_SECONDS = Histogram(
+    "dlbot_botapi_seconds", "Длительность вызовов Bot API, сек", ["method", "code"]
+)
+BYTES = Counter("dlbot_bytes_total", "Скачано и отправлено байт", ["direction"])
+JOBS_TOTAL = Counter("dlbot_jobs_total", "Завершённые задачи по исходу", ["outcome"])
+
+# постпроцессоры yt-dlp -> этап
+_PP_STAGES = {
+    "Merger": "merge",
+    "FFmpegVideoRemuxer": "remux",
+    "FFmpegVideoConvertor": "remux",
+    "SmartMp4": "remux",
+    "FFmpegExtractAudio": "remux",
+}
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """Замер этапа; ``status`` — ok или error (по исключению)."""
+    t0 = time.monotonic()
+    status = "error"
+    try:
+        yield
+        status = "ok"
+    finally:
+        STAGE_SECONDS.observe(time.monotonic() - t0, stage=stage, status=status)
+
+
+@contextmanager
+def api_call(method: str) -> Iterator[Dict[str, Any]]:
+    """Замер вызова Bot API; код ответа кладут в ``m["code"]``."""
+    t0 = time.monotonic()
+    m: Dict[str, Any] = {"code": "error"}
+    try:
+        yield m
+    finally:
+        BOTAPI_SECONDS.observe(time.monotonic() - t0, method=method, code=m["code"])
+
+
+def observe_pp(postprocessor: Optional[str], seconds: float) -> None:
+    if postprocessor == "MoveFiles":
+        return
+    stage = _PP_STAGES.get(postprocessor or "", "postprocess")
+    STAGE_SECONDS.observe(seconds, stage=stage, status="ok")
+
+
+def pp_hook() -> Callable[[Dict[str, Any]], None]:
+    """postprocessor_hook yt-dlp, который замеряет склейку/ремукс."""
+    started: Dict[str, float] = {}
+
+    def _hook(d: Dict[str, Any]) -> None:
+        name = d.get("postprocessor") or ""
+        if d.get("status") == "started":
+            started[name] = time.monotonic()
+        elif d.get("status") == "finished" and name in started:
+            observe_pp(name, time.monotonic() - started.pop(name))
+
+    return _hook
+
+
+def download_hook(d: Dict[str, Any]) -> None:
+    """progress_hook yt-dlp: байты каждого скачанного файла."""
+    if d.get("status") == "finished":
+        size = d.get("total_bytes") or d.get("downloaded_bytes") or 0
+        if size:
+            BYTES.inc(size, direction="download")
+
+
+def _flatten(stats: Dict[str, Any], prefix: str = "") -> Dict[Labels, float]:
+    out: Dict[Labels, float] = {}
+    for k, v in stats.items():
+        key = f"{prefix}{k}"
+        if isinstance(v, dict):
+            out.update(_flatten(v, key + "_"))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            out[(key,)] = v
+    return out
+
+
+def expose_stats(name: str, help: str, fn: Callable[[], Dict[str, Any]]) -> Gauge:
+    """Gauge ``dlbot_<name>{key}`` из числовых полей ``fn()`` (вложенные — через _)."""
+    return Gauge(f"dlbot_{name}", help, ["key"], fn=lambda: _flatten(fn()))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self) -> None:
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt: str, *args: Any) -> None:
+        log.debug("metrics: " + fmt, *args)
+
+
+def start_server(
+    port: int = METRICS_PORT, host: str = METRICS_HOST
+) -> Optional[ThreadingHTTPServer]:
+    """Поднимает ``/metrics`` в фоновом потоке; None, если порт 0 или занят."""
+    if port <= 0:
+        return None
+    try:
+        server = ThreadingHTTPServer((host, port), _Handler)
+    except OSError as e:
+        log.warning("Не удалось открыть /metrics на %s:%d: %s", host, port, e)
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    log.info("Метрики: http://%s:%d/metrics", host, port)
+    return server
@@ -0,0 +1,57 @@
+"""Куда задача пишет файлы и как узнать итоговый путь.
+
+Каждая задача пишет в свой подкаталог ``<base>/<job_id>/``, поэтому два
+скачивания с одинаковым названием не пересекаются, а всё, что оставила
+задача (дорожки, ``.part``, temp-файлы склейки), лежит в одном месте.
+Итоговый путь приходит из ``post_hooks`` yt-dlp — их вызывает MoveFiles
+после всей постобработки, — так что ни угадывать расширение, ни обходить
+каталог не нужно.
+"""
+
+import os
+import uuid
+import shutil
+import logging
+from typing import Any, Dict, Optional
+
+log = logging.getLogger("bot.outputs")
+
+DEFAULT_NAME = "%(title).80s [%(id)s].%(ext)s"
+
+
+class JobOutput:
+    def __init__(self, base_dir: str, job_id: Optional[str] = None):
+        self.dir = os.path.join(base_dir, job_id or uuid.uuid4().hex[:10])
+        self.final_path: Optional[str] = None
+
+    def template(self, name: str = DEFAULT_NAME) -> str:
+        """``outtmpl`` для yt-dlp; каталог создаётся здесь."""
+        os.makedirs(self.dir, exist_ok=True)
+        return os.path.join(self.dir, name)
+
+    def hook(self, filepath: str) -> None:
+        """``post_hooks`` yt-dlp: вызывается с путём готового файла."""
+        self.final_path = filepath
+
+    def resolve(self, info: Optional[Dict[str, Any]] = None) -> str:
+        """Итоговый путь: из post_hook, иначе из ``requested_downloads``."""
+        path = self.final_path
+        if not path and info:
+            rds = info.get("requested_downloads") or []
+            if rds:
+                path = rds[0].get("filepath")
+        if not path or not os.path.exists(path):
+            raise RuntimeError(
+                f"Скачивание завершилось, но файл не найден в {self.dir}"
+            )
+        return path
+
+    def remove(self) -> None:
+        """Удаляет каталог задачи целиком."""
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def remove_if_empty(self) -> None:
+        try:
+            os.rmdir(self.dir)
+        except OSError:
+            pass
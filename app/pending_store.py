@@ -0,0 +1,172 @@
+"""Хранилище «ожидающих выбора качества» сессий: token -> (url, варианты).
+
+Сессии живут ``PENDING_TTL`` секунд, всего в памяти не больше
+``PENDING_MAX`` (самые старые вытесняются). Записи компактные: ``__slots__``,
+варианты — кортежи интернированных строк (у сотен сессий одни и те же
+"1080p"/"137+140"). info_dict пробы тяжёлый, поэтому держим его только у
+``PENDING_INFO_MAX`` самых свежих сессий — у остальных скачивание просто
+сделает extract_info заново. При ``PENDING_SQLITE=1`` сессии (без info)
+пишутся в SQLite и переживают перезапуск контейнера.
+"""
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+log = logging.getLogger("bot.pending")
+
+PENDING_TTL = float(os.getenv("PENDING_TTL", str(24 * 3600)))
+PENDING_MAX = int(os.getenv("PENDING_MAX", "5000"))
+PENDING_INFO_MAX = int(os.getenv("PENDING_INFO_MAX", "32"))
+PENDING_SQLITE = os.getenv("PENDING_SQLITE", "false").lower() in {"1", "true", "yes"}
+
+
+class PendingSession:
+    __slots__ = ("url", "choices", "created", "info")
+
+    def __init__(
+        self,
+        url: str,
+        choices: Iterable[Tuple[str, str]],
+        info: Optional[Dict[str, Any]] = None,
+        created: Optional[float] = None,
+    ):
+        self.url = url
+        self.choices: Tuple[Tuple[str, str], ...] = tuple(
+            (sys.intern(lbl), sys.intern(fmt)) for lbl, fmt in choices
+        )
+        self.info = info
+        self.created = time.time() if created is None else created
+
+
+class PendingStore:
+    def __init__(
+        self,
+        ttl: float = PENDING_TTL,
+        max_entries: int = PENDING_MAX,
+        max_info: int = PENDING_INFO_MAX,
+        db_path: Optional[str] = None,
+    ):
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self.max_info = max(0, max_info)
+        self._mem: "OrderedDict[str, PendingSession]" = OrderedDict()
+        # токены сессий, у которых ещё хранится info, в порядке добавления
+        self._with_info: "OrderedDict[str, None]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        if db_path:
+            try:
+                os.makedirs(os.path.dirname(db_path), exist_ok=True)
+                self._db = sqlite3.connect(db_path, check_same_thread=False)
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS pending ("
+                    "token TEXT PRIMARY KEY, url TEXT, choices TEXT, created REAL)"
+                )
+                self._db.execute(
+                    "DELETE FROM pending WHERE created < ?", (time.time() - ttl,)
+                )
+                self._db.commit()
+                log.info("Ожидающие сессии на диске: %s", db_path)
+            except Exception as e:
+                log.warning("Не удалось открыть хранилище сессий %s: %s", db_path, e)
+                self._db = None
+
+    @classmethod
+    def from_env(cls, base_dir: str) -> "PendingStore":
+        db_path = (
+            os.path.join(base_dir, ".cache", "pending.sqlite3")
+            if PENDING_SQLITE
+            else None
+        )
+        return cls(db_path=db_path)
+
+    def __len__(self) -> int:
+        return len(self._mem)
+
+    def put(self, token: str, session: PendingSession) -> None:
+        with self._lock:
+            self._purge(time.time())
+            self._mem[token] = session
+            while len(self._mem) > self.max_entries:
+                old, _ = self._mem.popitem(last=False)
+                self._with_info.pop(old, None)
+                self._db_delete(old)
+            if session.info is not None:
+                self._with_info[token] = None
+                while len(self._with_info) > self.max_info:
+                    old, _ = self._with_info.popitem(last=False)
+                    if old in self._mem:
+                        self._mem[old].info = None
+            if self._db is not None:
+                try:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO pending (token, url, choices, created) "
+                        "VALUES (?, ?, ?, ?)",
+                        (
+                            token,
+                            session.url,
+                            json.dumps(session.choices, ensure_ascii=False),
+                            session.created,
+                        ),
+                    )
+                    self._db.commit()
+                except Exception as e:
+                    log.warning("Не удалось сохранить сессию %s: %s", token, e)
+
+    def pop(self, token: str) -> Optional[PendingSession]:
+        """Забирает сессию (одноразовую). None — нет или истекла."""
+        now = time.time()
+        with self._lock:
+            session = self._mem.pop(token, None)
+            self._with_info.pop(token, None)
+            if session is None:
+                session = self._db_load(token)
+            self._db_delete(token)
+        if session is None or now - session.created >= self.ttl:
+            return None
+        return session
+
+    def _purge(self, now: float) -> None:
+        while self._mem:
+            token, session = next(iter(self._mem.items()))
+            if now - session.created < self.ttl:
+                break
+            self._mem.popitem(last=False)
+            self._with_info.pop(token, None)
+        if self._db is not None:
+            try:
+                self._db.execute(
+                    "DELETE FROM pending WHERE created < ?", (now - self.ttl,)
+                )
+            except Exception:
+                pass
+
+    def _db_load(self, token: str) -> Optional[PendingSession]:
+        if self._db is None:
+            return None
+        try:
+            row = self._db.execute(
+                "SELECT url, choices, created FROM pending WHERE token = ?", (token,)
+            ).fetchone()
+        except Exception:
+            return None
+        if not row:
+            return None
+        url, choices, created = row
+        return PendingSession(url, json.loads(choices), created=created)
+
+    def _db_delete(self, token: str) -> None:
+        if self._db is None:
+            return
+        try:
+            self._db.execute("DELETE FROM pending WHERE token = ?", (token,))
+            self._db.commit()
+        except Exception:
+            pass
@@ -0,0 +1,165 @@
+"""Конвейер «склейка → аплоад»: отправка в Bot API начинается, пока ffmpeg
+ещё пишет итоговый mp4.
+
+yt-dlp склеивает видео и аудио (Merger) во временный ``*.temp.mp4``. В
+конвейерном режиме склейка пишет фрагментированный MP4 (moov в начале,
+дальше независимые фрагменты), поэтому файл можно читать «хвостом» по мере
+записи и сразу слать в sendVideo chunked-запросом. Ремукс/конвертация после
+склейки в mp4 в yt-dlp пропускаются, так что аплоад заканчивается почти
+одновременно со склейкой, а не после неё.
+
+Само скачивание дорожек не перекрывается с аплоадом: aria2c пишет файл
+кусками вразнобой, а склейке нужны обе дорожки целиком.
+"""
+
+import os
+import time
+import uuid
+import logging
+import threading
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+from yt_dlp.utils import prepend_extension
+
+from formats import FormatIndex
+
+log = logging.getLogger("bot.pipeline")
+
+PIPELINED_UPLOAD = os.getenv("PIPELINED_UPLOAD", "false").lower() in {
+    "1",
+    "true",
+    "yes",
+}
+PIPELINE_POLL = 0.2  # сек между проверками «хвоста» файла
+PIPELINE_CHUNK_SIZE = 1024 * 1024
+
+# Аргументы ffmpeg для выхода склейки: фрагментированный MP4 без второго прохода
+# (+faststart, который yt-dlp добавляет сам, переписывает файл целиком в конце)
+FRAGMENTED_MP4_ARGS = ["-movflags", "+frag_keyframe+empty_moov+default_base_moof"]
+MERGER_PP_ARGS = {"merger+ffmpeg_o": FRAGMENTED_MP4_ARGS}
+
+
+class MergeWatcher:
+    """postprocessor_hook для yt-dlp: сообщает, куда и когда пишет Merger."""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.finished = threading.Event()
+        self.failed = False
+        self.temp_path: Optional[str] = None
+        self.final_path: Optional[str] = None
+
+    def hook(self, d: Dict[str, Any]) -> None:
+        if d.get("postprocessor") != "Merger":
+            return
+        if d.get("status") == "started":
+            self.final_path = d["info_dict"]["filepath"]
+            self.temp_path = prepend_extension(self.final_path, "temp")
+            log.info("Склейка началась, стримлю %s", self.temp_path)
+            self.started.set()
+        elif d.get("status") == "finished":
+            self.finished.set()
+
+    def close(self, failed: bool = False) -> None:
+        """Вызывается по завершении скачивания (успешном или нет)."""
+        self.failed = failed and not self.finished.is_set()
+        self.finished.set()
+        self.started.set()
+
+    def wait_started(self) -> bool:
+        """True — склейка началась, False — скачивание закончилось без неё."""
+        self.started.wait()
+        return self.temp_path is not None and not self.failed
+
+    def chunks(self, size: int = PIPELINE_CHUNK_SIZE) -> Iterator[bytes]:
+        """Читает растущий temp-файл до конца склейки."""
+        path = self.temp_path
+        while not os.path.exists(path):
+            if self.finished.is_set():
+                # склейка успела закончиться и переименовать файл
+                path = self.final_path
+                break
+            time.sleep(PIPELINE_POLL)
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(size)
+                if chunk:
+                    yield chunk
+                    continue
+                if self.failed:
+                    raise RuntimeError("Склейка завершилась с ошибкой")
+                if self.finished.is_set():
+                    # дочитываем то, что успело дописаться до установки флага
+                    tail = f.read()
+                    if tail:
+                        yield tail
+                    return
+                time.sleep(PIPELINE_POLL)
+
+
+def multipart_stream(
+    fields: Dict[str, Any],
+    file_field: str,
+    filename: str,
+    content_type: str,
+    chunks: Iterator[bytes],
+    label: str = "upload",
+) -> Tuple[str, Iterator[bytes]]:
+    """(Content-Type, генератор тела) для multipart без известной длины."""
+    boundary = uuid.uuid4().hex
+    filename = filename.replace('"', "'")
+    head = b"".join(
+        (
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="{k}"\r\n\r\n'
+            f"{str(v).lower() if isinstance(v, bool) else v}\r\n"
+        ).encode("utf-8")
+        for k, v in fields.items()
+        if v is not None
+    )
+    head += (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="{file_field}"; '
+        f'filename="{filename}"\r\n'
+        f"Content-Type: {content_type}\r\n\r\n"
+    ).encode("utf-8")
+
+    def body() -> Iterator[bytes]:
+        yield head
+        sent = 0
+        t0 = time.time()
+        last = 0.0
+        for chunk in chunks:
+            sent += len(chunk)
+            now = time.time()
+            if now - last >= 5:
+                log.info(
+                    "UP (pipe): %.2fMiB at %.2fMiB/s (%s)",
+                    sent / 1024 / 1024,
+                    sent / max(1e-6, now - t0) / 1024 / 1024,
+                    label,
+                )
+                last = now
+            yield chunk
+        yield f"\r\n--{boundary}--\r\n".encode("utf-8")
+
+    return f"multipart/form-data; boundary={boundary}", body()
+
+
+def video_meta_from_info(info: Optional[Dict[str, Any]], fmt: str) -> Dict[str, int]:
+    """width/height/duration для sendVideo из info_dict пробы (без ffprobe)."""
+    if not info:
+        return {}
+    meta: Dict[str, int] = {}
+    by_id = FormatIndex.of(info).by_id
+    for fid in fmt.split("+"):
+        f = by_id.get(fid)
+        if f is not None and f.has_video:
+            if f.width:
+                meta["width"] = f.width
+            if f.height:
+                meta["height"] = f.height
+            break
+    if info.get("duration"):
+        meta["duration"] = int(info["duration"])
+    return meta
@@ -0,0 +1,114 @@
+"""Постобработка под Telegram: один ffprobe и выбор минимального действия.
+
+Вместо цепочки FFmpegVideoRemuxer → FFmpegVideoConvertor смотрим на кодеки
+один раз и выбираем:
+
+* ``noop``    — уже mp4 с видео, которое mp4 умеет хранить (H.264, HEVC,
+  AV1, VP9…), и AAC/MP3 (или без звука), ничего не делаем;
+* ``remux``   — видео помещается в mp4, меняем только контейнер
+  (``-c copy``), при необходимости перекодируем одну аудиодорожку в AAC —
+  это дёшево;
+* ``reencode`` — видео в mp4 не кладётся вовсе (VP8, Theora, FLV1…),
+  перекодируем в H.264 с ограничением потоков ``TRANSCODE_THREADS``, чтобы
+  одна задача не съела хост.
+
+VP9/AV1/HEVC в 1440p/2160p не перекодируем: libx264 на таких файлах — минуты
+и часы, а раньше они тоже уходили как есть.
+"""
+
+import os
+import logging
+from typing import Any, Dict, List, Optional
+
+from yt_dlp.postprocessor.common import PostProcessor
+from yt_dlp.postprocessor.ffmpeg import FFmpegPostProcessor
+from yt_dlp.utils import prepend_extension, replace_extension
+
+from media_info import probe as probe_media
+
+log = logging.getLogger("bot.postprocess")
+
+TRANSCODE_THREADS = int(os.getenv("TRANSCODE_THREADS", "2"))
+TRANSCODE_PRESET = os.getenv("TRANSCODE_PRESET", "veryfast")
+TRANSCODE_CRF = os.getenv("TRANSCODE_CRF", "23")
+# false — никогда не перекодировать видео, отдавать как есть
+ALLOW_REENCODE = os.getenv("ALLOW_REENCODE", "true").lower() in {"1", "true", "yes"}
+
+# видео, которое кладётся в mp4 копированием (имена кодеков ffprobe)
+MP4_VIDEO_OK = {"h264", "hevc", "av1", "vp9", "mpeg4"}
+MP4_AUDIO_OK = {"aac", "mp3"}
+
+
+def choose_action(ext: str, vcodec: Optional[str], acodec: Optional[str]) -> str:
+    if vcodec is not None and vcodec not in MP4_VIDEO_OK:
+        if ALLOW_REENCODE:
+            return "reencode"
+        # без перекодирования видео mp4 → mp4 ничего не даст
+        return "noop" if ext == "mp4" else "remux"
+    if ext == "mp4" and (acodec is None or acodec in MP4_AUDIO_OK):
+        return "noop"
+    return "remux"
+
+
+class SmartMp4PP(FFmpegPostProcessor):
+    """yt-dlp постпроцессор: приводит файл к mp4 минимальной ценой.
+
+    Видео из ``MP4_VIDEO_OK`` (H.264, HEVC, AV1, VP9, MPEG-4) копируется как
+    есть, остальное перекодируется в H.264 (если ``ALLOW_REENCODE``); звук не
+    из ``MP4_AUDIO_OK`` — в AAC. Действие — :func:`choose_action`.
+    """
+
+    def __init__(self, downloader=None, threads: int = TRANSCODE_THREADS):
+        super().__init__(downloader)
+        self.threads = max(1, threads)
+
+    def _ffmpeg_opts(self, action: str, acodec: Optional[str]) -> List[str]:
+        opts = ["-map", "0:v:0?", "-map", "0:a:0?", "-dn", "-sn"]
+        if action == "reencode":
+            opts += [
+                "-c:v",
+                "libx264",
+                "-preset",
+                TRANSCODE_PRESET,
+                "-crf",
+                TRANSCODE_CRF,
+                "-pix_fmt",
+                "yuv420p",
+                "-threads",
+                str(self.threads),
+            ]
+        else:
+            opts += ["-c:v", "copy"]
+        if acodec is None or acodec in MP4_AUDIO_OK:
+            opts += ["-c:a", "copy"]
+        else:
+            opts += ["-c:a", "aac", "-b:a", "192k"]
+        return opts
+
+    @PostProcessor._restrict_to(images=False)
+    def run(self, info: Dict[str, Any]):
+        path = info["filepath"]
+        ext = (info.get("ext") or "").lower()
+        mi = probe_media(path)
+        if not mi.format_name:
+            self.report_warning(f"ffprobe не смог прочитать {path}")
+            return [], info
+        fmt_name, vcodec, acodec = mi.format_name, mi.vcodec, mi.acodec
+        action = choose_action(ext, vcodec, acodec)
+        log.info(
+            "Постобработка: %s (контейнер=%s, видео=%s, аудио=%s)",
+            action,
+            fmt_name,
+            vcodec,
+            acodec,
+        )
+        if action == "noop":
+            return [], info
+
+        out = replace_extension(path, "mp4", ext)
+        tmp = prepend_extension(out, "temp")
+        self.run_ffmpeg(path, tmp, self._ffmpeg_opts(action, acodec))
+        os.replace(tmp, out)
+        info["filepath"] = out
+        info["ext"] = "mp4"
+        return ([path] if out != path else []), info
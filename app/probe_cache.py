@@ -0,0 +1,237 @@
+"""Кэш результатов пробы yt-dlp (``extract_info(download=False)``).
+
+Ключ — канонический id экстрактора (``"Youtube:dQw4w9WgXcQ"``), а не строка
+URL, поэтому youtu.be/watch?v=/shorts-ссылки на одно видео попадают в одну
+запись. Записи живут ``PROBE_CACHE_TTL`` секунд, в памяти держим не больше
+``PROBE_CACHE_SIZE`` штук (LRU). При ``PROBE_CACHE_SQLITE=1`` кэш дублируется
+в SQLite-файл, чтобы переживать перезапуски. Одновременные промахи по
+одному ключу склеиваются в одну экстракцию (singleflight.py).
+"""
+
+import os
+import re
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from yt_dlp.extractor import gen_extractor_classes
+
+from metrics import timed
+from singleflight import SingleFlight
+from workers import extract_info
+
+log = logging.getLogger("bot.probe_cache")
+
+PROBE_CACHE_TTL = float(os.getenv("PROBE_CACHE_TTL", "900"))  # сек, 0 — выключен
+PROBE_CACHE_SIZE = int(os.getenv("PROBE_CACHE_SIZE", "256"))
+PROBE_CACHE_SQLITE = os.getenv("PROBE_CACHE_SQLITE", "false").lower() in {
+    "1",
+    "true",
+    "yes",
+}
+
+# Повторное использование info_dict пробы при скачивании: не старше MAX_AGE сек
+# и подписанные ссылки форматов должны жить ещё хотя бы MARGIN сек
+PROBE_REUSE_MAX_AGE = float(os.getenv("PROBE_REUSE_MAX_AGE", "3600"))
+PROBE_REUSE_MARGIN = float(os.getenv("PROBE_REUSE_MARGIN", "1800"))
+
+# expire=<unix> (YouTube, в т.ч. /expire/<unix>/ в манифестах), Expires=<unix>
+# (CloudFront), oe=<hex unix> (Instagram/Facebook CDN)
+_EXPIRE_RE = re.compile(r"(?:[?&]expire=|/expire/|[?&]Expires=)(\d+)")
+_EXPIRE_HEX_RE = re.compile(r"[?&]oe=([0-9A-Fa-f]+)")
+
+# Тяжёлые поля info_dict, которые не нужны ни для выбора качества, ни для скачивания
+_DROP_KEYS = ("automatic_captions", "subtitles", "heatmap", "comments")
+
+
+def canonical_key(url: str) -> str:
+    """``"<extractor_key>:<id>"`` без сетевых запросов; для generic — сам URL."""
+    for ie in gen_extractor_classes():
+        if ie.ie_key() == "Generic" or not ie.suitable(url):
+            continue
+        vid = ie.get_temp_id(url)
+        if vid:
+            return f"{ie.ie_key()}:{vid}"
+        break
+    return f"Generic:{url.strip()}"
+
+
+def info_key(info: Dict[str, Any]) -> Optional[str]:
+    ie_key = info.get("extractor_key") or info.get("ie_key")
+    vid = info.get("id")
+    if not ie_key or not vid:
+        return None
+    return f"{ie_key}:{vid}"
+
+
+def url_expiry(url: str) -> Optional[float]:
+    """Время истечения подписанной ссылки (unix) или None, если не распознали."""
+    m = _EXPIRE_RE.search(url)
+    if m:
+        return float(m.group(1))
+    m = _EXPIRE_HEX_RE.search(url)
+    if m:
+        return float(int(m.group(1), 16))
+    return None
+
+
+def info_is_fresh(info: Dict[str, Any], format_str: Optional[str] = None) -> bool:
+    """Можно ли скачивать по сохранённому info_dict без повторного extract_info.
+
+    Проверяем возраст пробы и сроки жизни ссылок у форматов из ``format_str``
+    (если это селектор вроде ``bv*+ba/best`` — у всех форматов).
+    """
+    now = time.time()
+    epoch = info.get("epoch")
+    if not epoch or now - epoch > PROBE_REUSE_MAX_AGE:
+        return False
+    formats = info.get("formats") or []
+    ids = set(re.split(r"[+/]", format_str)) if format_str else set()
+    selected = [f for f in formats if str(f.get("format_id")) in ids] or formats
+    for f in selected:
+        for u in (f.get("url"), f.get("manifest_url"), f.get("fragment_base_url")):
+            exp = url_expiry(u) if u else None
+            if exp is not None and exp - now < PROBE_REUSE_MARGIN:
+                return False
+    return True
+
+
+class ProbeCache:
+    def __init__(
+        self,
+        ttl: float = PROBE_CACHE_TTL,
+        max_entries: int = PROBE_CACHE_SIZE,
+        db_path: Optional[str] = None,
+    ):
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self._mem: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.flights = SingleFlight("Проба")
+        self._db: Optional[sqlite3.Connection] = None
+        if db_path and ttl > 0:
+            try:
+                os.makedirs(os.path.dirname(db_path), exist_ok=True)
+                self._db = sqlite3.connect(db_path, check_same_thread=False)
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS probe ("
+                    "key TEXT PRIMARY KEY, created REAL, used REAL, info TEXT)"
+                )
+                self._db.commit()
+                log.info("Кэш проб на диске: %s", db_path)
+            except Exception as e:
+                log.warning("Не удалось открыть кэш проб %s: %s", db_path, e)
+                self._db = None
+
+    @classmethod
+    def from_env(cls, base_dir: str) -> "ProbeCache":
+        db_path = (
+            os.path.join(base_dir, ".cache", "probe.sqlite3")
+            if PROBE_CACHE_SQLITE
+            else None
+        )
+        return cls(db_path=db_path)
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        if self.ttl <= 0:
+            return None
+        now = time.time()
+        with self._lock:
+            item = self._mem.get(key)
+            if item is not None:
+                created, info = item
+                if now - created < self.ttl:
+                    self._mem.move_to_end(key)
+                    return info
+                del self._mem[key]
+            if self._db is None:
+                return None
+            row = self._db.execute(
+                "SELECT created, info FROM probe WHERE key = ?", (key,)
+            ).fetchone()
+            if not row:
+                return None
+            created, raw = row
+            if now - created >= self.ttl:
+                self._db.execute("DELETE FROM probe WHERE key = ?", (key,))
+                self._db.commit()
+                return None
+            self._db.execute("UPDATE probe SET used = ? WHERE key = ?", (now, key))
+            self._db.commit()
+            info = json.loads(raw)
+            self._remember(key, created, info)
+            return info
+
+    def put(self, key: str, info: Dict[str, Any]) -> None:
+        if self.ttl <= 0:
+            return
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, info)
+            if self._db is None:
+                return
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO probe (key, created, used, info) "
+                    "VALUES (?, ?, ?, ?)",
+                    (key, now, now, json.dumps(info, ensure_ascii=False)),
+                )
+                self._db.execute(
+                    "DELETE FROM probe WHERE created < ? OR key NOT IN "
+                    "(SELECT key FROM probe ORDER BY used DESC LIMIT ?)",
+                    (now - self.ttl, self.max_entries * 4),
+                )
+                self._db.commit()
+            except Exception as e:
+                log.warning("Не удалось записать пробу %s на диск: %s", key, e)
+
+    def _remember(self, key: str, created: float, info: Dict[str, Any]) -> None:
+        self._mem[key] = (created, info)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_entries:
+            self._mem.popitem(last=False)
+
+    def extract(
+        self,
+        url: str,
+        opts: Dict[str, Any],
+        extractor: Optional[Callable[[str, Dict[str, Any]], Dict[str, Any]]] = None,
+    ) -> Dict[str, Any]:
+        """``extract_info(url, download=False)`` через кэш. Возвращает info_dict.
+
+        ``extractor(url, opts)`` — чем экстрактить при промахе (например, пулом
+        процессов из workers.py); по умолчанию в текущем потоке.
+        """
+        key = canonical_key(url)
+        info = self.get(key)
+        if info is not None:
+            self.hits += 1
+            log.info("Проба из кэша: %s", key)
+            return info
+        self.misses += 1
+        return self.flights.do(
+            key, lambda: self._extract(key, url, opts, extractor or extract_info)
+        )
+
+    def _extract(
+        self,
+        key: str,
+        url: str,
+        opts: Dict[str, Any],
+        extractor: Callable[[str, Dict[str, Any]], Dict[str, Any]],
+    ) -> Dict[str, Any]:
+        with timed("extract"):
+            info = extractor(url, opts)
+        for k in _DROP_KEYS:
+            info.pop(k, None)
+        real_key = info_key(info)
+        self.put(key, info)
+        if real_key and real_key != key:
+            self.put(real_key, info)
+        return info
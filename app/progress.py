@@ -0,0 +1,300 @@
+"""Прогресс задачи в служебном сообщении чата с ограничением частоты правок.
+
+Hooks yt-dlp и аплоада вызываются десятки раз в секунду из потоков
+скачивания, а Telegram разрешает примерно одну правку сообщения в секунду на
+чат (в группах — ~20 в минуту) и ~30 запросов в секунду на бота. Поэтому:
+
+* :class:`Progress` (одно сообщение) только запоминает последнее состояние
+  (``hook`` / ``pp_hook`` / ``upload`` / ``stage``) под замком — без
+  очереди, каждое событие перезаписывает предыдущее;
+* :class:`ProgressReporter` раз в ``_TICK`` секунд собирает текст изменившихся
+  сообщений и отправляет ``editMessageText`` не чаще раза в
+  ``PROGRESS_CHAT_INTERVAL`` секунд на чат и ``PROGRESS_EDITS_PER_SEC`` в
+  секунду на весь бот; первыми правятся те, что дольше всех ждут. Одинаковый
+  текст не отправляется, на ответ 429 чат выдерживает ``retry_after``.
+
+Перед тем как править или удалять сообщение самому, вызывающий закрывает
+:class:`Progress` (``await progress.close()`` или ``async with``): это
+дожидается уже отправленной правки, и прогресс не перезапишет итоговый текст.
+"""
+
+import os
+import time
+import asyncio
+import logging
+import threading
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+log = logging.getLogger("bot.progress")
+
+MB = 1024 * 1024
+# сек между правками прогресса в одном чате
+PROGRESS_CHAT_INTERVAL = float(os.getenv("PROGRESS_CHAT_INTERVAL", "3"))
+# правок прогресса в секунду на весь бот (остальное — ответам пользователям)
+PROGRESS_EDITS_PER_SEC = float(os.getenv("PROGRESS_EDITS_PER_SEC", "10"))
+
+_TICK = 0.25  # сек между проверками изменившихся сообщений
+_BAR = 10  # делений в полоске прогресса
+UPLOAD_HEADER = "📤 Загрузка в Telegram…"
+
+# постпроцессоры yt-dlp -> заголовок этапа (MoveFiles не показываем)
+_PP_HEADERS = {
+    "Merger": "🔧 Склеиваю дорожки…",
+    "FFmpegVideoRemuxer": "🔧 Перепаковываю в MP4…",
+    "FFmpegVideoConvertor": "🔧 Перепаковываю в MP4…",
+    "SmartMp4": "🔧 Перепаковываю в MP4…",
+    "FFmpegExtractAudio": "🎵 Извлекаю звук…",
+}
+
+# (chat_id, message_id, текст, reply_markup) -> пауза для чата по 429 или None
+EditFn = Callable[[int, int, str, Any], Awaitable[Optional[float]]]
+
+
+def _eta(sec: float) -> str:
+    sec = int(sec)
+    if sec >= 3600:
+        return f"{sec // 3600} ч {sec % 3600 // 60} мин"
+    if sec >= 60:
+        return f"{sec // 60} мин {sec % 60} с"
+    return f"{sec} с"
+
+
+def _line(
+    done: float, total: float, speed: Optional[float], eta: Optional[float]
+) -> str:
+    """``▰▰▰▱▱▱▱▱▱▱ 31% · 12.0/38.5 MB · 4.2 MB/s · ~6 с``."""
+    if total:
+        pct = min(100.0, done * 100 / total)
+        filled = int(pct * _BAR / 100)
+        parts = [
+            f"{'▰' * filled}{'▱' * (_BAR - filled)} {pct:.0f}%",
+            f"{done / MB:.1f}/{total / MB:.1f} MB",
+        ]
+    else:
+        parts = [f"{done / MB:.1f} MB"]
+    if speed:
+        parts.append(f"{speed / MB:.1f} MB/s")
+    if eta:
+        parts.append(f"~{_eta(eta)}")
+    return " · ".join(parts)
+
+
+class Progress:
+    """Состояние одного служебного сообщения; hooks можно звать из любых потоков."""
+
+    def __init__(
+        self,
+        reporter: "ProgressReporter",
+        chat_id: int,
+        message_id: int,
+        header: str,
+        markup: Any = None,
+    ):
+        self.reporter = reporter
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.header = header
+        self.markup = markup
+        self.closed = False
+        self.version = 0  # растёт с каждым событием
+        self.shown_version = 0
+        self.shown_text: Optional[str] = None
+        self.shown_at = 0.0
+        self.inflight: Optional["asyncio.Future[None]"] = None
+        self._download_header = header
+        self._mode = "text"  # text | download | upload
+        self._files: Dict[str, Tuple[float, float]] = {}  # файл -> (скачано, всего)
+        self._speed: Optional[float] = None
+        self._eta: Optional[float] = None
+        self._sent = (0, 0)
+        self._upload_start = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def dirty(self) -> bool:
+        return self.version != self.shown_version
+
+    def stage(self, header: str) -> None:
+        """Новый этап без полоски прогресса."""
+        with self._lock:
+            self.header = header
+            self._mode = "text"
+            self.version += 1
+
+    def hook(self, d: Dict[str, Any]) -> None:
+        """progress_hook yt-dlp: байты всех файлов задачи (видео + звук)."""
+        status = d.get("status")
+        if status not in ("downloading", "finished"):
+            return
+        done = d.get("downloaded_bytes") or 0
+        total = d.get("total_bytes") or d.get("total_bytes_estimate") or 0
+        if status == "finished":
+            done = total = total or done
+        with self._lock:
+            if self._mode != "download":
+                self._mode = "download"
+                self.header = self._download_header
+            self._files[d.get("filename") or ""] = (done, total)
+            self._speed = d.get("speed") if status == "downloading" else None
+            self._eta = d.get("eta") if status == "downloading" else None
+            self.version += 1
+
+    def pp_hook(self, d: Dict[str, Any]) -> None:
+        """postprocessor_hook yt-dlp (или событие ``postprocessing`` воркера)."""
+        if d.get("status") not in ("started", "postprocessing"):
+            return
+        name = d.get("postprocessor") or ""
+        if name != "MoveFiles":
+            self.stage(_PP_HEADERS.get(name, "🔧 Обработка…"))
+
+    def upload(self, sent: int, total: int) -> None:
+        """on_progress аплоада (``total`` 0 — размер ещё неизвестен)."""
+        with self._lock:
+            if self._mode != "upload":
+                self._mode = "upload"
+                self.header = UPLOAD_HEADER
+                self._upload_start = time.monotonic()
+            self._sent = (sent, total)
+            self.version += 1
+
+    def render(self) -> str:
+        with self._lock:
+            if self._mode == "download":
+                done = sum(d for d, _ in self._files.values())
+                total = sum(t for _, t in self._files.values())
+                line = _line(done, total, self._speed, self._eta)
+            elif self._mode == "upload":
+                sent, total = self._sent
+                speed = sent / max(1e-6, time.monotonic() - self._upload_start)
+                eta = (total - sent) / speed if total and speed else None
+                line = _line(sent, total, speed, eta)
+            else:
+                return self.header
+        return f"{self.header}\n{line}"
+
+    async def close(self) -> None:
+        """Больше не правим; дожидаемся уже отправленной правки."""
+        if self.closed:
+            return
+        self.closed = True
+        self.reporter._forget(self)
+        if self.inflight is not None:
+            await asyncio.wait([self.inflight])
+
+    async def __aenter__(self) -> "Progress":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+
+class ProgressReporter:
+    def __init__(
+        self,
+        edit: Optional[EditFn] = None,
+        chat_interval: float = PROGRESS_CHAT_INTERVAL,
+        rate: float = PROGRESS_EDITS_PER_SEC,
+    ):
+        self.edit = edit
+        self.chat_interval = chat_interval
+        self.rate = rate
+        self.edits = 0
+        self.errors = 0
+        self.throttled = 0  # ответов 429
+        self._active: Dict[Tuple[int, int], Progress] = {}
+        self._chat_next: Dict[int, float] = {}  # чат -> когда можно следующую правку
+        self._next = 0.0  # общий интервал между правками
+
+    def track(
+        self, chat_id: int, message_id: int, header: str, markup: Any = None
+    ) -> Progress:
+        """Прогресс в сообщении ``message_id``; закрыть — :meth:`Progress.close`."""
+        p = Progress(self, chat_id, message_id, header, markup)
+        old = self._active.get((chat_id, message_id))
+        if old is not None:
+            old.closed = True
+        self._active[(chat_id, message_id)] = p
+        return p
+
+    def _forget(self, p: Progress) -> None:
+        if self._active.get((p.chat_id, p.message_id)) is p:
+            del self._active[(p.chat_id, p.message_id)]
+        if not any(a.chat_id == p.chat_id for a in self._active.values()):
+            self._chat_next.pop(p.chat_id, None)
+
+    def flush(self) -> int:
+        """Запускает правки изменившихся сообщений, на которые хватает лимитов."""
+        if self.edit is None:
+            return 0
+        now = time.monotonic()
+        due = [
+            p
+            for p in self._active.values()
+            if p.dirty
+            and p.inflight is None
+            and self._chat_next.get(p.chat_id, 0.0) <= now
+        ]
+        due.sort(key=lambda p: p.shown_at)
+        started = 0
+        chats = set()
+        for p in due:
+            if self._next > now:
+                break
+            if p.chat_id in chats:
+                continue
+            version = p.version
+            text = p.render()
+            if text == p.shown_text:
+                p.shown_version = version
+                continue
+            chats.add(p.chat_id)
+            self._chat_next[p.chat_id] = now + self.chat_interval
+            if self.rate > 0:
+                # неиспользованный за прошлый тик запас не копим дольше тика
+                self._next = max(self._next, now - _TICK) + 1 / self.rate
+            p.inflight = asyncio.ensure_future(self._send(p, text, version))
+            started += 1
+        return started
+
+    async def _send(self, p: Progress, text: str, version: int) -> None:
+        try:
+            wait = await self.edit(p.chat_id, p.message_id, text, p.markup)
+            self.edits += 1
+            if wait:
+                self.throttled += 1
+                log.info(
+                    "Прогресс: Telegram просит паузу %.0f c в чате %s", wait, p.chat_id
+                )
+                self._chat_next[p.chat_id] = time.monotonic() + wait
+        except Exception as e:
+            self.errors += 1
+            log.debug("Не удалось обновить прогресс: %r", e)
+        finally:
+            # неудачную правку не повторяем: следующая будет с новым текстом
+            p.shown_text = text
+            p.shown_version = version
+            p.shown_at = time.monotonic()
+            p.inflight = None
+
+    async def run_forever(self, edit: Optional[EditFn] = None) -> None:
+        if edit is not None:
+            self.edit = edit
+        log.info(
+            "Прогресс в чате: раз в %.1f c на чат, до %.0f правок/с",
+            self.chat_interval,
+            self.rate,
+        )
+        while True:
+            try:
+                self.flush()
+            except Exception:
+                log.exception("Ошибка обновления прогресса")
+            await asyncio.sleep(_TICK)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "active": len(self._active),
+            "edits": self.edits,
+            "errors": self.errors,
+            "throttled": self.throttled,
+        }
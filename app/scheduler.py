@@ -0,0 +1,166 @@
+"""Планировщик задач для asyncio-цикла bot.py.
+
+Цикл getUpdates запускает на каждый апдейт отдельную корутину
+(:meth:`JobScheduler.spawn`) и сразу возвращается к опросу. Короткие вызовы
+Bot API (ответ на кнопку, правка статуса) выполняются без очереди, а тяжёлая
+часть обработки берёт слоты:
+
+* ``scheduler.job(chat_id)`` — глобально не больше ``MAX_JOBS`` задач и не
+  больше ``MAX_JOBS_PER_CHAT`` на чат, остальные ждут своей очереди;
+* ``scheduler.stage("probe" | "download" | "upload")`` — ограничивает число
+  одновременных проб, скачиваний и аплоадов.
+
+Блокирующая работа (yt-dlp, ffmpeg, аплоад) уходит в потоки executor'а,
+поэтому ``MAX_JOBS`` заодно ограничивает число занятых потоков.
+"""
+
+import os
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Dict, List, Optional, Set
+
+log = logging.getLogger("bot.scheduler")
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return max(1, int(os.getenv(name, str(default))))
+    except ValueError:
+        log.warning("Некорректное значение %s, использую %d", name, default)
+        return default
+
+
+MAX_JOBS = _env_int("MAX_JOBS", 8)
+MAX_JOBS_PER_CHAT = _env_int("MAX_JOBS_PER_CHAT", 2)
+STAGE_LIMITS = {
+    "probe": _env_int("MAX_PROBES", 4),
+    "download": _env_int("MAX_DOWNLOADS", 3),
+    "upload": _env_int("MAX_UPLOADS", 2),
+}
+
+
+class _ChatSlot:
+    __slots__ = ("sem", "users")
+
+    def __init__(self, n: int):
+        self.sem = asyncio.Semaphore(n)
+        # сколько корутин держат или ждут слот; при 0 запись удаляется
+        self.users = 0
+
+
+class JobScheduler:
+    def __init__(
+        self,
+        max_jobs: int = MAX_JOBS,
+        per_chat: int = MAX_JOBS_PER_CHAT,
+        stage_limits: Optional[Dict[str, int]] = None,
+    ):
+        self.max_jobs = max_jobs
+        self.per_chat = per_chat
+        self.stage_limits = dict(stage_limits or STAGE_LIMITS)
+        self._jobs = asyncio.Semaphore(max_jobs)
+        self._stages = {
+            name: asyncio.Semaphore(n) for name, n in self.stage_limits.items()
+        }
+        self._chats: Dict[int, _ChatSlot] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._waiting = 0
+        self._active: Dict[str, int] = {name: 0 for name in self._stages}
+
+    def spawn(self, coro: Awaitable[Any], name: Optional[str] = None) -> asyncio.Task:
+        """Запускает корутину в фоне; исключения логируются, а не теряются."""
+        task = asyncio.ensure_future(coro)
+        if name:
+            task.set_name(name)
+        self._tasks.add(task)
+        task.add_done_callback(self._done)
+        return task
+
+    def _done(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        if task.cancelled():
+            return
+        exc = task.exception()
+        if exc is not None:
+            log.error("Ошибка в задаче %s", task.get_name(), exc_info=exc)
+
+    @asynccontextmanager
+    async def job(self, chat_id: Optional[int]):
+        """Слот тяжёлой задачи: сначала чата, потом глобальный."""
+        slot = None
+        if chat_id is not None:
+            slot = self._chats.get(chat_id)
+            if slot is None:
+                slot = self._chats[chat_id] = _ChatSlot(self.per_chat)
+            slot.users += 1
+            if slot.sem.locked():
+                log.info(
+                    "Чат %s: лимит задач (%d), задача ждёт своей очереди",
+                    chat_id,
+                    self.per_chat,
+                )
+        self._waiting += 1
+        chat_acquired = False
+        try:
+            if slot is not None:
+                await slot.sem.acquire()
+                chat_acquired = True
+            await self._jobs.acquire()
+        except BaseException:
+            if chat_acquired:
+                slot.sem.release()
+            self._leave(chat_id, slot)
+            raise
+        finally:
+            self._waiting -= 1
+        try:
+            yield
+        finally:
+            self._jobs.release()
+            if slot is not None:
+                slot.sem.release()
+            self._leave(chat_id, slot)
+
+    def _leave(self, chat_id: Optional[int], slot: Optional[_ChatSlot]) -> None:
+        if slot is None:
+            return
+        slot.users -= 1
+        if slot.users <= 0 and self._chats.get(chat_id) is slot:
+            del self._chats[chat_id]
+
+    @asynccontextmanager
+    async def stage(self, name: str):
+        """Ограничивает число одновременных выполнений этапа ``name``."""
+        sem = self._stages.get(name)
+        if sem is None:
+            yield
+            return
+        async with sem:
+            self._active[name] += 1
+            try:
+                yield
+            finally:
+                self._active[name] -= 1
+
+    def pending(self) -> int:
+        """Сколько задач ждут слота."""
+        return self._waiting
+
+    def running(self) -> int:
+        return len(self._tasks)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "tasks": len(self._tasks),
+            "waiting": self._waiting,
+            "chats": len(self._chats),
+            "stage": dict(self._active),
+        }
+
+    async def shutdown(self) -> None:
+        tasks: List[asyncio.Task] = list(self._tasks)
+        for t in tasks:
+            t.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
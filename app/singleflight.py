@@ -0,0 +1,120 @@
+"""Склейка одинаковых запросов: одна проба / одно скачивание на всех.
+
+Когда ссылка расходится по групповому чату, десять человек присылают её за
+несколько секунд и нажимают одно и то же качество. Вместо десяти проб и
+десяти скачиваний:
+
+* :class:`SingleFlight` (потоки) — пробы по ключу ``"<extractor>:<id>"``
+  (``probe_cache.canonical_key``): первый вызов экстрактит, остальные ждут
+  его и получают тот же info_dict (или то же исключение);
+* :class:`AsyncSingleFlight` (asyncio) — скачивания по ключу
+  ``(ролик, формат)``: лидер качает и отправляет файл, остальные ждут его
+  ``(file_id, kind, caption)`` и переотправляют по file_id. Если лидер не
+  справился (ошибка, отмена), ожидающие получают None и пробуют сами.
+"""
+
+import asyncio
+import logging
+import threading
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple, TypeVar
+
+log = logging.getLogger("bot.singleflight")
+
+T = TypeVar("T")
+
+
+class _Call:
+    __slots__ = ("event", "result", "error", "followers")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self.followers = 0
+
+
+class SingleFlight:
+    def __init__(self, name: str = "flight"):
+        self.name = name
+        self.leaders = 0
+        self.coalesced = 0
+        self._calls: Dict[Hashable, _Call] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, fn: Callable[[], T]) -> T:
+        """Выполняет ``fn()`` один раз на ключ среди одновременных вызовов."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+            else:
+                call.followers += 1
+                self.coalesced += 1
+        if not leader:
+            log.info("%s: жду уже идущий запрос %s", self.name, key)
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+            if call.followers:
+                log.info(
+                    "%s: %s — результат получили ещё %d",
+                    self.name,
+                    key,
+                    call.followers,
+                )
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "leaders": self.leaders,
+                "coalesced": self.coalesced,
+                "in_flight": len(self._calls),
+            }
+
+
+class AsyncSingleFlight:
+    """Для корутин одного цикла событий: лидер сам сообщает результат."""
+
+    def __init__(self, name: str = "flight"):
+        self.name = name
+        self.leaders = 0
+        self.coalesced = 0
+        self._flights: Dict[Hashable, "asyncio.Future[Any]"] = {}
+
+    def join(self, key: Hashable) -> Tuple[bool, "asyncio.Future[Any]"]:
+        """(лидер?, future результата). Лидер обязан вызвать :meth:`finish`."""
+        fut = self._flights.get(key)
+        if fut is not None and not fut.done():
+            self.coalesced += 1
+            log.info("%s: %s уже выполняется, жду результата", self.name, key)
+            return False, fut
+        fut = asyncio.get_running_loop().create_future()
+        self._flights[key] = fut
+        self.leaders += 1
+        return True, fut
+
+    def finish(self, key: Hashable, result: Any = None) -> None:
+        """Отдаёт результат ожидающим (None — «не вышло, делайте сами»)."""
+        fut = self._flights.pop(key, None)
+        if fut is not None and not fut.done():
+            fut.set_result(result)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._flights),
+        }
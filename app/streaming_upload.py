@@ -0,0 +1,100 @@
+"""Потоковый multipart-аплоад в Bot API без буферизации тела в памяти.
+
+Тело собирает ``requests_toolbelt.MultipartEncoder``, а :class:`UploadBody`
+отдаёт его кусками по ``UPLOAD_CHUNK_SIZE`` байт (последний — меньше) и
+логирует прогресс (как ``main.ProgressFile``). urllib3 просит тело блоками
+по ~16 КБ, но отправляет столько, сколько вернул ``read``, так что
+``throttle``, счётчик байт и ``on_progress`` срабатывают раз на кусок, а не
+на каждые 16 КБ. Память на аплоад — O(размер куска), а не файла.
+``throttle(n)`` перед отдачей куска ждёт лимита полосы (bandwidth.Flow.consume).
+"""
+
+import os
+import time
+import logging
+from typing import Any, Callable, Dict, Optional
+
+import requests
+from requests_toolbelt import MultipartEncoder
+
+from metrics import BYTES
+
+log = logging.getLogger("bot.upload")
+
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))  # 1 MB
+PROGRESS_INTERVAL = float(os.getenv("PROGRESS_INTERVAL", "1.0"))  # сек между логами
+
+ProgressCallback = Callable[[int, int], None]
+
+
+class UploadBody:
+    """File-like обёртка над MultipartEncoder для ``requests.post(data=...)``."""
+
+    def __init__(
+        self,
+        encoder: MultipartEncoder,
+        label: str = "upload",
+        chunk_size: int = UPLOAD_CHUNK_SIZE,
+        on_progress: Optional[ProgressCallback] = None,
+        throttle: Optional[Callable[[int], None]] = None,
+    ):
+        self.encoder = encoder
+        self.len = encoder.len  # requests берёт отсюда Content-Length
+        self.label = label
+        self.chunk_size = chunk_size
+        self.on_progress = on_progress
+        self.throttle = throttle
+        self.sent = 0
+        self.start = time.time()
+        self.last_log = 0.0
+
+    def read(self, size: int = -1) -> bytes:
+        # size (блок urllib3) не важен: отдаём целый кусок chunk_size
+        chunk = self.encoder.read(self.chunk_size)
+        if chunk:
+            if self.throttle is not None:
+                self.throttle(len(chunk))
+            self.sent += len(chunk)
+            BYTES.inc(len(chunk), direction="upload")
+            now = time.time()
+            if now - self.last_log >= PROGRESS_INTERVAL or self.sent >= self.len:
+                pct = (self.sent / self.len * 100) if self.len else 0
+                speed = self.sent / max(1e-6, now - self.start)
+                log.info(
+                    "UP: %5.1f%% of %.2fMiB at %.2fMiB/s (%s)",
+                    pct,
+                    self.len / 1024 / 1024,
+                    speed / 1024 / 1024,
+                    self.label,
+                )
+                self.last_log = now
+            if self.on_progress is not None:
+                self.on_progress(self.sent, self.len)
+        return chunk
+
+
+def post_multipart(
+    url: str,
+    data: Dict[str, Any],
+    files: Dict[str, tuple],
+    timeout: float = 1800,
+    label: str = "upload",
+    session: Optional[requests.Session] = None,
+    on_progress: Optional[ProgressCallback] = None,
+    throttle: Optional[Callable[[int], None]] = None,
+) -> requests.Response:
+    """POST multipart/form-data, читая файлы с диска по мере отправки."""
+    fields: Dict[str, Any] = {
+        k: (str(v).lower() if isinstance(v, bool) else str(v))
+        for k, v in data.items()
+        if v is not None
+    }
+    fields.update(files)
+    encoder = MultipartEncoder(fields=fields)
+    body = UploadBody(encoder, label=label, on_progress=on_progress, throttle=throttle)
+    return (session or requests).post(
+        url,
+        data=body,
+        headers={"Content-Type": encoder.content_type},
+        timeout=timeout,
+    )
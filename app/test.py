@@ -1,8 +1,10 @@
 from yt_dlp import YoutubeDL
 import time
-from typing import List, Dict, Any, Optional
+from typing import Dict, Any, Optional
 import os
 
+from formats import FormatIndex
+
 
 url = "https://www.instagram.com/reels/DOk9ag9COH1/"
 
@@ -49,74 +51,30 @@ def pick_quality(url: str, base_opts: Dict[str, Any]) -> str:
             else:
                 raise
 
-    formats: List[Dict[str, Any]] = info.get("formats", [])
-
-    # выберем лучший аудио-формат (предпочтение m4a/aac, затем по abr)
-    audio_candidates = [
-        f
-        for f in formats
-        if f.get("acodec") not in (None, "none") and f.get("vcodec") in (None, "none")
-    ]
-
-    def audio_score(f):
-        ext = (f.get("ext") or "").lower()
-        pref = 2 if ext in ("m4a", "mp4", "aac") else 1
-        return (pref, f.get("abr") or 0)
+    index = FormatIndex.of(info)
+    best_audio = index.best_audio
 
-    best_audio = max(audio_candidates, key=audio_score) if audio_candidates else None
-
-    # подготовим варианты для пользователя
-    options = []  # each: {label, format_str, size}
-    for f in formats:
-        if (f.get("ext") or "").lower() != "mp4":
-            continue
-        if f.get("vcodec") in (None, "none"):
-            # это чисто аудио — пропустим, мы предлагаем видео-варианты
-            continue
-        height = f.get("height")
-        fps = f.get("fps")
-        vext = f.get("ext")
-        v_id = f.get("format_id")
-        acodec = f.get("acodec")
-        vcodec = f.get("vcodec")
-        tbr = f.get("tbr")
-        size = f.get("filesize") or f.get("filesize_approx")
-
-        if acodec and acodec != "none":
+    # подготовим варианты для пользователя (видео уже отсортированы индексом)
+    options = []  # each: {label, format_str, size, height}
+    for v in index.videos("mp4"):
+        head = f"{v.height}p{'' if not v.fps else f'{int(v.fps)}fps '}({v.ext})"
+        size = index.pair_size(v)
+        if v.has_audio:
             # прогрессивный поток (со звуком)
-            label = f"{height}p{'' if not fps else f'{int(fps)}fps '}({vext}) — prog — ~{human_size(size)}"
-            options.append(
-                {
-                    "label": label,
-                    "format_str": str(v_id),
-                    "size": size or 0,
-                }
-            )
+            label = f"{head} — prog — ~{human_size(size)}"
+        elif best_audio:
+            # только видео — спарим с лучшим аудио
+            label = f"{head} + bestaudio({best_audio.ext}) — ~{human_size(size)}"
         else:
-            # только видео — попробуем спарить с лучшим аудио
-            if best_audio:
-                a_id = best_audio.get("format_id")
-                asize = (
-                    best_audio.get("filesize") or best_audio.get("filesize_approx") or 0
-                )
-                total = (size or 0) + asize
-                label = f"{height}p{'' if not fps else f'{int(fps)}fps '}({vext}) + bestaudio({best_audio.get('ext')}) — ~{human_size(total)}"
-                options.append(
-                    {
-                        "label": label,
-                        "format_str": f"{v_id}+{a_id}",
-                        "size": total,
-                    }
-                )
-            else:
-                label = f"{height}p{'' if not fps else f'{int(fps)}fps '}({vext}) — video-only — ~{human_size(size)}"
-                options.append(
-                    {
-                        "label": label,
-                        "format_str": str(v_id),
-                        "size": size or 0,
-                    }
-                )
+            label = f"{head} — video-only — ~{human_size(size)}"
+        options.append(
+            {
+                "label": label,
+                "format_str": index.pair(v),
+                "size": size,
+                "height": v.height,
+            }
+        )
 
     # уберём дубликаты по format_str и отсортируем по высоте/размеру
     seen = set()
@@ -127,18 +85,7 @@ def pick_quality(url: str, base_opts: Dict[str, Any]) -> str:
         seen.add(opt["format_str"])
         uniq.append(opt)
 
-    def height_from_label(lbl: str) -> int:
-        # ищем число до 'p'
-        try:
-            part = lbl.split("p", 1)[0]
-            digits = "".join(ch for ch in part if ch.isdigit())
-            return int(digits) if digits else 0
-        except Exception:
-            return 0
-
-    uniq.sort(
-        key=lambda o: (height_from_label(o["label"]), o.get("size", 0)), reverse=True
-    )
+    uniq.sort(key=lambda o: (o["height"], o["size"]), reverse=True)
 
     # если mp4-вариантов не нашли — вернём безопасный дефолт
     if not uniq:
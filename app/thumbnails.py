@@ -0,0 +1,123 @@
+"""Миниатюры для sendVideo в пределах лимитов Telegram (JPEG, ≤320px, ≤200KB).
+
+Сначала пробуем готовую картинку из info_dict yt-dlp (``thumbnails``) — если
+у источника есть JPEG не больше 320px, просто скачиваем его, ничего не
+декодируя. Иначе ffmpeg декодирует ровно один ключевой кадр (``-skip_frame
+nokey`` + seek на ключевой кадр из media_info) и сразу уменьшает его до 320px.
+Каждая миниатюра пишется в свой уникальный файл, так что параллельные задачи
+с одинаковыми названиями не пересекаются.
+"""
+
+import os
+import logging
+import tempfile
+import subprocess
+from typing import Any, Dict, Optional
+
+import requests
+
+from media_info import MediaInfo, probe as probe_media
+
+log = logging.getLogger("bot.thumbnails")
+
+THUMB_MAX_SIDE = 320
+THUMB_MAX_BYTES = 200 * 1024
+THUMB_DIR = os.getenv("THUMB_DIR") or tempfile.gettempdir()
+
+
+def _new_path() -> str:
+    fd, path = tempfile.mkstemp(prefix="thumb-", suffix=".jpg", dir=THUMB_DIR)
+    os.close(fd)
+    return path
+
+
+def _discard(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _source_thumbnail_url(info: Dict[str, Any]) -> Optional[str]:
+    """Самый крупный JPEG из info_dict, который влезает в 320x320."""
+    best = None
+    for t in info.get("thumbnails") or []:
+        url, w, h = t.get("url"), t.get("width"), t.get("height")
+        if not url or not w or not h:
+            continue
+        if max(w, h) > THUMB_MAX_SIDE:
+            continue
+        if not url.split("?", 1)[0].lower().endswith((".jpg", ".jpeg")):
+            continue
+        if best is None or w * h > best[0]:
+            best = (w * h, url)
+    return best[1] if best else None
+
+
+def _fetch_source(info: Dict[str, Any]) -> Optional[str]:
+    url = _source_thumbnail_url(info)
+    if not url:
+        return None
+    path = _new_path()
+    try:
+        r = requests.get(url, timeout=10)
+        if r.ok and 0 < len(r.content) <= THUMB_MAX_BYTES:
+            with open(path, "wb") as f:
+                f.write(r.content)
+            log.debug("Миниатюра источника: %s", url)
+            return path
+    except Exception as e:
+        log.debug("Не удалось скачать миниатюру источника %s: %s", url, e)
+    _discard(path)
+    return None
+
+
+def _extract_keyframe(video_path: str, mi: MediaInfo) -> Optional[str]:
+    seek = mi.keyframe_near(1.0) if (mi.duration or 0) > 1.0 else 0.0
+    path = _new_path()
+    try:
+        subprocess.check_call(
+            [
+                "ffmpeg",
+                "-v",
+                "error",
+                "-y",
+                "-skip_frame",
+                "nokey",
+                "-ss",
+                f"{seek:.3f}",
+                "-i",
+                video_path,
+                "-an",
+                "-sn",
+                "-frames:v",
+                "1",
+                "-vf",
+                f"scale={THUMB_MAX_SIDE}:{THUMB_MAX_SIDE}"
+                ":force_original_aspect_ratio=decrease",
+                "-q:v",
+                "4",
+                path,
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        if 0 < os.path.getsize(path) <= THUMB_MAX_BYTES:
+            return path
+    except Exception as e:
+        log.debug("ffmpeg не сделал миниатюру %s: %s", video_path, e)
+    _discard(path)
+    return None
+
+
+def make_thumbnail(
+    video_path: str,
+    mi: Optional[MediaInfo] = None,
+    info: Optional[Dict[str, Any]] = None,
+) -> Optional[str]:
+    """Путь к JPEG-миниатюре (вызывающий удаляет файл) или None."""
+    if info:
+        path = _fetch_source(info)
+        if path:
+            return path
+    return _extract_keyframe(video_path, mi or probe_media(video_path))
@@ -1,10 +1,11 @@
 # send_local_file.py
 import os
-import requests
 import mimetypes
 from pathlib import Path
-import subprocess
-import tempfile
+
+from media_info import probe as probe_media
+from streaming_upload import post_multipart
+from thumbnails import make_thumbnail
 
 CHUNK_SIZE = 2 * 1024 * 1024  # 2 MB
 
@@ -26,68 +27,6 @@ FILEPATH = (
 BASE = f"http://127.0.0.1:8081/bot{BOT_TOKEN}"  # локальный Bot API
 
 
-def ffprobe_meta(path: str):
-    """Return (width, height, duration) via ffprobe; fall back to (None, None, None) if unavailable."""
-    try:
-        cmd = [
-            "ffprobe",
-            "-v",
-            "error",
-            "-select_streams",
-            "v:0",
-            "-show_entries",
-            "stream=width,height:format=duration",
-            "-of",
-            "default=noprint_wrappers=1:nokey=1",
-            path,
-        ]
-        out = (
-            subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-            .decode("utf-8", "ignore")
-            .strip()
-            .splitlines()
-        )
-        # Expected lines: width, height, duration
-        if len(out) >= 3:
-            w = int(float(out[0])) if out[0] else None
-            h = int(float(out[1])) if out[1] else None
-            try:
-                dur = int(float(out[2])) if out[2] else None
-            except ValueError:
-                dur = None
-            return w, h, dur
-    except Exception:
-        pass
-    return None, None, None
-
-
-def make_thumbnail(video_path: str) -> str | None:
-    """Create a JPEG thumbnail at ~1s using ffmpeg; return path or None."""
-    try:
-        tmpdir = tempfile.gettempdir()
-        base = os.path.splitext(os.path.basename(video_path))[0]
-        out = os.path.join(tmpdir, f"{base}.jpg")
-        cmd = [
-            "ffmpeg",
-            "-y",
-            "-ss",
-            "1.0",
-            "-i",
-            video_path,
-            "-vframes",
-            "1",
-            "-q:v",
-            "2",
-            out,
-        ]
-        subprocess.check_call(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        if os.path.isfile(out) and os.path.getsize(out) > 0:
-            return out
-    except Exception:
-        pass
-    return None
-
-
 def main():
     if not os.path.isfile(FILEPATH):
         raise SystemExit(f"Файл не найден: {FILEPATH}")
@@ -99,8 +38,10 @@ def main():
     is_mp4 = ext == ".mp4"
 
     if is_video and is_mp4:
-        w, h, dur = ffprobe_meta(FILEPATH)
-        thumb_path = make_thumbnail(FILEPATH)
+        mi = probe_media(FILEPATH)
+        w, h = mi.width, mi.height
+        dur = int(mi.duration) if mi.duration else None
+        thumb_path = make_thumbnail(FILEPATH, mi)
         files = {
             "video": (path.name, open(FILEPATH, "rb"), "video/mp4"),
         }
@@ -129,7 +70,7 @@ def main():
         data = {"chat_id": CHAT_ID, "caption": path.name}
         url = f"{BASE}/sendDocument"
 
-    r = requests.post(url, data=data, files=files, timeout=1800)
+    r = post_multipart(url, data=data, files=files, timeout=1800, label=path.name)
     print(r.status_code, r.text)
 
 
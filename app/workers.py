@@ -0,0 +1,361 @@
+"""Исполнитель задач yt-dlp: потоки (как раньше) или пул процессов.
+
+Экстракция yt-dlp (расшифровка подписей, разбор JSON, сортировка форматов) и
+постобработка заметно грузят CPU и в потоке делят GIL с циклом событий
+бота. При ``YDL_EXECUTOR=process`` проба и скачивание выполняются в
+``YDL_PROCESSES`` отдельных процессах:
+
+* процессы «тёплые» — стартуют сразу при :meth:`YdlPool.start` через
+  forkserver и заранее импортируют yt_dlp, так что цена импорта платится
+  один раз на процесс, а не на задачу;
+* события прогресса (``progress_hooks``) уходят в общую очередь
+  ``multiprocessing.Manager`` и в родителе передаются колбэку задачи;
+* отмена — через ``Event`` из :meth:`YdlPool.cancel_event`: hook в воркере
+  бросает :class:`jobs.JobCancelled`, и yt-dlp прерывает скачивание.
+
+Функции задач (:func:`extract_info`, :func:`download`) получают только
+сериализуемые аргументы — словари опций без колбэков и info_dict.
+"""
+
+import os
+import copy
+import time
+import types
+import asyncio
+import logging
+import itertools
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, wait
+from typing import Any, Callable, Dict, Optional
+
+from jobs import JobCancelled
+
+log = logging.getLogger("bot.workers")
+
+YDL_EXECUTOR = os.getenv("YDL_EXECUTOR", "thread").strip().lower()
+YDL_PROCESSES = max(1, int(os.getenv("YDL_PROCESSES", "2")))
+
+# Поля события прогресса, которые передаём между процессами
+_PROGRESS_KEYS = (
+    "status",
+    "filename",
+    "downloaded_bytes",
+    "total_bytes",
+    "total_bytes_estimate",
+    "speed",
+    "eta",
+    "elapsed",
+    "fragment_index",
+    "fragment_count",
+)
+
+ProgressCallback = Callable[[Dict[str, Any]], None]
+
+_CANCEL_CHECK_INTERVAL = 0.25  # сек; проверка Event Manager'а — это IPC
+
+# --- сторона воркера ---
+
+_queue = None  # очередь Manager'а, задаётся в _warm
+_job_id: Optional[int] = None
+
+
+def _warm(queue) -> None:
+    """Инициализатор процесса: запоминаем очередь и прогреваем импорты."""
+    global _queue
+    _queue = queue
+    from yt_dlp import YoutubeDL
+    from yt_dlp.extractor import gen_extractor_classes
+
+    gen_extractor_classes()
+    YoutubeDL({"quiet": True, "no_warnings": True}).close()
+
+
+def _ping() -> int:
+    return os.getpid()
+
+
+def _emit(event: Dict[str, Any]) -> None:
+    if _queue is None or _job_id is None:
+        return
+    try:
+        _queue.put_nowait((_job_id, event))
+    except Exception:
+        pass
+
+
+def _checked(
+    progress: Optional[ProgressCallback], cancel
+) -> Optional[ProgressCallback]:
+    """Оборачивает колбэк прогресса проверкой отмены (бросает JobCancelled)."""
+    if cancel is None:
+        return progress
+    last = [0.0]
+
+    def _progress(event: Dict[str, Any]) -> None:
+        now = time.monotonic()
+        if now - last[0] >= _CANCEL_CHECK_INTERVAL:
+            last[0] = now
+            if cancel.is_set():
+                raise JobCancelled()
+        if progress is not None:
+            progress(event)
+
+    return _progress
+
+
+def _invoke(job_id: int, fn: Callable[..., Any], args: tuple, cancel=None) -> Any:
+    global _job_id
+    _job_id = job_id
+    try:
+        return fn(*args, progress=_checked(_emit, cancel))
+    finally:
+        _job_id = None
+
+
+def _slim(d: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: d[k] for k in _PROGRESS_KEYS if d.get(k) is not None}
+
+
+def extract_info(
+    url: str, opts: Dict[str, Any], progress: Optional[ProgressCallback] = None
+) -> Dict[str, Any]:
+    """``extract_info(download=False)`` → sanitize_info (сериализуемый dict)."""
+    from yt_dlp import YoutubeDL
+
+    with YoutubeDL(opts) as ydl:
+        return ydl.sanitize_info(ydl.extract_info(url, download=False))
+
+
+def download(
+    url: str,
+    opts: Dict[str, Any],
+    info: Optional[Dict[str, Any]] = None,
+    ratelimit=None,
+    progress: Optional[ProgressCallback] = None,
+) -> Dict[str, Any]:
+    """Скачивание с постобработкой из ``opts["postprocessors"]``.
+
+    ``info`` — уже проверенный на свежесть info_dict пробы: по нему качаем без
+    повторной экстракции, при DownloadError откатываемся на extract_info.
+    ``ratelimit`` — значение из :meth:`YdlPool.shared_value` (байт/с, 0 — без
+    лимита): доля полосы меняется на ходу, hook переносит её в
+    ``ydl.params["ratelimit"]``.
+    Возвращает компактный результат: title, пути из requested_downloads и
+    итоговый путь из ``post_hooks`` (``final_path``, после MoveFiles).
+    """
+    from yt_dlp import YoutubeDL
+    from yt_dlp.utils import DownloadError
+
+    opts = dict(opts)
+    final: Dict[str, str] = {}
+    opts["post_hooks"] = list(opts.get("post_hooks") or []) + [
+        lambda path: final.__setitem__("path", path)
+    ]
+    if progress is not None:
+
+        started: Dict[str, float] = {}
+
+        def _pp_hook(d: Dict[str, Any]) -> None:
+            name = d.get("postprocessor") or ""
+            if d.get("status") == "started":
+                started[name] = time.monotonic()
+                progress(
+                    {
+                        "status": "postprocessing",
+                        "postprocessor": name,
+                        "filename": (d.get("info_dict") or {}).get("filepath"),
+                    }
+                )
+            elif d.get("status") == "finished" and name in started:
+                # длительность постобработки — для метрик родителя
+                progress(
+                    {
+                        "status": "postprocessed",
+                        "postprocessor": name,
+                        "elapsed": time.monotonic() - started.pop(name),
+                    }
+                )
+
+        opts["progress_hooks"] = list(opts.get("progress_hooks") or []) + [
+            lambda d: progress(_slim(d))
+        ]
+        opts["postprocessor_hooks"] = list(opts.get("postprocessor_hooks") or []) + [
+            _pp_hook
+        ]
+    ydls = []
+    if ratelimit is not None:
+        last = [0.0]
+
+        def _rate_hook(d: Dict[str, Any]) -> None:
+            now = time.monotonic()
+            if ydls and now - last[0] >= _CANCEL_CHECK_INTERVAL:
+                last[0] = now
+                ydls[0].params["ratelimit"] = int(ratelimit.value) or None
+
+        opts["progress_hooks"] = list(opts.get("progress_hooks") or []) + [_rate_hook]
+    with YoutubeDL(opts) as ydl:
+        ydls.append(ydl)
+        if info is not None:
+            try:
+                res = ydl.process_ie_result(copy.deepcopy(info), download=True)
+            except DownloadError as e:
+                log.warning(
+                    "Скачивание по info_dict не удалось (%s), повторяю extract_info", e
+                )
+                res = ydl.extract_info(url, download=True)
+        else:
+            res = ydl.extract_info(url, download=True)
+    return {
+        "title": res.get("title"),
+        "id": res.get("id"),
+        "filepath": res.get("filepath"),
+        "_filename": res.get("_filename"),
+        "requested_downloads": [
+            {"filepath": rd.get("filepath"), "_filename": rd.get("_filename")}
+            for rd in res.get("requested_downloads") or []
+            if isinstance(rd, dict)
+        ],
+        "final_path": final.get("path"),
+    }
+
+
+# --- сторона родителя ---
+
+
+class YdlPool:
+    def __init__(self, kind: str = YDL_EXECUTOR, processes: int = YDL_PROCESSES):
+        if kind not in {"thread", "process"}:
+            log.warning("Неизвестный YDL_EXECUTOR=%s, использую thread", kind)
+            kind = "thread"
+        self.kind = kind
+        self.processes = processes
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._manager = None
+        self._queue = None
+        self._reader: Optional[threading.Thread] = None
+        self._callbacks: Dict[int, ProgressCallback] = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        """Поднимает процессы и ждёт, пока каждый импортирует yt_dlp."""
+        if self.kind != "process" or self._pool is not None:
+            return
+        ctx = multiprocessing.get_context(
+            "forkserver"
+            if "forkserver" in multiprocessing.get_all_start_methods()
+            else "spawn"
+        )
+        self._manager = ctx.Manager()
+        self._queue = self._manager.Queue()
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=ctx,
+            initializer=_warm,
+            initargs=(self._queue,),
+        )
+        self._reader = threading.Thread(
+            target=self._read_progress, name="ydl-progress", daemon=True
+        )
+        self._reader.start()
+        pings = [self._pool.submit(_ping) for _ in range(self.processes)]
+        wait(pings)
+        log.info(
+            "Пул yt-dlp: %d процессов (%s)",
+            self.processes,
+            sorted({f.result() for f in pings if not f.exception()}),
+        )
+
+    def cancel_event(self):
+        """Event отмены, который можно передать в задачу (и в процесс пула)."""
+        if self.kind == "process" and self._manager is not None:
+            return self._manager.Event()
+        return threading.Event()
+
+    def shared_value(self, value: float = 0):
+        """Число с ``.value``, которое видно и задаче в процессе пула."""
+        if self.kind == "process" and self._manager is not None:
+            return self._manager.Value("d", value)
+        return types.SimpleNamespace(value=value)
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+        if self._queue is not None:
+            try:
+                self._queue.put(None)
+            except Exception:
+                pass
+        if self._manager is not None:
+            self._manager.shutdown()
+            self._manager = None
+
+    def _read_progress(self) -> None:
+        while True:
+            try:
+                item = self._queue.get()
+            except Exception:
+                return
+            if item is None:
+                return
+            job_id, event = item
+            with self._lock:
+                cb = self._callbacks.get(job_id)
+            if cb is None:
+                continue
+            try:
+                cb(event)
+            except Exception:
+                log.debug("Ошибка в колбэке прогресса", exc_info=True)
+
+    def submit(
+        self,
+        fn: Callable[..., Any],
+        *args,
+        on_progress: Optional[ProgressCallback] = None,
+        cancel=None,
+    ) -> Future:
+        if self._pool is None:
+            raise RuntimeError("Пул процессов не запущен")
+        job_id = next(self._ids)
+        if on_progress is not None:
+            with self._lock:
+                self._callbacks[job_id] = on_progress
+        fut = self._pool.submit(_invoke, job_id, fn, args, cancel)
+
+        def _forget(_f: Future) -> None:
+            with self._lock:
+                self._callbacks.pop(job_id, None)
+
+        fut.add_done_callback(_forget)
+        return fut
+
+    def call(
+        self,
+        fn: Callable[..., Any],
+        *args,
+        on_progress: Optional[ProgressCallback] = None,
+        cancel=None,
+    ) -> Any:
+        """Синхронный вызов: в режиме thread — прямо в текущем потоке."""
+        if self.kind == "thread":
+            return fn(*args, progress=_checked(on_progress, cancel))
+        return self.submit(fn, *args, on_progress=on_progress, cancel=cancel).result()
+
+    async def run(
+        self,
+        fn: Callable[..., Any],
+        *args,
+        on_progress: Optional[ProgressCallback] = None,
+        cancel=None,
+    ) -> Any:
+        """Асинхронный вызов: поток executor'а или процесс пула."""
+        if self.kind == "thread":
+            return await asyncio.to_thread(
+                fn, *args, progress=_checked(on_progress, cancel)
+            )
+        return await asyncio.wrap_future(
+            self.submit(fn, *args, on_progress=on_progress, cancel=cancel)
+        )
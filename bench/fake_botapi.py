@@ -0,0 +1,136 @@
+"""Локальная заглушка Bot API: принимает вызовы бота и только считает байты.
+
+``sendVideo`` / ``sendDocument`` / ``sendAnimation`` читают тело целиком
+(Content-Length или chunked, как у конвейерного аплоада) и отвечают сообщением
+с фиктивным file_id; ``editMessageText`` и прочие методы — ``ok``.
+``delay`` — искусственная задержка ответа (сек), чтобы изобразить сеть до
+Telegram.
+"""
+
+import json
+import time
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional
+
+log = logging.getLogger("bench.botapi")
+
+_CHUNK = 256 * 1024
+_MEDIA = {
+    "sendVideo": "video",
+    "sendDocument": "document",
+    "sendAnimation": "animation",
+}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: "_Server"
+    protocol_version = "HTTP/1.1"  # keep-alive, как у настоящего Bot API
+
+    def do_GET(self) -> None:
+        self._handle()
+
+    def do_POST(self) -> None:
+        self._handle()
+
+    def _drain(self) -> int:
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            total = 0
+            while True:
+                size = int(self.rfile.readline().split(b";", 1)[0].strip() or b"0", 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return total
+                left = size
+                while left:
+                    left -= len(self.rfile.read(min(_CHUNK, left)))
+                self.rfile.readline()
+                total += size
+        left = total = int(self.headers.get("Content-Length") or 0)
+        while left:
+            chunk = self.rfile.read(min(_CHUNK, left))
+            if not chunk:
+                break
+            left -= len(chunk)
+        return total
+
+    def _handle(self) -> None:
+        method = self.path.split("?", 1)[0].rsplit("/", 1)[-1]
+        size = self._drain()
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        msg_id = self.server.count(method, size)
+        result: Any = True
+        if method in _MEDIA:
+            result = {
+                "message_id": msg_id,
+                "date": int(time.time()),
+                "chat": {"id": 0, "type": "private"},
+                _MEDIA[method]: {
+                    "file_id": f"bench-{msg_id}",
+                    "file_unique_id": f"bench-u{msg_id}",
+                    "file_size": size,
+                },
+            }
+        elif method == "getUpdates":
+            result = []
+        elif method in ("sendMessage", "editMessageText"):
+            result = {"message_id": msg_id, "date": int(time.time())}
+        body = json.dumps({"ok": True, "result": result}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt: str, *args: Any) -> None:
+        log.debug("botapi: " + fmt, *args)
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, addr, delay: float):
+        super().__init__(addr, _Handler)
+        self.delay = delay
+        self.calls: Dict[str, int] = {}
+        self.bytes = 0
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def count(self, method: str, size: int) -> int:
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            self.bytes += size
+            self._next_id += 1
+            return self._next_id
+
+
+class FakeBotAPI:
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self._server: Optional[_Server] = None
+
+    @property
+    def url(self) -> str:
+        """BASE_URL для bot.py (без ``/bot<token>``)."""
+        assert self._server is not None
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def start(self) -> "FakeBotAPI":
+        self._server = _Server(("127.0.0.1", 0), self.delay)
+        threading.Thread(
+            target=self._server.serve_forever, name="bench-botapi", daemon=True
+        ).start()
+        return self
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def stats(self) -> Dict[str, Any]:
+        assert self._server is not None
+        with self._server._lock:
+            return {"calls": dict(self._server.calls), "bytes": self._server.bytes}
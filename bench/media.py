@@ -0,0 +1,308 @@
+"""Синтетические ролики и локальный HTTP-сервер для generic-экстрактора yt-dlp.
+
+* прогрессивный MP4 (``progressive-<N>mb.mp4``) — прямая ссылка, yt-dlp
+  качает один файл;
+* DASH (``dash-<N>mb.mpd``) — манифест с отдельными видео (``.mp4``) и звуком
+  (``.m4a``) без сегментов: две загрузки и склейка, как у YouTube/Vimeo.
+
+С ffmpeg ролики настоящие (testsrc2 + sine, CBR ~8 Мбит/с, размер добираем
+``-stream_loop`` без перекодирования), так что ffprobe, миниатюра и ремукс
+работают по-настоящему. Без ffmpeg прогрессивный файл — заголовок ``ftyp`` и
+случайные байты, а DASH недоступен (склеивать нечем).
+
+:class:`MediaServer` отдаёт файлы каталога с поддержкой Range (aria2c качает
+кусками) и, при ``rate`` > 0, ограничивает скорость каждого соединения — так
+изображают CDN, который режет скорость на соединение.
+"""
+
+import os
+import re
+import math
+import shutil
+import logging
+import threading
+import subprocess
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional, Tuple
+
+log = logging.getLogger("bench.media")
+
+MB = 1024 * 1024
+_CHUNK = 256 * 1024
+_BASE_SECONDS = 4  # длина исходного клипа, дальше — копии через -stream_loop
+_VIDEO_BITRATE = "8M"
+
+_TYPES = {
+    ".mp4": "video/mp4",
+    ".m4a": "audio/mp4",
+    ".mpd": "application/dash+xml",
+}
+
+_MPD = """<?xml version="1.0" encoding="UTF-8"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static"
+     profiles="urn:mpeg:dash:profile:isoff-on-demand:2011"
+     mediaPresentationDuration="PT{duration:.3f}S" minBufferTime="PT2S">
+  <Period>
+    <AdaptationSet mimeType="video/mp4" contentType="video">
+      <Representation id="v720" codecs="avc1.64001f" width="1280" height="720"
+                      frameRate="30" bandwidth="{vbw}">
+        <BaseURL>{video}</BaseURL>
+      </Representation>
+    </AdaptationSet>
+    <AdaptationSet mimeType="audio/mp4" contentType="audio" lang="en">
+      <Representation id="a128" codecs="mp4a.40.2" audioSamplingRate="48000"
+                      bandwidth="128000">
+        <BaseURL>{audio}</BaseURL>
+      </Representation>
+    </AdaptationSet>
+  </Period>
+</MPD>
+"""
+
+
+def have_ffmpeg() -> bool:
+    return bool(shutil.which("ffmpeg") and shutil.which("ffprobe"))
+
+
+def _ffmpeg(*args: str) -> None:
+    subprocess.run(["ffmpeg", "-y", "-v", "error", *args], check=True)
+
+
+def _duration(path: str) -> float:
+    out = subprocess.check_output(
+        [
+            "ffprobe",
+            "-v",
+            "error",
+            "-show_entries",
+            "format=duration",
+            "-of",
+            "csv=p=0",
+            path,
+        ]
+    )
+    return float(out.strip() or 0)
+
+
+def _base_clip(root: str) -> str:
+    path = os.path.join(root, "base.mp4")
+    if not os.path.isfile(path):
+        log.info("Кодирую исходный клип %d c…", _BASE_SECONDS)
+        _ffmpeg(
+            "-f",
+            "lavfi",
+            "-i",
+            "testsrc2=size=1280x720:rate=30",
+            "-f",
+            "lavfi",
+            "-i",
+            "sine=frequency=440:sample_rate=48000",
+            "-t",
+            str(_BASE_SECONDS),
+            "-c:v",
+            "libx264",
+            "-preset",
+            "ultrafast",
+            "-b:v",
+            _VIDEO_BITRATE,
+            "-minrate",
+            _VIDEO_BITRATE,
+            "-maxrate",
+            _VIDEO_BITRATE,
+            "-bufsize",
+            _VIDEO_BITRATE,
+            "-x264-params",
+            "nal-hrd=cbr",
+            "-g",
+            "60",
+            "-pix_fmt",
+            "yuv420p",
+            "-c:a",
+            "aac",
+            "-b:a",
+            "128k",
+            path,
+        )
+    return path
+
+
+def _synthetic(path: str, size: int) -> None:
+    """Файл ``size`` байт: бокс ftyp и повторяющийся случайный блок."""
+    block = os.urandom(MB)
+    with open(path, "wb") as f:
+        f.write(b"\x00\x00\x00\x18ftypisom\x00\x00\x02\x00isomiso2")
+        left = size - f.tell()
+        while left > 0:
+            n = min(left, len(block))
+            f.write(block[:n])
+            left -= n
+
+
+def progressive(root: str, size_mb: int) -> str:
+    """Имя прогрессивного MP4 примерно на ``size_mb`` МБ (создаёт, если нет)."""
+    name = f"progressive-{size_mb}mb.mp4"
+    path = os.path.join(root, name)
+    if os.path.isfile(path):
+        return name
+    if not have_ffmpeg():
+        _synthetic(path, size_mb * MB)
+        return name
+    base = _base_clip(root)
+    loops = max(1, math.ceil(size_mb * MB / os.path.getsize(base)))
+    _ffmpeg(
+        "-stream_loop",
+        str(loops - 1),
+        "-i",
+        base,
+        "-c",
+        "copy",
+        "-movflags",
+        "+faststart",
+        path,
+    )
+    return name
+
+
+def dash(root: str, size_mb: int) -> Optional[str]:
+    """Имя MPD с отдельными дорожками (None без ffmpeg)."""
+    if not have_ffmpeg():
+        return None
+    name = f"dash-{size_mb}mb.mpd"
+    if os.path.isfile(os.path.join(root, name)):
+        return name
+    src = os.path.join(root, progressive(root, size_mb))
+    video, audio = f"dash-{size_mb}mb-v.mp4", f"dash-{size_mb}mb-a.m4a"
+    _ffmpeg("-i", src, "-map", "0:v", "-c", "copy", os.path.join(root, video))
+    _ffmpeg("-i", src, "-map", "0:a", "-c", "copy", os.path.join(root, audio))
+    duration = _duration(src) or 1.0
+    vbw = int(os.path.getsize(os.path.join(root, video)) * 8 / duration)
+    with open(os.path.join(root, name), "w", encoding="utf-8") as f:
+        f.write(_MPD.format(duration=duration, vbw=vbw, video=video, audio=audio))
+    return name
+
+
+def _parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    m = re.match(r"bytes=(\d*)-(\d*)$", (header or "").strip())
+    if not m or not (m.group(1) or m.group(2)):
+        return None
+    if m.group(1):
+        start = int(m.group(1))
+        end = int(m.group(2)) if m.group(2) else size - 1
+    else:  # последние N байт
+        start, end = max(0, size - int(m.group(2))), size - 1
+    return start, min(end, size - 1)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: "_Server"
+
+    def do_HEAD(self) -> None:
+        self._serve(body=False)
+
+    def do_GET(self) -> None:
+        self._serve(body=True)
+
+    def _serve(self, body: bool) -> None:
+        name = os.path.basename(self.path.split("?", 1)[0])
+        path = os.path.join(self.server.root, name)
+        if not name or not os.path.isfile(path):
+            self.send_error(404)
+            return
+        size = os.path.getsize(path)
+        rng = _parse_range(self.headers.get("Range"), size)
+        if rng is not None and rng[0] >= size:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.end_headers()
+            return
+        start, end = rng or (0, size - 1)
+        self.send_response(206 if rng else 200)
+        self.send_header(
+            "Content-Type",
+            _TYPES.get(os.path.splitext(name)[1], "application/octet-stream"),
+        )
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        if rng:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        self.server.count(ranged=rng is not None)
+        if body:
+            self._copy(path, start, end - start + 1)
+
+    def _copy(self, path: str, offset: int, length: int) -> None:
+        rate = self.server.rate
+        t0 = time.monotonic()
+        sent = 0
+        try:
+            with open(path, "rb") as f:
+                f.seek(offset)
+                while sent < length:
+                    chunk = f.read(min(_CHUNK, length - sent))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    sent += len(chunk)
+                    if rate > 0:
+                        ahead = sent / rate - (time.monotonic() - t0)
+                        if ahead > 0:
+                            time.sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            # generic-экстрактор читает только начало ответа и закрывает его
+            pass
+        finally:
+            self.server.count(sent=sent)
+
+    def log_message(self, fmt: str, *args: Any) -> None:
+        log.debug("media: " + fmt, *args)
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, addr, root: str, rate: float):
+        super().__init__(addr, _Handler)
+        self.root = root
+        self.rate = rate
+        self.stats = {"requests": 0, "ranged": 0, "bytes": 0}
+        self._lock = threading.Lock()
+
+    def count(self, ranged: bool = False, sent: int = 0) -> None:
+        with self._lock:
+            if sent:
+                self.stats["bytes"] += sent
+            else:
+                self.stats["requests"] += 1
+                self.stats["ranged"] += int(ranged)
+
+
+class MediaServer:
+    """Раздаёт каталог ``root`` на 127.0.0.1; ``rate`` — байт/с на соединение."""
+
+    def __init__(self, root: str, rate: float = 0):
+        self.root = root
+        self.rate = rate
+        self._server: Optional[_Server] = None
+
+    @property
+    def url(self) -> str:
+        assert self._server is not None
+        return f"http://127.0.0.1:{self._server.server_address[1]}/"
+
+    def start(self) -> "MediaServer":
+        self._server = _Server(("127.0.0.1", 0), self.root, self.rate)
+        threading.Thread(
+            target=self._server.serve_forever, name="bench-media", daemon=True
+        ).start()
+        return self
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def stats(self) -> Dict[str, int]:
+        assert self._server is not None
+        with self._server._lock:
+            return dict(self._server.stats)
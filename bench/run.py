@@ -0,0 +1,360 @@
+"""Офлайн-бенчмарк конвейера проба → скачивание → аплоад.
+
+Поднимает на 127.0.0.1 две заглушки:
+
+* :class:`media.MediaServer` — синтетические ролики (прогрессивный MP4 и DASH
+  с отдельными дорожками) для generic-экстрактора yt-dlp;
+* :class:`fake_botapi.FakeBotAPI` — Bot API, который принимает
+  sendVideo/sendDocument/editMessageText и только считает байты;
+
+и гоняет через них код бота без Telegram и интернета:
+
+* ``bot`` — ``_probe_mp4_choices`` → ``ydl_download`` → ``send_video``;
+* ``main`` — ``_probe_quality_options`` → ``_download_video`` (аплоад в
+  main.py идёт через python-telegram-bot и здесь не меряется).
+
+Для каждого сочетания (цель, тип ролика, размер, число одновременных задач)
+печатает задержку этапов (среднее и p95), скорость на задачу и суммарную,
+подэтапы из ``metrics.STAGE_SECONDS`` (склейка, ffprobe, миниатюра…), пиковый
+RSS процесса и всех его потомков (aria2c, ffmpeg) и число запросов к
+медиасерверу (Range-запросы — куски aria2c).
+
+Запуск из корня репозитория::
+
+    python bench/run.py --sizes 16,64 --concurrency 1,4 | tee bench_output.txt
+
+Без ffmpeg ролики — случайные байты с заголовком MP4, DASH пропускается.
+aria2c используется, если он есть в PATH (как в Docker-образе), иначе yt-dlp
+качает сам. Настройки бота (ARIA_*, BW_*, YDL_EXECUTOR…) берутся из окружения,
+как при обычном запуске.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import media
+from fake_botapi import FakeBotAPI
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "app")
+MB = 1024 * 1024
+_RSS_INTERVAL = 0.05  # сек между замерами RSS
+
+log = logging.getLogger("bench")
+
+# этап -> (секунды, байты) одной задачи
+Stages = Dict[str, Tuple[float, int]]
+
+
+def _rss(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/status", "rb") as f:
+            for line in f:
+                if line.startswith(b"VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+class RssSampler:
+    """Пиковый RSS процесса и суммы по дереву потомков (aria2c, ffmpeg)."""
+
+    def __init__(self, interval: float = _RSS_INTERVAL):
+        self.interval = interval
+        self.peak_self = 0
+        self.peak_tree = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="rss", daemon=True)
+
+    def _sample(self) -> None:
+        # дерево процессов читаем так же, как отмена задач (jobs.py)
+        from jobs import _proc_children
+
+        me = os.getpid()
+        own = _rss(me)
+        children = _proc_children()
+        tree, stack = own, list(children.get(me, []))
+        while stack:
+            pid = stack.pop()
+            tree += _rss(pid)
+            stack.extend(children.get(pid, []))
+        self.peak_self = max(self.peak_self, own)
+        self.peak_tree = max(self.peak_tree, tree)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self) -> "RssSampler":
+        if os.path.isdir("/proc"):
+            self._sample()
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+
+def _timed(stages: Stages, name: str, fn: Callable[[], Any], size=None) -> Any:
+    t0 = time.perf_counter()
+    result = fn()
+    n = size(result) if size is not None else 0
+    stages[name] = (time.perf_counter() - t0, n)
+    return result
+
+
+def _bot_job(url: str, chat_id: int) -> Stages:
+    import bot
+
+    stages: Stages = {}
+    job = bot.JOBS.new(chat_id, url)
+    try:
+        choices, info = _timed(stages, "probe", lambda: bot._probe_mp4_choices(url))
+        path = _timed(
+            stages,
+            "download",
+            lambda: bot.ydl_download(url, choices[0][1], info, job=job),
+            size=lambda p: p.stat().st_size,
+        )
+        size = path.stat().st_size
+        code, body = _timed(
+            stages, "upload", lambda: bot.send_video(chat_id, path, info, job)
+        )
+        if code != 200:
+            raise RuntimeError(f"sendVideo: {code} {body[:200]}")
+        stages["upload"] = (stages["upload"][0], size)
+        return stages
+    finally:
+        bot.JOBS.finish(job)
+        job.cleanup()
+
+
+def _main_job(url: str, chat_id: int) -> Stages:
+    import main
+
+    stages: Stages = {}
+    job = main.JOBS.new(chat_id, url, cancel_event=main.YDL_POOL.cancel_event())
+    try:
+        _, info = _timed(stages, "probe", lambda: main._probe_quality_options(url))
+        _timed(
+            stages,
+            "download",
+            lambda: main._download_video(url, "best", None, info, job),
+            size=os.path.getsize,
+        )
+        return stages
+    finally:
+        main.JOBS.finish(job)
+        job.cleanup()
+
+
+TARGETS: Dict[str, Callable[[str, int], Stages]] = {"bot": _bot_job, "main": _main_job}
+
+
+def _pct(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def run_case(
+    target: str, url: str, concurrency: int, server: media.MediaServer
+) -> Dict[str, Any]:
+    import metrics
+
+    before = metrics.STAGE_SECONDS.totals()
+    served = server.stats()
+    errors: List[str] = []
+
+    def _one(i: int) -> Optional[Stages]:
+        try:
+            return TARGETS[target](url, 1000 + i)
+        except Exception as e:
+            log.warning("%s #%d: %r", target, i, e)
+            errors.append(f"{type(e).__name__}: {e}")
+            return None
+
+    with RssSampler() as rss:
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(concurrency, thread_name_prefix="bench") as ex:
+            runs = [r for r in ex.map(_one, range(concurrency)) if r is not None]
+        wall = time.perf_counter() - t0
+
+    stages: Dict[str, Dict[str, float]] = {}
+    for name in ("probe", "download", "upload"):
+        samples = [r[name] for r in runs if name in r]
+        if not samples:
+            continue
+        secs = [s for s, _ in samples]
+        total_bytes = sum(n for _, n in samples)
+        stages[name] = {
+            "n": len(samples),
+            "mean": sum(secs) / len(secs),
+            "p95": _pct(secs, 0.95),
+            "mb_s": (total_bytes / MB / sum(secs)) if total_bytes else 0.0,
+        }
+    # подэтапы, которые код бота сам пишет в метрики (ffprobe, склейка…)
+    substages: Dict[str, Dict[str, float]] = {}
+    for (stage, status), (total, n) in metrics.STAGE_SECONDS.totals().items():
+        prev_total, prev_n = before.get((stage, status), (0.0, 0))
+        if n > prev_n and status == "ok":
+            substages[stage] = {
+                "n": n - prev_n,
+                "mean": (total - prev_total) / (n - prev_n),
+            }
+    after = server.stats()
+    downloaded = sum(r["download"][1] for r in runs if "download" in r)
+    return {
+        "wall": wall,
+        "jobs": concurrency,
+        "ok": len(runs),
+        "errors": errors,
+        "stages": stages,
+        "substages": substages,
+        "aggregate_mb_s": downloaded / MB / wall if wall else 0.0,
+        "peak_rss_mb": rss.peak_self / MB,
+        "peak_rss_tree_mb": rss.peak_tree / MB,
+        "requests": after["requests"] - served["requests"],
+        "ranged": after["ranged"] - served["ranged"],
+    }
+
+
+def _print_case(key: str, r: Dict[str, Any], out) -> None:
+    print(
+        f"\n== {key}: {r['ok']}/{r['jobs']} ok за {r['wall']:.2f} c, "
+        f"{r['aggregate_mb_s']:.1f} MB/s суммарно, пик RSS {r['peak_rss_mb']:.0f} MB "
+        f"(с потомками {r['peak_rss_tree_mb']:.0f} MB), запросов к медиа "
+        f"{r['requests']} (Range {r['ranged']})",
+        file=out,
+    )
+    print(
+        f"   {'этап':<12}{'n':>4}{'среднее, c':>12}{'p95, c':>10}{'MB/s':>9}", file=out
+    )
+    for name, s in r["stages"].items():
+        mb_s = f"{s['mb_s']:.1f}" if s["mb_s"] else "-"
+        print(
+            f"   {name:<12}{s['n']:>4}{s['mean']:>12.3f}{s['p95']:>10.3f}{mb_s:>9}",
+            file=out,
+        )
+    for name, s in sorted(r["substages"].items()):
+        print(f"     · {name:<10}{s['n']:>4}{s['mean']:>12.3f}", file=out)
+    for err in r["errors"][:3]:
+        print(f"   ! {err[:200]}", file=out)
+
+
+def _csv(value: str) -> List[str]:
+    return [v.strip() for v in value.split(",") if v.strip()]
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    ap.add_argument("--sizes", default="16,64", help="размеры роликов, МБ")
+    ap.add_argument("--concurrency", default="1,4", help="одновременных задач")
+    ap.add_argument("--media", default="progressive,dash", help="типы роликов")
+    ap.add_argument("--targets", default="bot,main", help="bot и/или main")
+    ap.add_argument(
+        "--server-rate", type=float, default=0, help="МБ/с на соединение (0 — без)"
+    )
+    ap.add_argument("--api-delay", type=float, default=0, help="задержка Bot API, c")
+    ap.add_argument("--workdir", help="каталог для роликов и загрузок")
+    ap.add_argument("--keep", action="store_true", help="не удалять --workdir")
+    ap.add_argument("--json", help="сохранить результаты в JSON")
+    ap.add_argument("-v", "--verbose", action="store_true", help="логи бота и yt-dlp")
+    args = ap.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING,
+        format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
+    )
+    work = args.workdir or tempfile.mkdtemp(prefix="dlbot-bench-")
+    media_dir = os.path.join(work, "media")
+    os.makedirs(media_dir, exist_ok=True)
+
+    server = media.MediaServer(media_dir, rate=args.server_rate * MB).start()
+    api = FakeBotAPI(delay=args.api_delay).start()
+    # bot.py и main.py читают настройки при импорте
+    os.environ.update(
+        {
+            "BOT_TOKEN": "bench:token",
+            "BASE_URL": api.url,
+            "OUT_DIR": os.path.join(work, "out"),
+            "DOWNLOAD_DIR": os.path.join(work, "download"),
+            "PROBE_CACHE_TTL": "0",  # каждая проба — настоящая
+            "PROBE_CACHE_SQLITE": "false",
+            "METRICS_PORT": "0",
+        }
+    )
+    os.environ.setdefault("LOG_LEVEL", "INFO" if args.verbose else "WARNING")
+    sys.path.insert(0, os.path.abspath(APP_DIR))
+    targets = [t for t in _csv(args.targets) if t in TARGETS]
+    for t in targets:
+        __import__(t)
+    if "main" in targets:
+        sys.modules["main"].YDL_POOL.start()
+
+    have_ffmpeg = media.have_ffmpeg()
+    out = sys.stdout
+    print(
+        f"ffmpeg: {'да' if have_ffmpeg else 'нет (синтетика, без DASH)'}, "
+        f"aria2c: {'да' if shutil.which('aria2c') else 'нет (качает yt-dlp)'}, "
+        f"лимит медиасервера: {args.server_rate or 'нет'} MB/s на соединение",
+        file=out,
+    )
+    results: Dict[str, Any] = {}
+    devnull = open(os.devnull, "w")
+    try:
+        for kind in _csv(args.media):
+            for size in (int(s) for s in _csv(args.sizes)):
+                name = (
+                    media.progressive(media_dir, size)
+                    if kind == "progressive"
+                    else None
+                )
+                if kind == "dash":
+                    name = media.dash(media_dir, size)
+                if name is None:
+                    print(f"\n-- {kind} {size} MB: пропущено (нужен ffmpeg)", file=out)
+                    continue
+                for conc in (int(c) for c in _csv(args.concurrency)):
+                    for target in targets:
+                        key = f"{target} {kind} {size}MB x{conc}"
+                        log.warning("Запускаю %s", key)
+                        # yt-dlp в main.py печатает прогресс в stdout
+                        quiet = (
+                            contextlib.redirect_stdout(devnull)
+                            if not args.verbose
+                            else contextlib.nullcontext()
+                        )
+                        with quiet:
+                            results[key] = run_case(
+                                target, server.url + name, conc, server
+                            )
+                        _print_case(key, results[key], out)
+        print(f"\nBot API: {api.stats()}", file=out)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(results, f, ensure_ascii=False, indent=2)
+    finally:
+        devnull.close()
+        if "main" in targets:
+            sys.modules["main"].YDL_POOL.shutdown()
+        server.stop()
+        api.stop()
+        if not args.keep and not args.workdir:
+            shutil.rmtree(work, ignore_errors=True)
+    return 0 if all(not r["errors"] for r in results.values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
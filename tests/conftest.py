@@ -0,0 +1,5 @@
+import os
+import sys
+
+# модули бота лежат плоско в app/ и импортируются как соседи
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
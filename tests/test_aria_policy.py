@@ -0,0 +1,62 @@
+"""Опции aria2c из AriaPolicy должны быть настоящими параметрами YoutubeDL."""
+
+import re
+
+import pytest
+from yt_dlp import YoutubeDL
+from yt_dlp.downloader import get_suitable_downloader
+from yt_dlp.downloader.external import Aria2cFD
+
+from aria_policy import AriaPolicy
+
+_INFO = {
+    "extractor_key": "Vimeo",
+    "url": "https://example.com/v.mp4",
+    "protocol": "https",
+    "ext": "mp4",
+}
+
+
+def _params():
+    """Параметры из докстринга YoutubeDL: ``name: ...`` и список для загрузчиков."""
+    doc = YoutubeDL.__doc__ or ""
+    names = set(re.findall(r"^\s{4}(\w+):", doc, re.MULTILINE))
+    m = re.search(r"used by\s+the downloader.*?:(.*?)\n\s*\n", doc, re.DOTALL)
+    if m:
+        names |= set(re.findall(r"\w+", m.group(1)))
+    return names
+
+
+@pytest.fixture
+def aria_available(monkeypatch):
+    monkeypatch.setattr(Aria2cFD, "available", classmethod(lambda cls, path=None: True))
+
+
+def test_opts_are_youtubedl_params():
+    opts = AriaPolicy().lease("https://vimeo.com/1", _INFO).opts()
+    unknown = set(opts) - _params()
+    assert not unknown, f"YoutubeDL не знает параметров: {unknown}"
+
+
+def test_http_goes_through_aria2c(aria_available):
+    opts = AriaPolicy().lease("https://vimeo.com/1", _INFO).opts()
+    assert get_suitable_downloader(_INFO, opts) is Aria2cFD
+
+
+def test_split_overrides_ytdlp_defaults(aria_available):
+    lease = AriaPolicy(max_split=3).lease("https://vimeo.com/1", _INFO)
+    with YoutubeDL({**lease.opts(), "quiet": True, "ratelimit": 1024}) as ydl:
+        cmd = Aria2cFD(ydl, ydl.params)._make_cmd("v.mp4", dict(_INFO))
+    # aria2c берёт последнее значение опции
+    assert cmd.index("--split=3") > cmd.index("-s16")
+    assert "--max-connection-per-server=3" in cmd
+    assert "--max-overall-download-limit" in cmd
+
+
+def test_bot_base_opts_are_youtubedl_params(monkeypatch, tmp_path):
+    monkeypatch.setenv("BOT_TOKEN", "0:test")
+    monkeypatch.setenv("BASE_URL", "http://127.0.0.1:1")
+    monkeypatch.setenv("OUT_DIR", str(tmp_path))
+    bot = pytest.importorskip("bot")
+    unknown = set(bot.YDL_OPTS_BASE) - _params()
+    assert not unknown, f"YoutubeDL не знает параметров: {unknown}"